@@ -0,0 +1,5 @@
+"""Benchmarks for the mailchimp writer
+
+Not part of the writer image entrypoint, run them from the repository root,
+e.g. `python3 -m benchmarks.run_writer --rows 10000 100000`
+"""
@@ -0,0 +1,716 @@
+"""A local stand-in for the Mailchimp v3 API
+
+Implements just enough of the API for the writer to run end-to-end against it:
+
+- `GET /` (credentials check)
+- `GET|POST /batches`, `GET /batches/{batch_id}`
+- `GET|POST /lists`, `GET|PATCH /lists/{list_id}`
+- `POST /lists/{list_id}` (batch subscribe)
+- `GET|POST /lists/{list_id}/merge-fields`,
+  `PATCH /lists/{list_id}/merge-fields/{merge_id}`
+- `GET /lists/{list_id}/members`,
+  `GET|PUT|PATCH|DELETE /lists/{list_id}/members/{subscriber_hash}`
+- `POST /lists/{list_id}/members/{subscriber_hash}/tags`
+- `GET|POST /lists/{list_id}/segments`,
+  `POST /lists/{list_id}/segments/{segment_id}` (static segment members)
+
+Batches are processed one after another (as mailchimp does) at a configurable
+speed, the per operation responses are served as a `.tar.gz` from the
+`response_body_url` of the batch. Every request can be delayed (`latency`),
+randomly rejected with `429 Too Many Requests` and a `Retry-After` header
+(`throttle_rate`) and every operation (both direct and within a batch) can
+randomly fail with `400` (`error_rate`). The rejected requests are counted
+as `throttled` in the stats.
+
+`GET /_stats` returns the number of API calls per endpoint, `POST /_reset`
+zeroes them and `POST /_configure` changes the latency and the error rates of a
+running server (so that the setup of a benchmark isn't affected by them).
+
+Usage:
+    server = FakeMailchimp(port=0, latency=0.05, batch_ops_per_second=1000)
+    server.start()      # runs in a separate process
+    client = server.client()
+    ...
+    server.stop()
+"""
+from collections import Counter
+from hashlib import md5
+import io
+import json
+import logging
+import multiprocessing
+import random
+import re
+import tarfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from mailchimp3 import MailChimp
+
+API_PREFIX = '/3.0'
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def _iso(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S+00:00')
+
+
+class ApiError(Exception):
+    def __init__(self, status, title, detail=''):
+        super(ApiError, self).__init__(title)
+        self.status = status
+        self.title = title
+        self.detail = detail
+
+    def body(self):
+        return {'type': 'http://developer.mailchimp.com/documentation/'
+                        'mailchimp/guides/error-glossary/',
+                'title': self.title,
+                'status': self.status,
+                'detail': self.detail,
+                'instance': str(uuid.uuid4())}
+
+
+class MailchimpState(object):
+    """In-memory account state shared by all request handler threads"""
+
+    def __init__(self, batch_ops_per_second=1000, error_rate=0.0,
+                 throttle_rate=0.0, seed=42, base_url=''):
+        self.batch_ops_per_second = batch_ops_per_second
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.base_url = base_url
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.lists = {}
+        self.members = {}
+        self.merge_fields = {}
+        self.segments = {}
+        self.batches = {}
+        self.batch_results = {}
+        self.queue_free_at = 0.0
+        self.calls = Counter()
+
+    # routing
+    def routes(self):
+        return (
+            ('GET', '/', self.get_root),
+            ('GET', '/batches', self.list_batches),
+            ('POST', '/batches', self.create_batch),
+            ('GET', '/batches/{batch_id}', self.get_batch),
+            ('GET', '/lists', self.list_lists),
+            ('POST', '/lists', self.create_list),
+            ('GET', '/lists/{list_id}', self.get_list),
+            ('PATCH', '/lists/{list_id}', self.update_list),
+            ('POST', '/lists/{list_id}', self.subscribe_members),
+            ('GET', '/lists/{list_id}/merge-fields', self.list_merge_fields),
+            ('POST', '/lists/{list_id}/merge-fields', self.create_merge_field),
+            ('PATCH', '/lists/{list_id}/merge-fields/{merge_id}',
+             self.update_merge_field),
+            ('GET', '/lists/{list_id}/members', self.list_members),
+            ('GET', '/lists/{list_id}/members/{subscriber_hash}', self.get_member),
+            ('PUT', '/lists/{list_id}/members/{subscriber_hash}', self.put_member),
+            ('PATCH', '/lists/{list_id}/members/{subscriber_hash}',
+             self.patch_member),
+            ('DELETE', '/lists/{list_id}/members/{subscriber_hash}',
+             self.delete_member),
+            ('POST', '/lists/{list_id}/members/{subscriber_hash}/tags',
+             self.post_member_tags),
+            ('GET', '/lists/{list_id}/segments', self.list_segments),
+            ('POST', '/lists/{list_id}/segments', self.create_segment),
+            ('POST', '/lists/{list_id}/segments/{segment_id}',
+             self.update_segment_members),
+        )
+
+    def compiled_routes(self):
+        """(method, template, regex, handler) for every route"""
+        if not hasattr(self, '_compiled_routes'):
+            self._compiled_routes = []
+            for method, template, handler in self.routes():
+                pattern = re.sub(r'\\{(\w+)\\}', r'(?P<\1>[^/]+)',
+                                 re.escape(template))
+                self._compiled_routes.append(
+                    (method, template, re.compile('^' + pattern + '$'), handler))
+        return self._compiled_routes
+
+    def match(self, method, path):
+        for route_method, template, pattern, handler in self.compiled_routes():
+            match = pattern.match(path)
+            if route_method == method and match:
+                return template, handler, match.groupdict()
+        raise ApiError(404, 'Resource Not Found',
+                       'The requested resource could not be found.')
+
+    def endpoint_name(self, method, path):
+        """Normalize the path into an endpoint name for the stats"""
+        try:
+            template = self.match(method, path)[0]
+        except ApiError:
+            template = path
+        return '{} {}'.format(method, template)
+
+    def dispatch(self, method, path, query, body):
+        """Return (status_code, response_body) for one request or operation"""
+        template, handler, path_params = self.match(method, path)
+        if (method != 'GET' and handler != self.create_batch and self.error_rate
+                and self.random.random() < self.error_rate):
+            raise ApiError(400, 'Invalid Resource',
+                           'Randomly failed by the fake server.')
+        return handler(query=query, body=body, **path_params)
+
+    # root
+    def get_root(self, query, body):
+        return 200, {'account_id': 'fake', 'account_name': 'Fake mailchimp'}
+
+    # batches
+    def _batch_status(self, batch):
+        now = time.time()
+        if now >= batch['finish_at']:
+            finished, status = batch['total_operations'], 'finished'
+            completed_at = _iso(batch['finish_at'])
+        elif now >= batch['start_at']:
+            finished = int((now - batch['start_at']) * self.batch_ops_per_second)
+            finished = min(finished, batch['total_operations'])
+            status, completed_at = 'started', ''
+        else:
+            finished, status, completed_at = 0, 'pending', ''
+        errored = min(batch['errored'], finished)
+        return {'id': batch['id'],
+                'status': status,
+                'total_operations': batch['total_operations'],
+                'finished_operations': finished,
+                'errored_operations': errored,
+                'submitted_at': batch['submitted_at'],
+                'completed_at': completed_at,
+                'response_body_url': (
+                    '{}/_batch_results/{}.tar.gz'.format(self.base_url, batch['id'])
+                    if status == 'finished' else ''),
+                '_links': []}
+
+    def create_batch(self, query, body):
+        operations = body.get('operations')
+        if not isinstance(operations, list):
+            raise ApiError(400, 'Invalid Resource', 'Missing operations.')
+        results = []
+        errored = 0
+        with self.lock:
+            for op in operations:
+                op_query = op.get('params') or {}
+                op_body = json.loads(op['body']) if op.get('body') else {}
+                try:
+                    status, response = self.dispatch(
+                        op['method'], op['path'].rstrip('/') or '/', op_query,
+                        op_body)
+                except ApiError as err:
+                    status, response = err.status, err.body()
+                    errored += 1
+                results.append({'status_code': status,
+                                'operation_id': op.get('operation_id'),
+                                'response': json.dumps(response)})
+            now = time.time()
+            start_at = max(now, self.queue_free_at)
+            finish_at = start_at + len(operations) / float(self.batch_ops_per_second)
+            self.queue_free_at = finish_at
+            batch_id = uuid.uuid4().hex[:10]
+            batch = {'id': batch_id,
+                     'total_operations': len(operations),
+                     'errored': errored,
+                     'submitted_at': _iso(now),
+                     'start_at': start_at,
+                     'finish_at': finish_at}
+            self.batches[batch_id] = batch
+            self.batch_results[batch_id] = results
+        return 200, self._batch_status(batch)
+
+    def get_batch(self, query, body, batch_id):
+        try:
+            batch = self.batches[batch_id]
+        except KeyError:
+            raise ApiError(404, 'Resource Not Found')
+        return 200, self._batch_status(batch)
+
+    def list_batches(self, query, body):
+        batches = [self._batch_status(b) for b in self.batches.values()]
+        return 200, self._page('batches', batches, query)
+
+    def batch_results_archive(self, batch_id):
+        """The gzipped tarball served from `response_body_url`"""
+        results = self.batch_results[batch_id]
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+            payload = json.dumps(results).encode('utf-8')
+            info = tarfile.TarInfo('{}.json'.format(batch_id))
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+        return buffer.getvalue()
+
+    # lists
+    def _page(self, key, items, query):
+        count = int(query.get('count', 10))
+        offset = int(query.get('offset', 0))
+        return {key: items[offset:offset + count], 'total_items': len(items)}
+
+    def create_list(self, query, body):
+        if 'name' not in body:
+            raise ApiError(400, 'Invalid Resource', 'name is required')
+        list_id = uuid.uuid4().hex[:10]
+        one_list = dict(body, id=list_id,
+                        date_created=_now_iso(),
+                        stats={'member_count': 0})
+        with self.lock:
+            self.lists[list_id] = one_list
+            self.merge_fields[list_id] = []
+            self.segments[list_id] = []
+        return 200, one_list
+
+    def _get_list(self, list_id):
+        try:
+            return self.lists[list_id]
+        except KeyError:
+            raise ApiError(404, 'Resource Not Found',
+                           'The requested resource could not be found.')
+
+    def get_list(self, query, body, list_id):
+        return 200, self._get_list(list_id)
+
+    def list_lists(self, query, body):
+        return 200, self._page('lists', list(self.lists.values()), query)
+
+    def update_list(self, query, body, list_id):
+        one_list = self._get_list(list_id)
+        with self.lock:
+            for key, value in body.items():
+                if isinstance(value, dict) and isinstance(one_list.get(key), dict):
+                    one_list[key].update(value)
+                else:
+                    one_list[key] = value
+        return 200, one_list
+
+    def subscribe_members(self, query, body, list_id):
+        """Batch subscribe: add (or update) up to 500 members at once"""
+        self._get_list(list_id)
+        members = body.get('members')
+        if not isinstance(members, list) or len(members) > 500:
+            raise ApiError(400, 'Invalid Resource',
+                           'members must be a list of at most 500 members.')
+        created, updated, errors = [], [], []
+        with self.lock:
+            for data in members:
+                email = data.get('email_address') or ''
+                if '@' not in email:
+                    errors.append({'email_address': email,
+                                   'error': 'Invalid email address',
+                                   'error_code': 'ERROR_GENERIC'})
+                    continue
+                subscriber_hash = md5(email.lower().encode('utf-8')).hexdigest()
+                key = (list_id, subscriber_hash)
+                member = self.members.get(key)
+                if member is None:
+                    member = self.members[key] = {
+                        'status': data.get('status_if_new', data.get('status'))}
+                    done = created
+                elif body.get('update_existing'):
+                    if 'status' in data:
+                        member['status'] = data['status']
+                    done = updated
+                else:
+                    errors.append({'email_address': email,
+                                   'error': '{} is already a list member'.format(email),
+                                   'error_code': 'ERROR_CONTACT_EXISTS'})
+                    continue
+                for field, value in data.items():
+                    if field not in ('status', 'status_if_new'):
+                        member[field] = value
+                member['last_changed'] = _now_iso()
+                done.append(self._member_response(list_id, subscriber_hash, member))
+        return 200, {'new_members': created,
+                     'updated_members': updated,
+                     'errors': errors,
+                     'total_created': len(created),
+                     'total_updated': len(updated),
+                     'error_count': len(errors)}
+
+    # merge fields
+    def list_merge_fields(self, query, body, list_id):
+        self._get_list(list_id)
+        return 200, self._page('merge_fields', self.merge_fields[list_id], query)
+
+    def create_merge_field(self, query, body, list_id):
+        self._get_list(list_id)
+        with self.lock:
+            fields = self.merge_fields[list_id]
+            tag = body.get('tag') or 'MERGE{}'.format(len(fields) + 1)
+            if any(f['tag'] == tag for f in fields):
+                raise ApiError(400, 'Invalid Resource',
+                               'A Merge Field with the tag "{}" already exists '
+                               'for this list.'.format(tag))
+            field = dict(body, tag=tag, merge_id=len(fields) + 1, list_id=list_id)
+            fields.append(field)
+        return 200, field
+
+    def update_merge_field(self, query, body, list_id, merge_id):
+        self._get_list(list_id)
+        for field in self.merge_fields[list_id]:
+            if str(field['merge_id']) == str(merge_id):
+                with self.lock:
+                    field.update(body)
+                return 200, field
+        raise ApiError(404, 'Resource Not Found')
+
+    # members
+    def _member_response(self, list_id, subscriber_hash, member):
+        return {'id': subscriber_hash,
+                'list_id': list_id,
+                'email_address': member.get('email_address'),
+                'status': member.get('status'),
+                'last_changed': member.get('last_changed')}
+
+    def list_members(self, query, body, list_id):
+        self._get_list(list_id)
+        members = [dict(member, id=subscriber_hash, list_id=list_id)
+                   for (l_id, subscriber_hash), member in self.members.items()
+                   if l_id == list_id]
+        return 200, self._page('members', members, query)
+
+    def get_member(self, query, body, list_id, subscriber_hash):
+        try:
+            member = self.members[(list_id, subscriber_hash)]
+        except KeyError:
+            raise ApiError(404, 'Resource Not Found')
+        return 200, dict(member, id=subscriber_hash, list_id=list_id)
+
+    def put_member(self, query, body, list_id, subscriber_hash):
+        self._get_list(list_id)
+        key = (list_id, subscriber_hash)
+        with self.lock:
+            member = self.members.get(key)
+            if member is None:
+                if 'status_if_new' not in body and 'status' not in body:
+                    raise ApiError(400, 'Invalid Resource',
+                                   'status_if_new is required for new members')
+                member = {'status': body.get('status_if_new', body.get('status'))}
+                self.members[key] = member
+            elif 'status' in body:
+                member['status'] = body['status']
+            for field, value in body.items():
+                if field not in ('status', 'status_if_new'):
+                    member[field] = value
+            member['last_changed'] = _now_iso()
+        return 200, self._member_response(list_id, subscriber_hash, member)
+
+    def patch_member(self, query, body, list_id, subscriber_hash):
+        key = (list_id, subscriber_hash)
+        with self.lock:
+            try:
+                member = self.members[key]
+            except KeyError:
+                raise ApiError(404, 'Resource Not Found')
+            member.update(body)
+            member['last_changed'] = _now_iso()
+        return 200, self._member_response(list_id, subscriber_hash, member)
+
+    def delete_member(self, query, body, list_id, subscriber_hash):
+        with self.lock:
+            try:
+                del self.members[(list_id, subscriber_hash)]
+            except KeyError:
+                raise ApiError(404, 'Resource Not Found')
+        return 204, None
+
+    def post_member_tags(self, query, body, list_id, subscriber_hash):
+        with self.lock:
+            try:
+                member = self.members[(list_id, subscriber_hash)]
+            except KeyError:
+                raise ApiError(404, 'Resource Not Found')
+            tags = set(member.get('tags', ()))
+            for tag in body.get('tags', ()):
+                if tag.get('status') == 'inactive':
+                    tags.discard(tag['name'])
+                else:
+                    tags.add(tag['name'])
+            member['tags'] = sorted(tags)
+        return 204, None
+
+
+    # segments (tags are static segments)
+    def list_segments(self, query, body, list_id):
+        self._get_list(list_id)
+        segments = [s for s in self.segments[list_id]
+                    if query.get('type') in (None, s['type'])]
+        return 200, self._page('segments', segments, query)
+
+    def create_segment(self, query, body, list_id):
+        self._get_list(list_id)
+        if 'name' not in body:
+            raise ApiError(400, 'Invalid Resource', 'name is required')
+        with self.lock:
+            segments = self.segments[list_id]
+            segment = {'id': len(segments) + 1,
+                       'name': body['name'],
+                       'type': 'static' if 'static_segment' in body else 'saved',
+                       'list_id': list_id,
+                       'member_count': 0,
+                       'created_at': _now_iso()}
+            segments.append(segment)
+            for email in body.get('static_segment') or ():
+                if self._tag_member(list_id, email, segment['name'], True):
+                    segment['member_count'] += 1
+        return 200, segment
+
+    def _tag_member(self, list_id, email, name, active):
+        """Add or remove the tag of a member
+
+        Returns:
+            None if not a list member, else whether the tags changed
+        """
+        subscriber_hash = md5(email.lower().encode('utf-8')).hexdigest()
+        member = self.members.get((list_id, subscriber_hash))
+        if member is None:
+            return None
+        tags = set(member.get('tags', ()))
+        if (name in tags) == active:
+            return False
+        if active:
+            tags.add(name)
+        else:
+            tags.discard(name)
+        member['tags'] = sorted(tags)
+        return True
+
+    def update_segment_members(self, query, body, list_id, segment_id):
+        """Batch add/remove up to 500 members to/from a static segment"""
+        self._get_list(list_id)
+        for segment in self.segments[list_id]:
+            if str(segment['id']) == str(segment_id):
+                break
+        else:
+            raise ApiError(404, 'Resource Not Found')
+        response = {'members_added': [], 'members_removed': [], 'errors': []}
+        with self.lock:
+            for key, done, active in (('members_to_add', 'members_added', True),
+                                      ('members_to_remove', 'members_removed', False)):
+                emails = body.get(key) or []
+                if len(emails) > 500:
+                    raise ApiError(400, 'Invalid Resource',
+                                   '{} accepts at most 500 emails.'.format(key))
+                missing = []
+                for email in emails:
+                    changed = self._tag_member(list_id, email, segment['name'], active)
+                    if changed is None:
+                        missing.append(email)
+                        continue
+                    response[done].append({'email_address': email})
+                    if changed:
+                        segment['member_count'] += 1 if active else -1
+                if missing:
+                    response['errors'].append(
+                        {'email_addresses': missing,
+                         'error': 'Email addresses are not subscribed to the list'})
+        response.update(total_added=len(response['members_added']),
+                        total_removed=len(response['members_removed']),
+                        error_count=sum(len(e['email_addresses'])
+                                        for e in response['errors']))
+        return 200, response
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _reply(self, status, body, content_type='application/json', headers=None):
+        if body is None:
+            payload = b''
+        elif isinstance(body, bytes):
+            payload = body
+        else:
+            payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method):
+        state = self.server.state
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+
+        if parsed.path == '/_stats':
+            return self._reply(200, dict(state.calls))
+        if parsed.path == '/_reset':
+            state.calls.clear()
+            return self._reply(200, {})
+        if parsed.path == '/_configure':
+            settings = json.loads(raw.decode('utf-8'))
+            self.server.latency = settings.pop('latency', self.server.latency)
+            for key, value in settings.items():
+                setattr(state, key, value)
+            return self._reply(200, {})
+        if parsed.path.startswith('/_batch_results/'):
+            batch_id = parsed.path.rsplit('/', 1)[-1].replace('.tar.gz', '')
+            return self._reply(200, state.batch_results_archive(batch_id),
+                               content_type='application/x-gzip')
+        if not parsed.path.startswith(API_PREFIX):
+            return self._reply(404, ApiError(404, 'Resource Not Found').body())
+
+        path = parsed.path[len(API_PREFIX):].rstrip('/') or '/'
+        with state.lock:
+            state.calls[state.endpoint_name(method, path)] += 1
+            state.calls['bytes_received'] += len(raw)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if state.throttle_rate and state.random.random() < state.throttle_rate:
+            with state.lock:
+                state.calls['throttled'] += 1
+            return self._reply(
+                429, ApiError(429, 'Too Many Requests',
+                              'You have exceeded the limit of 10 simultaneous '
+                              'connections.').body(),
+                content_type='application/problem+json',
+                headers={'Retry-After': '1'})
+        try:
+            body = json.loads(raw.decode('utf-8')) if raw else {}
+            status, response = state.dispatch(method, path, query, body)
+        except ApiError as err:
+            return self._reply(err.status, err.body(),
+                               content_type='application/problem+json')
+        except (ValueError, KeyError) as err:
+            return self._reply(400, ApiError(400, 'Bad Request', str(err)).body())
+        return self._reply(status, response)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(host, port, latency, state_kwargs, ready=None):
+    """Run the fake server in the current process (blocking)"""
+    httpd = _ThreadingHTTPServer((host, port), _Handler)
+    httpd.latency = latency
+    httpd.state = MailchimpState(
+        base_url='http://{}:{}'.format(host, httpd.server_address[1]),
+        **state_kwargs)
+    if ready is not None:
+        ready.put(httpd.server_address[1])
+    httpd.serve_forever()
+
+
+class FakeMailchimp(object):
+    """Run the fake API in a child process so it doesn't skew the measurements
+
+    Args:
+        host (str): interface to bind to
+        port (int): 0 picks a free port
+        latency (float): seconds added to every request
+        batch_ops_per_second (float): how fast the batches are processed
+        error_rate (float): probability that an operation fails with 400
+        throttle_rate (float): probability that a request fails with 429
+        seed (int): seed for the random errors
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 batch_ops_per_second=1000, error_rate=0.0, throttle_rate=0.0,
+                 seed=42):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.state_kwargs = {'batch_ops_per_second': batch_ops_per_second,
+                             'error_rate': error_rate,
+                             'throttle_rate': throttle_rate,
+                             'seed': seed}
+        self._process = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    @property
+    def api_url(self):
+        return self.url + API_PREFIX + '/'
+
+    def start(self, faults=True):
+        """Start the server
+
+        Args:
+            faults (bool): if False, the server starts without latency and
+                errors; switch them on with `enable_faults()` once the
+                benchmark setup is done.
+        """
+        ready = multiprocessing.Queue()
+        if faults:
+            latency, state_kwargs = self.latency, self.state_kwargs
+        else:
+            latency = 0.0
+            state_kwargs = dict(self.state_kwargs, error_rate=0.0, throttle_rate=0.0)
+        self._process = multiprocessing.Process(
+            target=serve,
+            args=(self.host, self.port, latency, state_kwargs, ready),
+            daemon=True)
+        self._process.start()
+        self.port = ready.get(timeout=10)
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def client(self, apikey='fakeapikey-us0'):
+        """A mailchimp3 client talking to this server"""
+        client = MailChimp(mc_user='', mc_secret=apikey)
+        client.base_url = self.api_url
+        return client
+
+    def stats(self):
+        client = self.client()
+        return client._get(url=self.url + '/_stats')
+
+    def reset_stats(self):
+        client = self.client()
+        return client._post(url=self.url + '/_reset')
+
+    def enable_faults(self):
+        """Apply the configured latency and error rates"""
+        client = self.client()
+        return client._post(url=self.url + '/_configure',
+                            data={'latency': self.latency,
+                                  'error_rate': self.state_kwargs['error_rate'],
+                                  'throttle_rate': self.state_kwargs['throttle_rate']})
+
@@ -0,0 +1,314 @@
+"""Micro-benchmarks of the per-row hot path
+
+Each stage of the row pipeline (csv parsing, cleaning, nesting, hashing and
+building the batch operations) is timed separately on synthetic rows. The
+row shapes cover the cases that are slow in production: wide merge field
+sets, many `interests__` columns and tags json.
+
+For every (shape, stage) the best of `--repeat` runs is reported as
+nanoseconds per row, together with the bytes allocated per row (the
+tracemalloc peak divided by the number of rows). Next to every stage a fixed
+pure python workload is timed as well; the comparison with the baseline uses
+the stage timings relative to its median, which filters out most of the noise
+of shared CI runners. The allocations don't depend on the machine and are
+compared as they are.
+
+Usage:
+    python3 -m benchmarks.micro                   # compare with the baseline
+    python3 -m benchmarks.micro --save-baseline   # overwrite the baseline
+
+The comparison exits with status 1 if any stage got slower than
+`--tolerance` times the baseline or allocates more than
+`--alloc-tolerance` times the baseline. The timings are machine dependent, save a
+fresh baseline on the machine you compare on.
+"""
+import argparse
+import copy
+import csv
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mcwriter.cleaning import (_hash_email,
+                               clean_and_validate_members_data,
+                               clean_and_validate_members_columns,
+                               clean_and_validate_members_delete_data,
+                               rows_to_columns)
+from mcwriter.records import MemberRecord
+from mcwriter.rowsource import open_table
+from mcwriter.utils import (serialize_dotted_path_dict,
+                            serialize_add_member_tags_input,
+                            prepare_batch_data_add_members,
+                            prepare_batch_data_update_members,
+                            prepare_batch_data_delete_members,
+                            prepare_batch_data_add_member_tags)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'micro_baseline.json')
+
+
+def generate_member_rows(rows, merge_fields=2, interests=2):
+    """Rows as they come from `csv.DictReader` for add_members.csv"""
+    generated = []
+    for i in range(rows):
+        row = {'email_address': 'Member.{}@Example.com'.format(i),
+               'list_id': 'abc123def{}'.format(i % 3),
+               'status_if_new': 'subscribed',
+               'status': 'subscribed' if i % 5 else 'unsubscribed',
+               'vip': 'true' if i % 7 == 0 else 'false',
+               'email_type': 'false',
+               'language': 'en'}
+        for m in range(merge_fields):
+            row['merge_fields__FIELD{}'.format(m)] = 'value {} {}'.format(i, m)
+        for n in range(interests):
+            row['interests__{:010x}'.format(n)] = 'true' if (i + n) % 2 else 'false'
+        generated.append(row)
+    return generated
+
+
+def generate_member_tags_rows(rows, tags=5):
+    """Rows as they come from `csv.DictReader` for add_member_tags.csv"""
+    return [{'list_id': 'abc123def0',
+             'email_address': 'member.{}@example.com'.format(i),
+             'tags': json.dumps([{'name': 'tag-{}'.format(t),
+                                  'status': 'active' if (i + t) % 3 else 'inactive'}
+                                 for t in range(tags)])}
+            for i in range(rows)]
+
+
+def _to_csv(rows, tmpdir, name):
+    """Write the rows into `tmpdir`/`name`, return its path
+
+    All the values are quoted, as in the tables Keboola exports.
+    """
+    path = os.path.join(tmpdir, name)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, list(rows[0]), quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+def _read_csv_dicts(path):
+    with open_table(path) as source:
+        return [row for batch in source.dicts(500) for row in batch]
+
+
+def _read_csv_batches(path):
+    with open_table(path) as source:
+        return [row for batch in source.batches(500) for row in batch]
+
+
+def _read_csv_dictreader(path):
+    # the reference the row sources should beat
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def _serialize_member_tags(path):
+    return [line for chunk in serialize_add_member_tags_input(path)
+            for line in chunk]
+
+
+def member_stages(rows, tmpdir):
+    """(stage name, setup, run) triples; setup builds fresh inputs for run
+
+    The csv file of the rows is written into `tmpdir`.
+    """
+    path = _to_csv(rows, tmpdir, 'add_members.csv')
+    cleaned = [clean_and_validate_members_data(dict(r)) for r in rows]
+    to_delete = [{'email_address': r['email_address'], 'list_id': r['list_id']}
+                 for r in rows]
+    emails = [r['email_address'] for r in rows]
+    header = tuple(rows[0])
+    tuples = [tuple(r.values()) for r in rows]
+
+    def records():
+        return [MemberRecord(c) for c in cleaned]
+
+    return (
+        ('read_csv_dicts', lambda: path, _read_csv_dicts),
+        ('read_csv_batches', lambda: path, _read_csv_batches),
+        ('read_csv_dictreader', lambda: path, _read_csv_dictreader),
+        ('hash_email', lambda: emails,
+         lambda data: [_hash_email(e) for e in data]),
+        ('clean_members', lambda: [dict(r) for r in rows],
+         lambda data: [clean_and_validate_members_data(r) for r in data]),
+        ('clean_members_columns', lambda: tuples,
+         lambda data: clean_and_validate_members_columns(
+             rows_to_columns(header, data), 'add_or_update')),
+        ('clean_members_delete', lambda: [dict(r) for r in to_delete],
+         lambda data: [clean_and_validate_members_delete_data(r) for r in data]),
+        ('serialize_dotted_path_dict', lambda: cleaned,
+         lambda data: [serialize_dotted_path_dict(c) for c in data]),
+        ('member_record', lambda: cleaned,
+         lambda data: [MemberRecord(c) for c in data]),
+        ('prepare_batch_data_add_members', records,
+         prepare_batch_data_add_members),
+        ('prepare_batch_data_update_members', records,
+         prepare_batch_data_update_members),
+        ('prepare_batch_data_delete_members', records,
+         prepare_batch_data_delete_members),
+    )
+
+
+def member_tags_stages(rows, tmpdir):
+    path = _to_csv(rows, tmpdir, 'add_member_tags.csv')
+    parsed = _serialize_member_tags(path)
+    return (
+        ('serialize_add_member_tags_input', lambda: path, _serialize_member_tags),
+        ('prepare_batch_data_add_member_tags', lambda: copy.deepcopy(parsed),
+         prepare_batch_data_add_member_tags),
+    )
+
+
+SHAPES = {
+    'narrow': lambda n, tmpdir: member_stages(generate_member_rows(n), tmpdir),
+    'wide_merge_fields': lambda n, tmpdir: member_stages(
+        generate_member_rows(n, merge_fields=60), tmpdir),
+    'many_interests': lambda n, tmpdir: member_stages(
+        generate_member_rows(n, merge_fields=2, interests=40), tmpdir),
+    'member_tags': lambda n, tmpdir: member_tags_stages(
+        generate_member_tags_rows(n), tmpdir),
+}
+
+
+def _calibration_workload():
+    row = {'email_address': 'Calibration@Example.com', 'vip': 'true'}
+    for i in range(2000):
+        copied = dict(row)
+        copied['vip'] = copied['vip'].lower() == 'true'
+        copied['n'] = str(i)
+
+
+def _best_time(setup, run, repeat):
+    best = None
+    for _ in range(repeat):
+        data = setup()
+        # same as timeit, keep the collector from skewing the timings
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run(data)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(setup, run, rows, repeat):
+    """Return (ns per row, allocated bytes per row, calibration ns)"""
+    calibration = _best_time(lambda: None, lambda _: _calibration_workload(),
+                             repeat)
+    best = _best_time(setup, run, repeat)
+    data = setup()
+    tracemalloc.start()
+    run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best * 1e9 / rows, peak / float(rows), calibration * 1e9
+
+
+def run_benchmarks(rows, repeat, shapes=None):
+    results = {}
+    for shape in shapes or sorted(SHAPES):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for stage, setup, run in SHAPES[shape](rows, tmpdir):
+                ns_per_row, bytes_per_row, calibration_ns = measure(
+                    setup, run, rows, repeat)
+                results['{}/{}'.format(shape, stage)] = {
+                    'ns_per_row': round(ns_per_row, 1),
+                    'bytes_per_row': round(bytes_per_row, 1),
+                    'calibration_ns': round(calibration_ns, 1)}
+    return results
+
+
+def _median_calibration(results):
+    timings = sorted(r['calibration_ns'] for r in results.values())
+    return timings[len(timings) // 2] if timings else None
+
+
+def compare(results, baseline, tolerance, alloc_tolerance=None):
+    """Print the results next to the baseline, return the regressed stages
+
+    A stage regressed if its calibrated timing is more than `tolerance`
+    times the baseline, or its allocations more than `alloc_tolerance`
+    times (the same as `tolerance` by default).
+    """
+    if alloc_tolerance is None:
+        alloc_tolerance = tolerance
+    regressions = []
+    print('{:<60} {:>12} {:>12} {:>8} {:>12} {:>8}'.format(
+        'stage', 'ns/row', 'baseline', 'ratio', 'bytes/row', 'ratio'))
+    now_calibration = _median_calibration(results)
+    base_calibration = _median_calibration(baseline)
+    for name, result in sorted(results.items()):
+        base = baseline.get(name, {}).get('ns_per_row')
+        ratio = None
+        if base:
+            ratio = ((result['ns_per_row'] / now_calibration)
+                     / (base / base_calibration))
+        base_bytes = baseline.get(name, {}).get('bytes_per_row')
+        alloc_ratio = result['bytes_per_row'] / base_bytes if base_bytes else None
+        flags = []
+        if ratio is not None and ratio > tolerance:
+            flags.append('REGRESSION')
+        if alloc_ratio is not None and alloc_ratio > alloc_tolerance:
+            flags.append('ALLOCATION REGRESSION')
+        if flags:
+            regressions.append(name)
+        print('{:<60} {:>12.1f} {:>12} {:>8} {:>12.1f} {:>8}{}'.format(
+            name, result['ns_per_row'],
+            '{:.1f}'.format(base) if base else '-',
+            '{:.2f}'.format(ratio) if ratio else '-',
+            result['bytes_per_row'],
+            '{:.2f}'.format(alloc_ratio) if alloc_ratio else '-',
+            ''.join(' ' + flag for flag in flags)))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                        help='run only these row shapes')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='max allowed ratio to the baseline')
+    parser.add_argument('--alloc-tolerance', type=float, default=1.5,
+                        help='max allowed ratio of the allocations to the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmarks(args.rows, args.repeat, args.shape)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        compare(results, results, args.tolerance, args.alloc_tolerance)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    regressions = compare(results, baseline, args.tolerance, args.alloc_tolerance)
+    if regressions:
+        print('{} stage(s) slower than {}x or allocating more than {}x the '
+              'baseline'.format(len(regressions), args.tolerance,
+                                args.alloc_tolerance))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
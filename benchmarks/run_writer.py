@@ -0,0 +1,222 @@
+"""End-to-end throughput benchmark of `run_writer` against the fake API
+
+For every requested input size, an `add_members.csv` (or `update_members.csv`,
+`delete_members.csv`) is generated, a fresh fake mailchimp server is started
+and `run_writer` is run in a child process. Reported per run:
+
+- wall time and rows/s
+- the API calls per endpoint (as seen by the server) and their total
+- peak RSS of the writer process
+
+Usage:
+    python3 -m benchmarks.run_writer --rows 10000 100000 1000000 \\
+        --latency 0.05 --batch-ops-per-second 2000 --error-rate 0.01 \\
+        --set BATCH_DELAY=0 --output bench.json
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from hashlib import md5
+
+from mailchimp3 import MailChimp
+from mcwriter import writer
+from mcwriter.utils import _verify_credentials
+from .fake_mailchimp import FakeMailchimp
+
+TABLES = {'add': writer.FILE_ADD_MEMBERS,
+          'update': writer.FILE_UPDATE_MEMBERS,
+          'delete': writer.FILE_DELETE_MEMBERS}
+OUTPUT_PATHS = ('PATH_OUT_BATCHES_ADD', 'PATH_OUT_BATCHES_UPDATE',
+                'PATH_OUT_BATCHES_DELETE')
+
+
+def generate_members_csv(path, rows, list_ids, action='add'):
+    """Write `rows` synthetic members spread over `list_ids`"""
+    if action == 'delete':
+        header = ['list_id', 'email_address']
+    else:
+        header = ['list_id', 'email_address', 'status_if_new', 'status', 'vip',
+                  'merge_fields__FNAME', 'merge_fields__LNAME',
+                  'interests__abc123', 'interests__def456']
+    with open(path, 'w') as f:
+        out = csv.writer(f)
+        out.writerow(header)
+        for i in range(rows):
+            list_id = list_ids[i % len(list_ids)]
+            email = 'member{}@example.com'.format(i)
+            if action == 'delete':
+                out.writerow([list_id, email])
+            else:
+                out.writerow([list_id, email, 'subscribed', 'subscribed',
+                              'true' if i % 7 == 0 else 'false',
+                              'First{}'.format(i), 'Last{}'.format(i),
+                              'true', 'false'])
+    return path
+
+
+def seed_members(client, path, list_ids):
+    """Make the members from `path` exist on the server (for update/delete)"""
+    operations = []
+
+    def flush():
+        if operations:
+            client.batches.create(data={'operations': list(operations)})
+            del operations[:]
+    with open(path, 'r') as f:
+        for line in csv.DictReader(f):
+            sub_hash = md5(line['email_address'].lower().encode('utf-8')).hexdigest()
+            operations.append({
+                'method': 'PUT',
+                'path': '/lists/{}/members/{}'.format(line['list_id'], sub_hash),
+                'body': json.dumps({'email_address': line['email_address'],
+                                    'status_if_new': 'subscribed'})})
+            if len(operations) >= 5000:
+                flush()
+    flush()
+
+
+def _run_writer_in_child(api_url, datadir, tables, overrides, results):
+    """Child process entrypoint, reports back through the `results` queue"""
+    logging.basicConfig(level=logging.WARNING)
+    for name, value in overrides.items():
+        setattr(writer, name, value)
+    for name in OUTPUT_PATHS:
+        setattr(writer, name, os.path.join(datadir, 'out', 'tables',
+                                           os.path.basename(getattr(writer, name))))
+    client = MailChimp(mc_user='', mc_secret='fakeapikey-us0')
+    client.base_url = api_url
+    start = time.time()
+    error = None
+    try:
+        _verify_credentials(client)
+        writer.run_writer(client, {}, tables, datadir=datadir)
+    except Exception as err:
+        error = '{}: {}'.format(type(err).__name__, err)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({'elapsed': elapsed, 'peak_rss_mb': peak_rss_kb / 1024.0,
+                 'error': error})
+
+
+def run_one(rows, args):
+    server = FakeMailchimp(latency=args.latency,
+                           batch_ops_per_second=args.batch_ops_per_second,
+                           error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate,
+                           seed=args.seed)
+    server.start(faults=False)
+    try:
+        return _run_one(server, rows, args)
+    finally:
+        server.stop()
+
+
+def _run_one(server, rows, args):
+    with tempfile.TemporaryDirectory() as datadir:
+        os.makedirs(os.path.join(datadir, 'in', 'tables'))
+        os.makedirs(os.path.join(datadir, 'out', 'tables'))
+        client = server.client()
+        list_ids = [client.lists.create(data=_list_data(i))['id']
+                    for i in range(args.lists)]
+        path = os.path.join(datadir, 'in', 'tables', TABLES[args.action])
+        generate_members_csv(path, rows, list_ids, action=args.action)
+        if args.action != 'add':
+            seed_members(client, path, list_ids)
+        server.reset_stats()
+        server.enable_faults()
+
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(
+            target=_run_writer_in_child,
+            args=(server.api_url, datadir, [path], args.overrides, results))
+        child.start()
+        measured = results.get()
+        child.join()
+
+        calls = server.stats()
+        api_calls = {k: v for k, v in calls.items()
+                     if k not in ('bytes_received', 'throttled')}
+        measured.update({
+            'rows': rows,
+            'action': args.action,
+            'rows_per_second': rows / measured['elapsed'] if measured['elapsed'] else None,
+            'api_calls': api_calls,
+            'api_calls_total': sum(api_calls.values()),
+            'bytes_sent': calls.get('bytes_received', 0),
+            'throttled': calls.get('throttled', 0)})
+        return measured
+
+
+def _list_data(i):
+    return {'name': 'Benchmark list {}'.format(i),
+            'contact': {'company': 'Bench', 'address1': 'Street 1',
+                        'city': 'City', 'state': 'State', 'zip': '12345',
+                        'country': 'CZ'},
+            'permission_reminder': 'You signed up for benchmarks',
+            'campaign_defaults': {'from_name': 'Bench',
+                                  'from_email': 'bench@example.com',
+                                  'subject': 'Bench', 'language': 'en'},
+            'email_type_option': True}
+
+
+def _parse_override(value):
+    name, _, raw = value.partition('=')
+    if not hasattr(writer, name):
+        raise argparse.ArgumentTypeError(
+            "mcwriter.writer has no attribute '{}'".format(name))
+    return name, json.loads(raw)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--action', choices=sorted(TABLES), default='add')
+    parser.add_argument('--lists', type=int, default=1,
+                        help='number of lists the members are spread over')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every API request')
+    parser.add_argument('--batch-ops-per-second', type=float, default=1000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='probability of a request being rejected with 429')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--set', dest='overrides', action='append', default=[],
+                        type=_parse_override, metavar='NAME=JSON',
+                        help='override a mcwriter.writer constant, '
+                             'e.g. BATCH_DELAY=0')
+    parser.add_argument('--output', help='write the results as json here')
+    args = parser.parse_args(argv)
+    args.overrides = dict(args.overrides)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    all_results = []
+    print('{:>10} {:>10} {:>12} {:>10} {:>12} {}'.format(
+        'rows', 'seconds', 'rows/s', 'api calls', 'peak RSS MB', 'error'))
+    for rows in args.rows:
+        result = run_one(rows, args)
+        all_results.append(result)
+        print('{rows:>10} {elapsed:>10.1f} {rows_per_second:>12.0f} '
+              '{api_calls_total:>10} {peak_rss_mb:>12.1f} {error}'.format(
+                  **dict(result, error=result['error'] or '')))
+        sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': {k: v for k, v in vars(args).items()
+                                    if k != 'output'},
+                       'results': all_results}, f, indent=2)
+    return all_results
+
+
+if __name__ == '__main__':
+    main()
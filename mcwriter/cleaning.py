@@ -43,6 +43,14 @@ tags_mandatory_custom_fields = {'type': ["text", "number", "address", "phone",
                                          "dropdown", "birthday", "zip"]}
 tags_exclusive_fields = set(('list_id', 'custom_id'))
 
+# the addresses mailchimp accepts: an ascii local part and a (punycoded) domain
+_EMAIL_ATOM = r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+"
+EMAIL_PATTERN = re.compile(
+    r'^{atom}(?:\.{atom})*@(?:[A-Za-z0-9](?:[A-Za-z0-9-]{{0,61}}[A-Za-z0-9])?\.)+'
+    r'[A-Za-z0-9-]{{2,63}}$'.format(atom=_EMAIL_ATOM))
+MAX_EMAIL_LENGTH = 254
+INVALID_EMAIL = 'invalid email address'
+
 
 def clean_and_validate_lists_data(one_list):
     logging.debug("Cleaning one mailing list data")
@@ -57,10 +65,41 @@ def clean_and_validate_lists_data(one_list):
         one_list = cleaning_procedure(one_list, fields)
     return one_list
 
-def _hash_email(email):
+def normalize_email(email):
+    """Strip the address and encode its domain in lowercase ascii (punycode)
+
+    The local part keeps its case, mailchimp stores the address as sent but
+    hashes it lowercased (see `_hash_email`).
+    """
+    email = email.strip()
+    local, at, domain = email.rpartition('@')
+    if not at:
+        return email
+    domain = domain.lower()
+    try:
+        domain.encode('ascii')
+    except UnicodeEncodeError:
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            # left as is, fails the validation
+            pass
+    return local + at + domain
+
+
+def is_valid_email(email):
+    """Whether the (normalized) address is one mailchimp accepts"""
+    return len(email) <= MAX_EMAIL_LENGTH and EMAIL_PATTERN.match(email) is not None
+
+
+def _hash_normalized_email(email):
     return md5(bytes(email.lower(), 'utf-8')).hexdigest()
 
 
+def _hash_email(email):
+    return _hash_normalized_email(normalize_email(email))
+
+
 def clean_and_validate_members_update_data(line):
     """For cleaning """
     logging.debug("Cleaning members data")
@@ -73,7 +112,8 @@ def clean_and_validate_members_update_data(line):
             (_clean_optional_custom_fields, members_optional_custom_fields)):
         line = cleaning_procedure(line, fields)
     line = _clean_members_interests(line)
-    line['subscriber_hash'] = _hash_email(line['email_address'])
+    line['email_address'] = normalize_email(line['email_address'])
+    line['subscriber_hash'] = _hash_normalized_email(line['email_address'])
     return line
 
 def clean_and_validate_members_data(line):
@@ -88,10 +128,234 @@ def clean_and_validate_members_data(line):
 def clean_and_validate_members_delete_data(line):
     logging.debug("Cleaning members data for deleting")
     line = _clean_mandatory_str_fields(line, ['list_id', 'email_address'])
-    line['subscriber_hash'] = _hash_email(line['email_address'])
+    line['email_address'] = normalize_email(line['email_address'])
+    line['subscriber_hash'] = _hash_normalized_email(line['email_address'])
     return line
 
 
+def rows_to_columns(header, rows):
+    """Transpose a chunk of row tuples into {column: list of values}"""
+    if not rows:
+        return {name: [] for name in header}
+    return dict(zip(header, map(list, zip(*rows))))
+
+
+def clean_and_validate_members_columns(columns, action, offset=0, schemas=None,
+                                       quarantined=None):
+    """Clean a chunk of members column by column
+
+    Does what `clean_and_validate_members_data` (and the update and delete
+    variants) do for each row, but every check and conversion runs once per
+    column and mostly on its distinct values.
+
+    Args:
+        columns (dict): {column: list of values}, see `rows_to_columns` and
+            `RowSource.column_batches`
+            (modified in place)
+        action (str): 'add_or_update', 'update' or 'delete'
+        offset (int): index of the first row of the chunk in the table, the
+            errors report the index of the offending row
+        schemas (MergeFieldSchemas): if given, the merge fields are
+            validated against the merge fields of their lists
+        quarantined (list): the rows with an invalid email_address or merge
+            field are left out of the chunk and appended here as {'row',
+            'email_address', 'list_id', 'reason'} dicts
+
+    Returns:
+        (column names, list of cleaned row tuples), the rows end with their
+        subscriber_hash
+    """
+    logging.debug("Cleaning a chunk of members data by columns")
+    if action == 'delete':
+        _clean_mandatory_str_columns(columns, ['list_id', 'email_address'], offset)
+    else:
+        if members_exclusive_fields.issubset(columns):
+            raise CleaningError(
+                "It doesn't make sense to provide both {} in the rows."
+                "Check the documentation for usage.".format(members_exclusive_fields))
+        for field in members_optional_str_fields:
+            if field in columns and None in columns[field]:
+                columns[field] = ['' if value is None else value
+                                  for value in columns[field]]
+        interests_pattern = r'^interests__[0-9a-zA-Z]+$'
+        pattern = re.compile(interests_pattern)
+        interests = [f for f in columns if f.startswith('interests')]
+        for field in interests:
+            if not pattern.match(field):
+                raise CleaningError(
+                    "'interests' columns must have format '{}'"
+                    "not '{}'".format(interests_pattern, field))
+        for field in members_optional_bool_fields + tuple(interests):
+            if field in columns:
+                columns[field] = _bool_column(field, columns[field], offset)
+        _clean_mandatory_str_columns(columns, members_mandatory_str_fields, offset)
+        for field, expected in members_optional_custom_fields.items():
+            if field in columns:
+                _check_column_values(field, columns[field], expected, offset)
+        if action == 'add_or_update' and 'status_if_new' not in columns:
+            raise MissingFieldError(
+                "when adding members you must provide 'status_if_new' and optionally status field")
+    rejected = _clean_email_column(columns)
+    if schemas is not None and action != 'delete':
+        for index, reason in clean_members_merge_field_columns(columns, schemas).items():
+            rejected.setdefault(index, reason)
+    if rejected:
+        _remove_rows(columns, rejected, offset,
+                     quarantined if quarantined is not None else [])
+    columns['subscriber_hash'] = [_hash_normalized_email(email)
+                                  for email in columns['email_address']]
+    return tuple(columns), list(zip(*columns.values()))
+
+
+def _clean_email_column(columns):
+    """Normalize the email_address column, every distinct address once
+
+    Returns:
+        {row index: reason} of the rows with an invalid address
+    """
+    emails = columns['email_address']
+    normalized = {email: normalize_email(email) for email in set(emails)}
+    invalid = set(email for email, clean in normalized.items()
+                  if not is_valid_email(clean))
+    columns['email_address'] = [normalized[email] for email in emails]
+    if not invalid:
+        return {}
+    return {index: INVALID_EMAIL for index, email in enumerate(emails)
+            if email in invalid}
+
+
+def _remove_rows(columns, rejected, offset, quarantined):
+    """Move the {row index: reason} rows out of the columns into `quarantined`"""
+    for index in sorted(rejected):
+        quarantined.append({'row': offset + index,
+                            'email_address': columns['email_address'][index],
+                            'list_id': columns['list_id'][index],
+                            'reason': rejected[index]})
+    keep = [index for index in range(len(columns['email_address']))
+            if index not in rejected]
+    for field, column in columns.items():
+        columns[field] = [column[index] for index in keep]
+
+
+def merge_tag(column):
+    """The merge tag of a merge_fields__ column suffix, '*|FNAME|*' is 'FNAME'"""
+    if column.startswith('*|') and column.endswith('|*'):
+        return column[2:-2]
+    return column
+
+
+def _merge_field_tags(fields):
+    """(column, merge tag) of the merge_fields__TAG columns"""
+    prefix = 'merge_fields__'
+    return [(field, merge_tag(field[len(prefix):])) for field in fields
+            if field.startswith(prefix) and '__' not in field[len(prefix):]]
+
+
+def _invalid_merge_value(tag, err, value):
+    return "merge field {} {}, it is '{}'".format(tag, err, value)
+
+
+def clean_members_merge_field_columns(columns, schemas):
+    """Validate and coerce the merge field columns by the schemas of the lists
+
+    Every distinct (list, value) pair of a column is coerced once, the
+    invalid values are left as they are.
+
+    Returns:
+        {row index: reason} of the rows with an invalid merge field
+    """
+    list_ids = columns['list_id']
+    rejected = {}
+    for field, tag in _merge_field_tags(columns):
+        column = columns[field]
+        converted = {}
+        invalid = {}
+        for list_id, value in set(zip(list_ids, column)):
+            coerce = schemas.coercer(list_id, tag)
+            converted[(list_id, value)] = value
+            if coerce is None:
+                continue
+            try:
+                converted[(list_id, value)] = coerce(value)
+            except ValueError as err:
+                invalid[(list_id, value)] = _invalid_merge_value(tag, err, value)
+        pairs = list(zip(list_ids, column))
+        columns[field] = [converted[pair] for pair in pairs]
+        if invalid:
+            for index, pair in enumerate(pairs):
+                if pair in invalid:
+                    rejected.setdefault(index, invalid[pair])
+    return rejected
+
+
+def clean_members_merge_fields(line, schemas):
+    """Validate and coerce the merge fields of one flat member row
+
+    Returns:
+        the reason the row is invalid, None if it's valid
+    """
+    for field, tag in _merge_field_tags(list(line)):
+        coerce = schemas.coercer(line['list_id'], tag)
+        if coerce is not None:
+            try:
+                line[field] = coerce(line[field])
+            except ValueError as err:
+                return _invalid_merge_value(tag, err, line[field])
+    return None
+
+
+def _first_row(column, values):
+    """Index of the first row holding one of the values"""
+    return min(column.index(value) for value in values)
+
+
+def _clean_mandatory_str_columns(columns, fields, offset):
+    for field in fields:
+        if field not in columns:
+            raise MissingFieldError(
+                "Every entry must have str '{}' field.".format(field))
+        column = columns[field]
+        invalid = [t for t in set(map(type, column)) if t is not str]
+        if invalid:
+            index = min(i for i, value in enumerate(column)
+                        if not isinstance(value, str))
+            raise CleaningError(
+                "Field '{}' must be a string! It is '{}' in row {}".format(
+                    field, column[index], offset + index))
+
+
+def _bool_column(field, column, offset):
+    """Convert a column of 'true'/'false' strings to booleans (None is False)"""
+    converted = {None: False, True: True, False: False}
+    invalid = []
+    for value in set(column):
+        if value in converted:
+            continue
+        value_clean = value.lower()
+        if value_clean == 'true':
+            converted[value] = True
+        elif value_clean == 'false':
+            converted[value] = False
+        else:
+            invalid.append(value)
+    if invalid:
+        index = _first_row(column, invalid)
+        raise CleaningError(
+            "Can't convert optional '{}' field to boolean. "
+            "Make sure it is either 'true' or 'false',"
+            " not '{}' (row {})".format(field, column[index], offset + index))
+    return [converted[value] for value in column]
+
+
+def _check_column_values(field, column, expected, offset):
+    invalid = set(column).difference(expected)
+    if invalid:
+        index = _first_row(column, invalid)
+        raise CleaningError(
+            "The field {} must be one of {}. It is {} in row {}".format(
+                field, expected, column[index], offset + index))
+
+
 def clean_and_validate_tags_data(one_tag):
     logging.debug("Cleaning tags data")
     for cleaning_procedure, fields in (
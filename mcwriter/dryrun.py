@@ -0,0 +1,309 @@
+"""Plan a run without sending anything to mailchimp
+
+Every input table is streamed through the same cleaning and
+`prepare_batch_data_*` as in a real run, and the strategy of every chunk is
+picked by the same `EnginePlanner`, but instead of sending the requests, the
+plan counts them:
+
+- the operations per table and list
+- the serial requests, the batches and the bulk requests
+- at most how many times the batches would be polled
+- the projected duration, from the throttle settings of the writer and the
+  default latencies of `mcwriter.planner`
+
+Nothing is read from mailchimp either, so the plan is an upper bound where the
+real run skips what is already in sync (unchanged lists and merge fields,
+members in the snapshots) and it doesn't include the members `mirror_members`
+would delete.
+"""
+from collections import namedtuple, OrderedDict
+import logging
+from .metrics import Metrics
+from .planner import (EnginePlanner, SERIAL, BATCH, BULK, DEFAULT_REQUEST_LATENCY,
+                      DEFAULT_BULK_MEMBER_LATENCY, DEFAULT_BATCH_LATENCY)
+from .utils import (serialize_lists_input,
+                    serialize_members_input,
+                    serialize_add_member_tags_input,
+                    serialize_member_tags_by_tag,
+                    serialize_tags_input,
+                    prepare_batch_data_add_members,
+                    prepare_batch_data_add_member_tags,
+                    prepare_batch_data_delete_members,
+                    prepare_batch_data_update_members,
+                    prepare_batch_data_lists,
+                    prepare_batch_data_update_lists,
+                    prepare_batch_data_merge_fields,
+                    prepare_batch_subscribe_data,
+                    BatchesCsvWriter,
+                    MAX_POLLING_DELAY)
+from .webhook import FALLBACK_POLLING_DELAY
+
+PLAN_FIELDS = ('table', 'list_id', 'operations', 'serial_requests', 'batches',
+               'bulk_requests', 'polls', 'seconds')
+NEW_LIST_ID = 'new:{}' # stands for the id of a list created in the run
+UNKNOWN_LIST_ID = 'unknown:{}' # stands for a list not in the lists index
+
+Throttle = namedtuple('Throttle', ['batch_delay', 'sequential_delay',
+                                   'polling_delay', 'subscribe_workers',
+                                   'batch_threshold'])
+
+
+def estimate_polls(seconds, api_delay, notified=False):
+    """At most how many times a batch finishing in `seconds` is polled
+
+    Follows `wait_for_batches` without an ETA: the delay between the polls
+    grows linearly up to MAX_POLLING_DELAY. With the batch webhook, only the
+    fallback polls are made.
+    """
+    if notified:
+        return 1 + int(seconds // FALLBACK_POLLING_DELAY)
+    polls = 1
+    elapsed = 0.0
+    while elapsed < seconds:
+        elapsed += max(api_delay, min(api_delay * polls, MAX_POLLING_DELAY))
+        polls += 1
+    return polls
+
+
+class TablePlan(object):
+    """The requests one input table would make
+
+    The duration is simulated: sending the requests moves the clock
+    (`seconds`), the batches finish DEFAULT_BATCH_LATENCY after they were
+    submitted and the table is done when the last of them is.
+    """
+    def __init__(self, table, throttle, notified=False):
+        self.table = table
+        self.throttle = throttle
+        self.notified = notified
+        self.operations = OrderedDict()
+        self.serial_requests = 0
+        self.batches = 0
+        self.bulk_requests = 0
+        self.polls = 0
+        self.seconds = 0.0
+        self._submitted = []
+
+    def count(self, list_ids):
+        for list_id in list_ids:
+            self.operations[list_id] = self.operations.get(list_id, 0) + 1
+
+    def running(self):
+        """The number of batches still running at the current time"""
+        return sum(1 for submitted in self._submitted
+                   if submitted + DEFAULT_BATCH_LATENCY > self.seconds)
+
+    def serial(self, requests, delay=0):
+        self.serial_requests += requests
+        self.seconds += requests * (DEFAULT_REQUEST_LATENCY + delay)
+
+    def batch(self):
+        self.batches += 1
+        self.seconds += DEFAULT_REQUEST_LATENCY
+        self._submitted.append(self.seconds)
+        self.seconds += self.throttle.batch_delay
+
+    def bulk(self, requests, members, workers=1):
+        self.bulk_requests += requests
+        self.seconds += (requests * DEFAULT_REQUEST_LATENCY
+                         + members * DEFAULT_BULK_MEMBER_LATENCY) / workers
+
+    def finish(self):
+        """Wait for the submitted batches"""
+        wait = 0.0
+        for submitted in self._submitted:
+            remaining = max(0.0, submitted + DEFAULT_BATCH_LATENCY - self.seconds)
+            self.polls += estimate_polls(remaining, self.throttle.polling_delay,
+                                         self.notified)
+            wait = max(wait, remaining)
+        self._submitted = []
+        self.seconds += wait
+
+    def rows(self):
+        """The plan rows of every list and of the whole table"""
+        for list_id, operations in self.operations.items():
+            yield {'table': self.table, 'list_id': list_id, 'operations': operations}
+        yield {'table': self.table, 'list_id': '',
+               'operations': sum(self.operations.values()),
+               'serial_requests': self.serial_requests,
+               'batches': self.batches,
+               'bulk_requests': self.bulk_requests,
+               'polls': self.polls,
+               'seconds': round(self.seconds, 1)}
+
+
+class _PlannedLists(dict):
+    """{custom_list_id: list_id} of the plan, nothing is fetched
+
+    The lists created by the plan resolve to NEW_LIST_ID, the other ones
+    through the persisted index of `lists` (see `ListResolver.known`) or to
+    UNKNOWN_LIST_ID.
+    """
+    def __init__(self, lists=None):
+        super(_PlannedLists, self).__init__()
+        self.lists = lists
+
+    def __missing__(self, custom_list_id):
+        list_id = self.lists.known(custom_list_id) if self.lists is not None else None
+        return list_id or UNKNOWN_LIST_ID.format(custom_list_id)
+
+    def __bool__(self):
+        return True
+
+
+def plan_run(tables, throttle, engine='batches', tags_engine='batches',
+             notified=False, outpath=None, lists=None):
+    """Plan the tables of a run, in the order the writer processes them
+
+    Args:
+        tables (list): (action, path) tuples, the action is one of
+            'add_member_tags', 'update_lists', 'new_lists', 'add_tags',
+            'add_members', 'update_members', 'delete_members' and
+            'mirror_members'
+        throttle (Throttle): the delays and limits of the writer
+        engine, tags_engine (str): as the `engine` and `tags_engine`
+            parameters
+        notified (bool): whether the batch webhook is used
+        outpath (str): where the plan table is written
+        lists (ListResolver): resolves the custom_list_id of the existing
+            lists from its persisted index, without fetching anything
+
+    Returns:
+        the plan rows, the last one with the totals
+    """
+    created_lists = _PlannedLists(lists)
+    rows = []
+    total = OrderedDict((field, 0) for field in PLAN_FIELDS[2:])
+    for action, path in tables:
+        plan = TablePlan(action, throttle, notified)
+        if action == 'new_lists':
+            created_lists.update(_plan_new_lists(plan, path))
+        elif action == 'update_lists':
+            _plan_update_lists(plan, path)
+        elif action == 'add_tags':
+            _plan_tags(plan, path, created_lists)
+        elif action == 'add_member_tags':
+            _plan_member_tags(plan, path, tags_engine)
+        else:
+            _plan_members(plan, path, action, engine, created_lists)
+        plan.finish()
+        table_rows = list(plan.rows())
+        summary = table_rows[-1]
+        logging.info("Plan for %s: %s operations in %s lists, %s serial requests, "
+                     "%s batches, %s bulk requests, at most %s polls, about %ss",
+                     action, summary['operations'], len(plan.operations),
+                     summary['serial_requests'], summary['batches'],
+                     summary['bulk_requests'], summary['polls'], summary['seconds'])
+        for field in total:
+            total[field] += summary[field]
+        rows.extend(table_rows)
+    total['seconds'] = round(total['seconds'], 1)
+    rows.append(dict(total, table='total', list_id=''))
+    logging.info("The run would make %s API requests and take about %ss",
+                 total['serial_requests'] + total['batches']
+                 + total['bulk_requests'] + total['polls'], total['seconds'])
+    with BatchesCsvWriter(outpath, fieldnames=PLAN_FIELDS) as writer:
+        for row in rows:
+            writer.write(row)
+    return rows
+
+
+def _plan_new_lists(plan, path):
+    serialized_data = serialize_lists_input(path)
+    created_lists = {}
+    for data in serialized_data:
+        if data.get('custom_id'):
+            created_lists[data['custom_id']] = NEW_LIST_ID.format(data['custom_id'])
+    plan.count(NEW_LIST_ID.format(data.get('custom_id') or '')
+               for data in serialized_data)
+    if len(serialized_data) <= plan.throttle.batch_threshold:
+        plan.serial(len(serialized_data), delay=plan.throttle.sequential_delay)
+    else:
+        prepare_batch_data_lists(serialized_data)
+        plan.batch()
+        plan.finish()
+    return created_lists
+
+
+def _plan_update_lists(plan, path):
+    serialized_data = serialize_lists_input(path)
+    # fetching the current settings of the lists
+    plan.serial(1)
+    plan.count(data['list_id'] for data in serialized_data)
+    if len(serialized_data) <= plan.throttle.batch_threshold:
+        plan.serial(len(serialized_data), delay=plan.throttle.sequential_delay)
+    else:
+        prepare_batch_data_update_lists(serialized_data)
+        plan.batch()
+
+
+def _plan_tags(plan, path, created_lists):
+    tags_by_list = OrderedDict()
+    for tag in serialize_tags_input(path, created_lists=created_lists):
+        tags_by_list.setdefault(tag.pop('list_id'), []).append(tag)
+    operations = 0
+    for list_id, tags in tags_by_list.items():
+        # fetching the existing merge fields of the list
+        plan.serial(1)
+        plan.count([list_id] * len(tags))
+        operations += len(prepare_batch_data_merge_fields(list_id, tags, [])['operations'])
+    if operations <= plan.throttle.batch_threshold:
+        plan.serial(operations, delay=plan.throttle.sequential_delay)
+    else:
+        plan.batch()
+
+
+def _plan_member_tags(plan, path, tags_engine):
+    if tags_engine == 'segments':
+        looked_up = set()
+        for list_id, _, _, emails in serialize_member_tags_by_tag(path):
+            if list_id not in looked_up:
+                # fetching the tags (static segments) of the list
+                looked_up.add(list_id)
+                plan.serial(1)
+            plan.count([list_id] * len(emails))
+            plan.bulk(1, len(emails), plan.throttle.subscribe_workers)
+        return
+    for chunk in serialize_add_member_tags_input(path):
+        plan.count(line['list_id'] for line in chunk)
+        prepare_batch_data_add_member_tags(chunk)
+        plan.batch()
+
+
+_PREPARE = {'add_members': prepare_batch_data_add_members,
+            'mirror_members': prepare_batch_data_add_members,
+            'update_members': prepare_batch_data_update_members,
+            'delete_members': prepare_batch_data_delete_members}
+_ACTIONS = {'add_members': 'add_or_update',
+            'mirror_members': 'add_or_update',
+            'update_members': 'update',
+            'delete_members': 'delete'}
+
+
+def _plan_members(plan, path, table, engine, created_lists):
+    """Plan the members the same way `_send_chunks_and_wait_for_batches` sends them"""
+    workers = 1
+    if table == 'add_members' and engine == 'subscribe':
+        strategies = (BULK, )
+        workers = plan.throttle.subscribe_workers
+    elif table in ('delete_members', 'mirror_members'):
+        strategies = (BATCH, )
+    elif table == 'add_members' and engine == 'auto':
+        strategies = (SERIAL, BATCH, BULK)
+    else:
+        strategies = (SERIAL, BATCH)
+    # the planner of the plan shouldn't count into the metrics of the run
+    planner = EnginePlanner(strategies, batch_delay=plan.throttle.batch_delay,
+                            registry=Metrics())
+    for chunk in serialize_members_input(path, action=_ACTIONS[table],
+                                         created_lists=created_lists):
+        for strategy, members in planner.plan(chunk, running=plan.running()):
+            plan.count(member['list_id'] for member in members)
+            if strategy == SERIAL:
+                plan.serial(len(members))
+            elif strategy == BULK:
+                plan.bulk(len(prepare_batch_subscribe_data(members)), len(members),
+                          workers)
+            else:
+                _PREPARE[table](members)
+                plan.batch()
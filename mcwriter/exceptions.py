@@ -16,3 +16,6 @@ class CleaningError(UserError):
 
 class MissingFieldError(CleaningError):
     pass
+
+class BatchOperationError(UserError):
+    pass
@@ -0,0 +1,329 @@
+"""On-disk journal of ready to send batch operations
+
+Preparing the batches (parsing, cleaning, hashing, json encoding) and sending
+them are two separate phases:
+
+1. `compile_journal` streams the input tables through the cleaning and
+   `prepare_batch_data_*` and appends every batch payload as one json line to
+   the segments of the journal. Nothing is sent, so this can run ahead of
+   time or on another machine.
+2. `replay_journal` submits the payloads as fast as the batch slots allow,
+   waits for the batches and records the progress in the journal. A crashed
+   replay resumes where it stopped, without compiling anything again.
+
+The journal is a directory of append-only files:
+
+- `segment-00000.ndjson`, ...: one batch payload ({'operations': [...]}) per
+  line, at most SEGMENT_BATCHES lines per segment
+- `index.ndjson`: one line per batch ({'seq', 'table', 'segment', 'offset',
+  'length', 'operations'}), the last line ({'complete': true, 'batches',
+  'inputs'}) marks a fully compiled journal, `inputs` identifies the tables
+  it was compiled from (see `fingerprint`)
+- `progress.ndjson`: {'seq', 'batch_id'} when a batch was submitted,
+  {'seq', 'status'} when it finished
+"""
+from collections import OrderedDict
+from contextlib import ExitStack
+import json
+import logging
+import os
+from requests import HTTPError
+from .exceptions import ConfigError
+from .metrics import metrics
+from .planner import MAX_RUNNING_BATCHES
+from .rowsource import resolve_table
+from .utils import (serialize_members_input,
+                    serialize_add_member_tags_input,
+                    prepare_batch_data_add_members,
+                    prepare_batch_data_add_member_tags,
+                    prepare_batch_data_delete_members,
+                    prepare_batch_data_update_members,
+                    BatchesCsvWriter,
+                    BATCH_RESULT_FIELDS,
+                    wait_for_batch_to_finish,
+                    wait_for_batches)
+
+SEGMENT_BATCHES = 100 # batch payloads in one segment file
+SEGMENT_NAME = 'segment-{:05d}.ndjson'
+INDEX_NAME = 'index.ndjson'
+PROGRESS_NAME = 'progress.ndjson'
+JOURNAL_TABLES = ('add_member_tags', 'add_members', 'update_members', 'delete_members')
+_ACTIONS = {'add_members': ('add_or_update', prepare_batch_data_add_members),
+            'update_members': ('update', prepare_batch_data_update_members),
+            'delete_members': ('delete', prepare_batch_data_delete_members)}
+
+
+class JournalWriter(object):
+    """Appends batch payloads to a new journal
+
+    Any previous (e.g. partially compiled) journal in `path` is replaced.
+    The journal is marked complete when closed without an error.
+
+    Args:
+        inputs (list): the `fingerprint` of the tables the journal is
+            compiled from
+    """
+    def __init__(self, path, segment_batches=SEGMENT_BATCHES, inputs=None):
+        self.path = path
+        self.segment_batches = segment_batches
+        self.inputs = inputs
+        self.batches = 0
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith('.ndjson'):
+                os.remove(os.path.join(path, name))
+        self._index = open(os.path.join(path, INDEX_NAME), 'w')
+        self._segment = None
+        self._segment_name = None
+
+    def append(self, table, payload):
+        if not payload['operations']:
+            return
+        if self.batches % self.segment_batches == 0:
+            self._next_segment()
+        line = (json.dumps(payload) + '\n').encode('utf-8')
+        offset = self._segment.tell()
+        self._segment.write(line)
+        self._write_index({'seq': self.batches, 'table': table,
+                           'segment': self._segment_name, 'offset': offset,
+                           'length': len(line),
+                           'operations': len(payload['operations'])})
+        self.batches += 1
+        metrics.incr('journal.batches_compiled')
+        metrics.incr('journal.operations', len(payload['operations']))
+
+    def _next_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_name = SEGMENT_NAME.format(self.batches // self.segment_batches)
+        self._segment = open(os.path.join(self.path, self._segment_name), 'wb')
+
+    def _write_index(self, entry):
+        self._index.write(json.dumps(entry) + '\n')
+
+    def close(self, complete=True):
+        if self._segment is not None:
+            self._segment.close()
+        if complete:
+            self._write_index({'complete': True, 'batches': self.batches,
+                               'inputs': self.inputs})
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(complete=exc_type is None)
+
+
+def read_index(path):
+    """The batches of the journal and whether it was compiled completely"""
+    entries, completion = _read_index(path)
+    return entries, completion is not None
+
+
+def _read_index(path):
+    """The batches of the journal and its last line if it's complete"""
+    entries = []
+    completion = None
+    index = os.path.join(path, INDEX_NAME)
+    if not os.path.exists(index):
+        return entries, completion
+    with open(index) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get('complete'):
+                completion = entry
+            else:
+                entries.append(entry)
+    return entries, completion
+
+
+def is_complete(path):
+    return read_index(path)[1]
+
+
+def fingerprint(tables):
+    """[table, path, size, mtime] of the tables, to tell the inputs apart
+
+    A sliced table counts with the total size and the latest mtime of its
+    slices.
+    """
+    inputs = []
+    for table, csv_path in tables:
+        resolved = resolve_table(csv_path)
+        if os.path.isdir(resolved):
+            stats = [os.stat(os.path.join(resolved, name))
+                     for name in sorted(os.listdir(resolved))]
+        else:
+            stats = [os.stat(resolved)]
+        inputs.append([table, resolved, sum(stat.st_size for stat in stats),
+                       max([stat.st_mtime for stat in stats] or [0])])
+    return inputs
+
+
+def needs_compiling(path, tables):
+    """Whether the `run` mode compiles the journal again
+
+    A journal is only replayed as it is when it was compiled completely from
+    the same tables (see `fingerprint`) and its replay hasn't finished yet,
+    i.e. it's resumed after a crash.
+    """
+    entries, completion = _read_index(path)
+    if completion is None or completion.get('inputs') != fingerprint(tables):
+        return True
+    finished = _read_progress(path)[1]
+    return all(entry['seq'] in finished for entry in entries)
+
+
+def compile_journal(path, tables, created_lists=None, schemas=None,
+                    quarantine_outpaths=None):
+    """Prepare the batches of the tables into a journal in `path`
+
+    Args:
+        tables (list): (table, path/to/table.csv) tuples, the table is one
+            of JOURNAL_TABLES
+        created_lists (dict): {custom_list_id: list_id}, e.g. a `ListResolver`
+        schemas (MergeFieldSchemas): validate the merge fields locally
+        quarantine_outpaths (dict): {table: path/to/quarantine.csv} where the
+            rows with an invalid email address are written
+
+    Returns:
+        the number of batches compiled
+    """
+    quarantine_outpaths = quarantine_outpaths or {}
+    with JournalWriter(path, inputs=fingerprint(tables)) as journal:
+        for table, csv_path in tables:
+            logging.info("Compiling %s into the journal %s", table, path)
+            if table == 'add_member_tags':
+                for chunk in serialize_add_member_tags_input(csv_path):
+                    metrics.incr('rows.add_member_tags', len(chunk))
+                    with metrics.timer('stage.prepare_batch'):
+                        payload = prepare_batch_data_add_member_tags(chunk)
+                    journal.append(table, payload)
+                continue
+            action, prepare = _ACTIONS[table]
+            for chunk in serialize_members_input(
+                    csv_path, action=action,
+                    created_lists=created_lists, schemas=schemas,
+                    quarantine_outpath=quarantine_outpaths.get(table)):
+                metrics.incr('rows.{}'.format(action), len(chunk))
+                with metrics.timer('stage.prepare_batch'):
+                    payload = prepare(chunk)
+                journal.append(table, payload)
+    logging.info("Compiled %s batches into the journal %s", journal.batches, path)
+    return journal.batches
+
+
+def _read_progress(path):
+    """{seq: batch_id} of the submitted and {seq: status} of the finished batches"""
+    submitted = OrderedDict()
+    finished = {}
+    progress = os.path.join(path, PROGRESS_NAME)
+    if os.path.exists(progress):
+        with open(progress) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a crashed replay may be cut off
+                    continue
+                if 'status' in record:
+                    finished[record['seq']] = record['status']
+                else:
+                    submitted[record['seq']] = record['batch_id']
+    return submitted, finished
+
+
+def replay_journal(client, path, outpaths=None, polling_delay=5, api_delay=1):
+    """Submit the batches of a compiled journal and wait for them
+
+    The batches submitted by a previous replay of the journal aren't
+    submitted again, the ones still running are waited for.
+
+    Args:
+        outpaths (dict): {table: path/to/batches.csv} where the statuses of
+            the finished batches are written, including the ones finished
+            by a previous replay
+        polling_delay (float): the shortest delay between two polls of a
+            batch when waiting for a batch slot
+        api_delay (float): the same when waiting for the last batches
+
+    Returns:
+        the number of finished batches
+    """
+    entries, complete = read_index(path)
+    if not complete:
+        raise ConfigError("The journal {} isn't compiled completely, "
+                         "compile it again".format(path))
+    submitted, finished = _read_progress(path)
+    tables = {entry['seq']: entry['table'] for entry in entries}
+    outpaths = outpaths or {}
+    logging.info("Replaying %s batches from the journal %s, %s submitted "
+                 "and %s finished before", len(entries), path, len(submitted),
+                 len(finished))
+    metrics.incr('journal.batches_skipped', len(submitted))
+    with open(os.path.join(path, PROGRESS_NAME), 'a') as progress, \
+            ExitStack() as stack:
+        writers = {}
+
+        def batches_writer(table):
+            if table not in writers:
+                writers[table] = stack.enter_context(BatchesCsvWriter(outpaths.get(table)))
+            return writers[table]
+
+        def record(seq, batch_status):
+            status = {field: batch_status.get(field) for field in BATCH_RESULT_FIELDS}
+            progress.write(json.dumps({'seq': seq, 'status': status}) + '\n')
+            progress.flush()
+            batches_writer(tables[seq]).write(batch_status)
+
+        for seq in sorted(finished):
+            batches_writer(tables[seq]).write(finished[seq])
+        # {batch_id: seq} of the running batches
+        running = OrderedDict((batch_id, seq) for seq, batch_id in submitted.items()
+                              if seq not in finished)
+        segments = {}
+        try:
+            for entry in entries:
+                seq = entry['seq']
+                if seq in submitted:
+                    continue
+                if len(running) >= MAX_RUNNING_BATCHES:
+                    batch_id, oldest = running.popitem(last=False)
+                    record(oldest, wait_for_batch_to_finish(client, batch_id,
+                                                            api_delay=polling_delay))
+                payload = _read_payload(path, entry, segments)
+                try:
+                    batch_response = client.batches.create(data=payload)
+                except HTTPError as exc:
+                    logging.error("Error while submitting batch %s of the journal:\n%s",
+                                  seq, exc.response.text)
+                    raise
+                if not batch_response:
+                    # a disabled client sends nothing
+                    continue
+                progress.write(json.dumps({'seq': seq, 'batch_id': batch_response['id']})
+                               + '\n')
+                progress.flush()
+                running[batch_response['id']] = seq
+                metrics.incr('journal.batches_replayed')
+        finally:
+            for segment in segments.values():
+                segment.close()
+        logging.info("Waiting for batches to finish.")
+        for batch_status in wait_for_batches(client, list(running), api_delay=api_delay):
+            record(running[batch_status['id']], batch_status)
+    return len(entries)
+
+
+def _read_payload(path, entry, segments):
+    segment = segments.get(entry['segment'])
+    if segment is None:
+        for opened in segments.values():
+            opened.close()
+        segments.clear()
+        segment = segments[entry['segment']] = open(
+            os.path.join(path, entry['segment']), 'rb')
+    segment.seek(entry['offset'])
+    return json.loads(segment.read(entry['length']).decode('utf-8'))
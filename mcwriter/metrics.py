@@ -0,0 +1,157 @@
+"""Run-level metrics of the writer
+
+A module level `metrics` registry collects counters, stage timers and samples
+(e.g. batch latencies) during the run. At the end of the run the summary is
+written as a table (`metric`, `value`) and as one json log line.
+
+Usage:
+    from .metrics import metrics
+    metrics.incr('rows.add_or_update', 500)
+    with metrics.timer('stage.cleaning'):
+        ...
+    metrics.observe('batch.latency_seconds', 12.5)
+"""
+from collections import Counter, defaultdict, OrderedDict
+from contextlib import contextmanager
+import csv
+import functools
+import json
+import logging
+import threading
+import time
+from requests.auth import AuthBase
+
+_HTTP_METHODS = ('_get', '_post', '_put', '_patch', '_delete')
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return None
+    rank = int(round(q / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+def endpoint_name(method, url, base_url=''):
+    """Normalize the request into e.g. 'PUT lists/{id}/members/{id}'"""
+    if base_url and url.startswith(base_url):
+        url = url[len(base_url):]
+    segments = [s for s in url.split('?')[0].strip('/').split('/') if s]
+    # the api paths alternate between collections and ids, like
+    # lists/{id}/members/{id}/tags
+    normalized = [s if i % 2 == 0 else '{id}' for i, s in enumerate(segments)]
+    return '{} {}'.format(method.upper(), '/'.join(normalized) or '/')
+
+
+class Metrics(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        self.timers = defaultdict(float)
+        self.timer_counts = Counter()
+        self.samples = defaultdict(list)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        """For the hot loops, where a context manager is too expensive"""
+        with self._lock:
+            self.timers[name] += seconds
+            self.timer_counts[name] += 1
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def sleep(self, name, seconds):
+        """time.sleep() accounted under `name`"""
+        with self.timer(name):
+            time.sleep(seconds)
+
+    def observe(self, name, value):
+        with self._lock:
+            self.samples[name].append(value)
+
+    def summary(self):
+        """Flat mapping of metric name to value"""
+        summary = OrderedDict()
+        for name in sorted(self.counters):
+            summary[name] = self.counters[name]
+        for name in sorted(self.timers):
+            summary['{}.seconds'.format(name)] = round(self.timers[name], 6)
+            summary['{}.count'.format(name)] = self.timer_counts[name]
+        for name in sorted(self.samples):
+            values = sorted(self.samples[name])
+            summary['{}.count'.format(name)] = len(values)
+            for q in PERCENTILES:
+                summary['{}.p{}'.format(name, q)] = percentile(values, q)
+            summary['{}.max'.format(name)] = values[-1]
+        rows = sum(v for k, v in self.counters.items() if k.startswith('rows.'))
+        elapsed = self.timers.get('run_writer')
+        if rows and elapsed:
+            summary['rows_per_second'] = round(rows / elapsed, 2)
+        return summary
+
+    def write_csv(self, outpath):
+        with open(outpath, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(('metric', 'value'))
+            for name, value in self.summary().items():
+                writer.writerow((name, value))
+        return outpath
+
+    def log(self):
+        logging.info("writer_metrics %s", json.dumps(self.summary()))
+
+
+metrics = Metrics()
+
+
+def instrument_client(client, registry=metrics):
+    """Count the API calls of a mailchimp3 client
+
+    Every request made by the client is counted by endpoint (with ids
+    replaced by `{id}`) and timed. The size of the body requests encoded is
+    added to `http.bytes_sent` (see `_CountingAuth`).
+    """
+    def wrap(method_name, method):
+        http_method = method_name.lstrip('_')
+
+        @functools.wraps(method)
+        def wrapper(url, *args, **kwargs):
+            registry.incr('api_calls.{}'.format(
+                endpoint_name(http_method, url, client.base_url)))
+            with registry.timer('http.{}'.format(http_method)):
+                return method(url, *args, **kwargs)
+        return wrapper
+
+    for method_name in _HTTP_METHODS:
+        setattr(client, method_name, wrap(method_name, getattr(client, method_name)))
+    client.auth = _CountingAuth(client.auth, registry)
+    return client
+
+
+class _CountingAuth(AuthBase):
+    """Counts the bytes of the prepared requests, then authenticates them
+
+    mailchimp3 passes its auth to every request, it's the only place the
+    encoded body is at hand without encoding it again.
+    """
+    def __init__(self, auth, registry):
+        self.auth = auth
+        self.registry = registry
+
+    def __call__(self, request):
+        if request.body:
+            self.registry.incr('http.bytes_sent', len(request.body))
+        return self.auth(request)
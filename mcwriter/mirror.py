@@ -0,0 +1,162 @@
+"""Mirror mode: make the lists contain exactly the members of one table
+
+The desired members (the table) and the current members (exported from
+mailchimp) are both sorted by `(list_id, subscriber_hash)` with an external
+merge sort and then merge joined, so the memory needed doesn't depend on the
+size of the audience. The join yields the minimal set of changes:
+
+- members only in the table are added (PUT)
+- members in both which differ are updated (PATCH)
+- members only in mailchimp are deleted (archived)
+
+Only the lists referenced in the table are mirrored.
+"""
+import heapq
+import json
+import os
+import tempfile
+from .metrics import metrics
+from .records import encode_member
+from .snapshot import fetch_members, member_changed
+
+SORT_RUN_SIZE = 50000 #members held in memory while sorting
+
+
+def chunked(iterable, size):
+    """Yield lists of `size` items of the iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _read_run(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def external_sort(records, key, tmpdir, run_size=SORT_RUN_SIZE):
+    """Sort json serializable records with bounded memory
+
+    Runs of `run_size` records are sorted in memory and written to `tmpdir`,
+    then lazily merged. A single run is never written to disk.
+
+    Yields:
+        the records ordered by key(record)
+    """
+    runs = []
+    last_run = None
+    for chunk in chunked(records, run_size):
+        chunk.sort(key=key)
+        if last_run is not None:
+            runs.append(_write_run(last_run, tmpdir))
+        last_run = chunk
+    if not runs:
+        for record in last_run or ():
+            yield record
+        return
+    runs.append(_write_run(last_run, tmpdir))
+    try:
+        for record in heapq.merge(*[_read_run(path) for path in runs], key=key):
+            yield record
+    finally:
+        for path in runs:
+            os.remove(path)
+
+
+def _write_run(records, tmpdir):
+    fd, path = tempfile.mkstemp(suffix='.jsonl', dir=tmpdir)
+    with os.fdopen(fd, 'w') as f:
+        for record in records:
+            f.write(encode_member(record))
+            f.write('\n')
+    return path
+
+
+def _desired_key(member):
+    return member['list_id'], member['subscriber_hash']
+
+
+def _current_key(member):
+    return member['list_id'], member['id']
+
+
+def diff_members(desired, current):
+    """Merge join the desired and current members
+
+    Args:
+        desired (iterator): serialized members sorted by (list_id, subscriber_hash)
+        current (iterator): members as returned by the API with their
+            `list_id`, sorted by (list_id, id)
+
+    Yields:
+        (action, serialized member) tuples, action is one of
+        'add_or_update', 'update' or 'delete'
+    """
+    want = next(desired, None)
+    have = next(current, None)
+    while want is not None or have is not None:
+        if have is None or (want is not None and _desired_key(want) < _current_key(have)):
+            yield 'add_or_update', want
+            want = next(desired, None)
+        elif want is None or _current_key(have) < _desired_key(want):
+            if have.get('status') != 'archived':
+                yield 'delete', {'list_id': have['list_id'],
+                                 'subscriber_hash': have['id'],
+                                 'email_address': have['email_address']}
+            have = next(current, None)
+        else:
+            if have.get('status') == 'archived':
+                yield 'add_or_update', want
+            elif member_changed(have, want):
+                # status_if_new only applies to PUT
+                yield 'update', {k: v for k, v in want.items() if k != 'status_if_new'}
+            want = next(desired, None)
+            have = next(current, None)
+
+
+def mirror_changes(client, desired_chunks, tmpdir, run_size=SORT_RUN_SIZE):
+    """Compute the changes making the lists match the desired members
+
+    Args:
+        desired_chunks (iterable): chunks of serialized members, as yielded
+            by `serialize_members_input`
+        tmpdir (str): where to keep the sorted runs
+
+    Yields:
+        (action, serialized member) tuples, see `diff_members`
+    """
+    list_ids = set()
+
+    def desired_members():
+        for chunk in desired_chunks:
+            metrics.incr('rows.mirror', len(chunk))
+            for member in chunk:
+                list_ids.add(member['list_id'])
+                yield member
+
+    # sorting consumes the whole table, so list_ids are known afterwards
+    desired = external_sort(desired_members(), _desired_key, tmpdir, run_size)
+    first = next(desired, None)
+    if first is None:
+        return
+
+    def current_members():
+        for list_id in sorted(list_ids):
+            members = (dict(member, list_id=list_id)
+                       for member in fetch_members(client, list_id))
+            for member in external_sort(members, _current_key, tmpdir, run_size):
+                yield member
+
+    def desired_with_first():
+        yield first
+        for member in desired:
+            yield member
+
+    for change in diff_members(desired_with_first(), current_members()):
+        yield change
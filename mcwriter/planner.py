@@ -0,0 +1,187 @@
+"""Cost based choice of how to send the members of a chunk
+
+The members of a chunk can be sent one request per member (serial), as one
+batch operation, or through the list batch subscribe endpoint (bulk, only
+when adding members). `EnginePlanner` estimates the seconds every strategy
+adds to the run for the members of each list in the chunk and picks the
+cheapest one:
+
+- serial: one request per member, only for the whole chunk and only for
+  chunks of at most `serial_limit` members. A serial request failing fails
+  the run, unlike a failed operation of a batch.
+- batch: one request to submit the batch plus the wait for the batch queue.
+  The run waits for the batches already running anyway, so the more of them
+  are running, the less a new one adds; when all the batch slots are taken,
+  a slot has to free up first.
+- bulk: one request per 500 members, its latency grows with the members
+
+The latencies are the ones observed during the run (the requests of the
+writer, the batches which finished), with conservative defaults until then.
+With the defaults, a chunk of up to `SERIAL_LIMIT` members goes serially
+rather than waiting a minute in the batch queue, unless batches are already
+running.
+
+Usage:
+    planner = EnginePlanner(strategies=(SERIAL, BATCH))
+    for strategy, members in planner.plan(chunk, running=len(running_batches)):
+        ...
+        planner.observe(strategy, len(members), seconds)
+"""
+from collections import OrderedDict, deque
+import logging
+import math
+from .metrics import metrics, percentile
+
+SERIAL = 'serial'
+BATCH = 'batch'
+BULK = 'bulk'
+DEFAULT_REQUEST_LATENCY = 0.5 #seconds per API request until measured
+DEFAULT_BULK_MEMBER_LATENCY = 0.01 #seconds per member of a bulk request
+DEFAULT_BATCH_LATENCY = 60 #seconds from submitting a batch until it finishes
+MAX_RUNNING_BATCHES = 480 # mailchimp allows 500 running batches
+BULK_SIZE = 500 # members in one bulk request
+RECENT_OBSERVATIONS = 20 # the estimates follow the latest observations
+SERIAL_LIMIT = 100 # members of a chunk sent serially at most
+
+
+class EnginePlanner(object):
+    """Picks the cheapest strategy for the members of every list of a chunk
+
+    Args:
+        strategies (tuple): the strategies available for the action
+        batch_delay (float): seconds the writer sleeps after submitting a batch
+        registry (Metrics): where the latencies of the finished batches and
+            of the API requests are observed
+        serial_limit (int): the largest chunk sent serially
+    """
+    def __init__(self, strategies=(SERIAL, BATCH), batch_delay=0, registry=metrics,
+                 serial_limit=SERIAL_LIMIT):
+        self.strategies = tuple(strategies)
+        self.batch_delay = batch_delay
+        self.serial_limit = serial_limit
+        self.registry = registry
+        # seconds per request, seconds per member of the bulk requests
+        self._requests = deque(maxlen=RECENT_OBSERVATIONS)
+        self._bulk = deque(maxlen=RECENT_OBSERVATIONS)
+
+    def observe(self, strategy, size, seconds):
+        """Record how long sending `size` members with `strategy` took"""
+        if not size:
+            return
+        if strategy == SERIAL:
+            self._requests.append(seconds / size)
+        elif strategy == BATCH:
+            # submitting a batch is one request
+            self._requests.append(seconds)
+        elif strategy == BULK:
+            self._bulk.append(seconds / size)
+
+    def request_latency(self):
+        """Seconds per API request"""
+        if self._requests:
+            return _median(self._requests)
+        # the requests the writer made so far, e.g. fetching the lists
+        seconds = sum(value for name, value in self.registry.timers.items()
+                      if name.startswith('http.'))
+        count = sum(value for name, value in self.registry.timer_counts.items()
+                    if name.startswith('http.'))
+        return seconds / count if count else DEFAULT_REQUEST_LATENCY
+
+    def batch_latency(self):
+        """Seconds from submitting a batch until it finishes"""
+        samples = self.registry.samples.get('batch.latency_seconds')
+        if samples:
+            return _median(samples[-RECENT_OBSERVATIONS:])
+        return DEFAULT_BATCH_LATENCY
+
+    def costs(self, size, running=0, batch_submitted=False, strategies=None):
+        """The estimated seconds each strategy adds to the run
+
+        Args:
+            size (int): the number of members to send
+            running (int): the number of running batches
+            batch_submitted (bool): other members of the chunk already go
+                into a batch, these would only join it
+            strategies (tuple): the strategies to estimate, all by default
+        """
+        request = self.request_latency()
+        costs = OrderedDict()
+        for strategy in strategies or self.strategies:
+            if strategy == SERIAL:
+                costs[strategy] = size * request
+            elif strategy == BATCH:
+                costs[strategy] = 0.0 if batch_submitted else self._batch_cost(
+                    request, running)
+            elif strategy == BULK:
+                per_member = (_median(self._bulk) if self._bulk
+                              else DEFAULT_BULK_MEMBER_LATENCY)
+                costs[strategy] = (math.ceil(size / BULK_SIZE) * request
+                                   + size * per_member)
+        return costs
+
+    def _batch_cost(self, request, running):
+        latency = self.batch_latency()
+        if not running:
+            wait = latency
+        elif running < MAX_RUNNING_BATCHES:
+            # the run waits for the running batches anyway
+            wait = latency * running / MAX_RUNNING_BATCHES
+        else:
+            # wait for a slot, then for the batch
+            wait = 2 * latency
+        return request + self.batch_delay + wait
+
+    def plan(self, members, running=0):
+        """Split the members of a chunk by the strategy to send them with
+
+        A chunk of at most `serial_limit` members is sent serially if that's
+        cheaper than anything else for the whole chunk. Otherwise every list
+        of the chunk gets the cheapest of the other strategies for its
+        members, the members with the same strategy are sent together.
+
+        Args:
+            members (list): serialized members, with 'list_id'
+            running (int): the number of running batches
+
+        Returns:
+            a list of (strategy, members)
+        """
+        if len(self.strategies) == 1:
+            self.registry.incr('planner.{}'.format(self.strategies[0]), len(members))
+            return [(self.strategies[0], members)]
+        by_list = OrderedDict()
+        for member in members:
+            by_list.setdefault(member.get('list_id'), []).append(member)
+        others = tuple(strategy for strategy in self.strategies if strategy != SERIAL)
+        choices = []
+        batch_submitted = False
+        for list_id, list_members in by_list.items():
+            costs = self.costs(len(list_members), running,
+                               batch_submitted=batch_submitted, strategies=others)
+            strategy = min(costs, key=costs.get)
+            batch_submitted = batch_submitted or strategy == BATCH
+            choices.append((list_id, list_members, strategy, costs))
+        if SERIAL in self.strategies and len(members) <= self.serial_limit:
+            serial = self.costs(len(members), strategies=(SERIAL, ))[SERIAL]
+            otherwise = sum(costs[strategy] for _, _, strategy, costs in choices)
+            if serial <= otherwise:
+                logging.info("%s members go %s, estimated %.1fs, otherwise %.1fs",
+                             len(members), _AS[SERIAL], serial, otherwise)
+                self.registry.incr('planner.{}'.format(SERIAL), len(members))
+                return [(SERIAL, members)]
+        planned = OrderedDict()
+        for list_id, list_members, strategy, costs in choices:
+            logging.info("%s members of list %s go %s, estimated %s",
+                         len(list_members), list_id, _AS[strategy],
+                         ', '.join('{} {:.1f}s'.format(name, cost)
+                                   for name, cost in costs.items()))
+            self.registry.incr('planner.{}'.format(strategy), len(list_members))
+            planned.setdefault(strategy, []).extend(list_members)
+        return list(planned.items())
+
+
+_AS = {SERIAL: 'serially', BATCH: 'in a batch', BULK: 'in bulk'}
+
+
+def _median(values):
+    return percentile(sorted(values), 50)
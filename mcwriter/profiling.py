@@ -0,0 +1,180 @@
+"""Optional profiling of the whole writer run
+
+Turned on by the `profile` config parameter:
+
+- `"deterministic"` (or `true`) runs the writer under cProfile and writes
+  `writer_profile.pstats` and `writer_profile.collapsed`, the latter
+  reconstructed from the pstats call graph
+- `"sampling"` samples the stack of the main thread every
+  `SAMPLING_INTERVAL` seconds (low overhead, fit for production sized runs)
+  and writes `writer_profile.collapsed`
+
+The `.collapsed` file has one `frame;frame;frame weight` line per stack, the
+input format of flamegraph.pl / speedscope / inferno.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from .exceptions import ConfigError
+
+PROFILE_MODES = ('deterministic', 'sampling')
+SAMPLING_INTERVAL = 0.005 #seconds
+PSTATS_FILENAME = 'writer_profile.pstats'
+COLLAPSED_FILENAME = 'writer_profile.collapsed'
+# weights in the collapsed file from cProfile are microseconds
+_MICROSECONDS = 1e6
+_MAX_STACK_DEPTH = 128
+
+
+def _profile_mode(profile):
+    if profile is True:
+        return 'deterministic'
+    if profile not in PROFILE_MODES:
+        raise ConfigError("The 'profile' parameter must be one of {} or true, "
+                          "not '{}'".format(PROFILE_MODES, profile))
+    return profile
+
+
+def _frame_name(filename, lineno, funcname):
+    if filename == '~':
+        # builtins, like "<method 'append' of 'list' objects>"
+        return funcname
+    return '{} ({}:{})'.format(funcname, os.path.basename(filename), lineno)
+
+
+def write_collapsed(stacks, outpath):
+    """Write {(frame, frame, ...): weight} in the collapsed stack format"""
+    with open(outpath, 'w') as f:
+        for stack, weight in sorted(stacks.items()):
+            if weight > 0:
+                f.write('{} {}\n'.format(';'.join(stack), int(round(weight))))
+    return outpath
+
+
+def collapse_pstats(stats):
+    """Reconstruct collapsed stacks from a cProfile call graph
+
+    cProfile only keeps caller -> callee edges, so the own time of every
+    function is spread over its callers in proportion to the time spent
+    under each caller. Exact for trees, an approximation for functions
+    called from many places.
+
+    Args:
+        stats (pstats.Stats): the profile
+
+    Returns:
+        a Counter of {(frame, ...): microseconds}
+    """
+    raw = stats.stats
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    roots = [func for func, value in raw.items() if not value[4]]
+
+    stacks = Counter()
+
+    def walk(func, path, fraction):
+        cc, nc, tt, ct, callers = raw[func]
+        path = path + (_frame_name(*func), )
+        stacks[path] += tt * fraction * _MICROSECONDS
+        if len(path) >= _MAX_STACK_DEPTH:
+            return
+        for callee, edge_cumtime in callees.get(func, ()):
+            callee_cumtime = raw[callee][3]
+            if callee_cumtime <= 0 or _frame_name(*callee) in path:
+                # no time to attribute, or recursion
+                continue
+            if fraction * edge_cumtime * _MICROSECONDS < 1:
+                # prune the negligible paths, the number of paths can explode
+                continue
+            walk(callee, path, fraction * edge_cumtime / callee_cumtime)
+
+    for root in roots:
+        walk(root, (), 1.0)
+    return stacks
+
+
+class StackSampler(object):
+    """Sample the stack of one thread from a background thread"""
+
+    def __init__(self, interval=SAMPLING_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.current_thread().ident
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler')
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(_frame_name(code.co_filename, code.co_firstlineno,
+                                         code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+@contextmanager
+def profiled(profile, outdir):
+    """Profile the body of the with statement if `profile` is set
+
+    Args:
+        profile: value of the `profile` config parameter, falsy disables it
+        outdir (str): where to write the results, e.g. /data/out/files
+    """
+    if not profile:
+        yield
+        return
+    mode = _profile_mode(profile)
+    logging.info("Profiling the writer run (%s)", mode)
+    start = time.time()
+    if mode == 'deterministic':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            _write_results(outdir, mode, time.time() - start, profiler=profiler)
+    else:
+        sampler = StackSampler(interval=SAMPLING_INTERVAL).start()
+        try:
+            yield
+        finally:
+            stacks = sampler.stop()
+            _write_results(outdir, mode, time.time() - start, stacks=stacks)
+
+
+def _write_results(outdir, mode, elapsed, profiler=None, stacks=None):
+    try:
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        if profiler is not None:
+            stats = pstats.Stats(profiler)
+            stats.dump_stats(os.path.join(outdir, PSTATS_FILENAME))
+            stacks = collapse_pstats(stats)
+        write_collapsed(stacks, os.path.join(outdir, COLLAPSED_FILENAME))
+        logging.info("Profile (%s, %.1f s) written to %s", mode, elapsed, outdir)
+    except Exception:
+        # the profile is a by-product, never fail the run because of it
+        logging.exception("Couldn't write the profile to %s", outdir)
@@ -0,0 +1,206 @@
+"""Compact records of the members flowing through the writer
+
+A `MemberRecord` holds one serialized member. The fixed member fields are
+kept in slots instead of a per row dict. The nested fields (merge fields,
+interests) are packed into one tuple of values, the nesting itself is shared
+by all the rows with the same columns. Anything else (unknown columns) goes
+into a dict allocated only when needed.
+
+The record behaves as a mutable mapping with the same keys as the nested
+dict `serialize_dotted_path_dict` builds, so it can be passed wherever a
+serialized member is expected. The nested dicts are unpacked the first time
+they are accessed. Records aren't dicts, encode them with
+`encode_member`.
+"""
+from collections.abc import MutableMapping
+import json
+
+MEMBER_FIELDS = ('email_address', 'list_id', 'subscriber_hash', 'status',
+                 'status_if_new', 'language', 'vip', 'email_type')
+_SLOTTED = frozenset(MEMBER_FIELDS)
+_MISSING = object()
+_MAX_LAYOUTS = 256
+_layouts = {}
+
+
+class _Layout(object):
+    """Where the values of a flat row go, shared by the rows with the same keys"""
+    __slots__ = ('slotted', 'nested', 'nested_positions', 'groups', 'extra')
+
+    def __init__(self, keys, delimiter):
+        self.slotted = []
+        self.nested = []
+        self.nested_positions = []
+        self.extra = []
+        for i, key in enumerate(keys):
+            if key in _SLOTTED:
+                self.slotted.append((key, i))
+            elif delimiter in key:
+                levels = tuple(key.split(delimiter))
+                if len(levels) > 3:
+                    raise ValueError("Can't nest dict deeper than 2 levels {!r}".format(key))
+                self.nested.append(levels)
+                self.nested_positions.append(i)
+            else:
+                self.extra.append((key, i))
+        self.groups = []
+        for levels in self.nested:
+            if levels[0] not in self.groups:
+                self.groups.append(levels[0])
+
+
+def _layout(keys, delimiter):
+    layout = _layouts.get((keys, delimiter))
+    if layout is None:
+        if len(_layouts) >= _MAX_LAYOUTS:
+            _layouts.clear()
+        layout = _layouts[(keys, delimiter)] = _Layout(keys, delimiter)
+    return layout
+
+
+class MemberRecord(MutableMapping):
+    """One serialized member
+
+    Args:
+        flat (dict): cleaned member data, keys like 'merge_fields__FNAME'
+            are nested as in `serialize_dotted_path_dict`
+    """
+    __slots__ = MEMBER_FIELDS + ('_layout', '_values', '_extra')
+
+    def __init__(self, flat=None, delimiter='__'):
+        self._layout = self._values = self._extra = None
+        if flat:
+            self._fill(tuple(flat), tuple(flat.values()), delimiter)
+
+    @classmethod
+    def from_row(cls, keys, values, delimiter='__'):
+        """Build the record from a row tuple and its column names"""
+        record = cls()
+        record._fill(keys, values, delimiter)
+        return record
+
+    def _fill(self, keys, values, delimiter):
+        layout = _layout(keys, delimiter)
+        for name, i in layout.slotted:
+            setattr(self, name, values[i])
+        if layout.nested:
+            self._layout = layout
+            self._values = tuple([values[i] for i in layout.nested_positions])
+        if layout.extra:
+            self._extra = {key: values[i] for key, i in layout.extra}
+
+    def _nested(self):
+        nested = {}
+        for levels, value in zip(self._layout.nested, self._values):
+            group = nested.setdefault(levels[0], {})
+            if len(levels) == 2:
+                group[levels[1]] = value
+            else:
+                group.setdefault(levels[1], {})[levels[2]] = value
+        return nested
+
+    def _unpack(self):
+        """Move the packed nested fields into the extra dict"""
+        if self._layout is None:
+            return
+        nested = self._nested()
+        nested.update(self._extra or {})
+        self._extra = nested
+        self._layout = self._values = None
+
+    def as_dict(self):
+        """The member as a plain dict (json serializable), without unpacking"""
+        data = {}
+        for name in MEMBER_FIELDS:
+            value = getattr(self, name, _MISSING)
+            if value is not _MISSING:
+                data[name] = value
+        if self._layout is not None:
+            data.update(self._nested())
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def _keys(self):
+        keys = [name for name in MEMBER_FIELDS
+                if getattr(self, name, _MISSING) is not _MISSING]
+        if self._layout is not None:
+            keys.extend(self._layout.groups)
+        if self._extra:
+            keys.extend(key for key in self._extra if key not in keys)
+        return keys
+
+    def __getitem__(self, key):
+        if key in _SLOTTED:
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                return value
+            raise KeyError(key)
+        if self._layout is not None and key in self._layout.groups:
+            self._unpack()
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _SLOTTED:
+            setattr(self, key, value)
+            return
+        self._unpack()
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _SLOTTED:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+            return
+        self._unpack()
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def pop(self, key, default=_MISSING):
+        if key in _SLOTTED:
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                delattr(self, key)
+                return value
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        if default is _MISSING:
+            return MutableMapping.pop(self, key)
+        return MutableMapping.pop(self, key, default)
+
+    def __contains__(self, key):
+        if key in _SLOTTED:
+            return getattr(self, key, _MISSING) is not _MISSING
+        return ((self._layout is not None and key in self._layout.groups)
+                or (self._extra is not None and key in self._extra))
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __repr__(self):
+        return 'MemberRecord({!r})'.format(self.as_dict())
+
+
+def encode_member(member):
+    """Json encode a serialized member, either a MemberRecord or a dict"""
+    if isinstance(member, MemberRecord):
+        member = member.as_dict()
+    return json.dumps(member)
+
+
+def as_dict(member):
+    """A serialized member (MemberRecord or dict) as a new plain dict"""
+    if isinstance(member, MemberRecord):
+        return member.as_dict()
+    return dict(member)
@@ -0,0 +1,157 @@
+"""Resolving `custom_list_id` to the ids of existing mailchimp lists
+
+Without a resolver, `custom_list_id` only refers to the lists created in the
+same run (the `custom_id` column of new_lists.csv). `ListResolver` also
+resolves the lists created by previous runs and the lists by their name.
+
+The index of the lists (their names and the custom ids the writer created
+them with) is kept in the state file of the component (`in/state.json`,
+written to `out/state.json`). It is fetched with a single paginated
+`GET /lists`, at most once per run: when it's older than the TTL or when a
+custom_list_id isn't in it. The state is written at the end of every run
+(`save()`), a run without an output state would make the next one forget
+the custom ids.
+
+Usage:
+    lists = ListResolver(client, datadir='/data/')
+    lists.add_created(created_lists)
+    lists.save()
+    lists['wizards']  # the id of the list created with custom_id 'wizards',
+                      # or of the list named 'wizards'
+"""
+from collections.abc import Mapping
+import json
+import logging
+import os
+import time
+from .exceptions import CleaningError
+from .metrics import metrics
+from .utils import get_lists
+
+LISTS_INDEX_TTL = 24 * 3600 #seconds
+STATE_KEY = 'lists_index'
+
+
+def load_state(datadir):
+    """The state of the previous run, {} if there is none"""
+    path = os.path.join(datadir, 'in', 'state.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(datadir, state):
+    outdir = os.path.join(datadir, 'out')
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, 'state.json'), 'w') as f:
+        json.dump(state, f)
+
+
+class ListResolver(Mapping):
+    """Maps a custom_list_id to the id of a list
+
+    The custom_list_id is either the custom_id the writer created the list
+    with (in this or a previous run) or the name of the list.
+
+    Args:
+        client: the mailchimp client, to fetch the lists
+        datadir (str): where the state file is read from and written to,
+            None keeps the index in memory only
+        ttl (float): seconds the index of the lists is reused for
+    """
+    def __init__(self, client, datadir=None, ttl=LISTS_INDEX_TTL, clock=time.time):
+        self.client = client
+        self.datadir = datadir
+        self.ttl = ttl
+        self.clock = clock
+        self._state = load_state(datadir) if datadir else {}
+        index = self._state.get(STATE_KEY) or {}
+        self.custom_ids = dict(index.get('custom_ids') or {})
+        # None for the names shared by several lists
+        self.names = dict(index.get('names') or {})
+        self.fetched_at = index.get('fetched_at')
+        self._refreshed = False
+
+    def add_created(self, created_lists):
+        """Remember the {custom_id: list_id} of the lists created in this run"""
+        if created_lists:
+            self.custom_ids.update(created_lists)
+            self.save()
+
+    def refresh(self):
+        """Fetch the names of all the lists"""
+        lists = get_lists(self.client, fields=['name'])
+        metrics.incr('lists_index.refreshes')
+        self.names = {}
+        for list_id, mc_list in lists.items():
+            name = mc_list.get('name')
+            self.names[name] = None if name in self.names else list_id
+        if lists:
+            # forget the deleted lists
+            self.custom_ids = {custom_id: list_id
+                               for custom_id, list_id in self.custom_ids.items()
+                               if list_id in lists}
+        self.fetched_at = self.clock()
+        self._refreshed = True
+        logging.info("Indexed %s lists", len(lists))
+        self.save()
+
+    def save(self):
+        """Write the index to the output state file (if there is a datadir)"""
+        if self.datadir:
+            self._state[STATE_KEY] = {'custom_ids': self.custom_ids,
+                                      'names': self.names,
+                                      'fetched_at': self.fetched_at}
+            save_state(self.datadir, self._state)
+
+    def _lookup(self, custom_list_id):
+        if custom_list_id in self.custom_ids:
+            return self.custom_ids[custom_list_id]
+        if self.names.get(custom_list_id) is None and custom_list_id in self.names:
+            raise CleaningError("There are several lists named '{}', use their "
+                                "list_id instead".format(custom_list_id))
+        return self.names.get(custom_list_id)
+
+    def known(self, custom_list_id):
+        """The list id from the index as it is, None if it isn't there
+
+        Nothing is fetched, e.g. for planning a run.
+        """
+        try:
+            return self._lookup(custom_list_id)
+        except CleaningError:
+            return None
+
+    def __getitem__(self, custom_list_id):
+        stale = self.fetched_at is None or self.clock() - self.fetched_at >= self.ttl
+        if stale and not self._refreshed:
+            self.refresh()
+        list_id = self._lookup(custom_list_id)
+        if list_id is None and not self._refreshed:
+            # the list may have been created since the index was fetched
+            self.refresh()
+            list_id = self._lookup(custom_list_id)
+        if list_id is None:
+            raise CleaningError("Unknown custom_list_id '{}', it's neither the "
+                                "custom_id of a list created by the writer nor "
+                                "the name of a list".format(custom_list_id))
+        return list_id
+
+    def __contains__(self, custom_list_id):
+        try:
+            self[custom_list_id]
+        except CleaningError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(set(self.custom_ids) | set(name for name, list_id
+                                               in self.names.items() if list_id))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __bool__(self):
+        # resolves lists even before the index was fetched
+        return True
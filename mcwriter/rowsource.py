@@ -0,0 +1,465 @@
+"""Reading the input tables
+
+A `RowSource` reads a csv table in batches of row tuples and keeps the header
+and a {column: position} index, so that the callers decide which rows need a
+dict at all. Three backends parse the csv:
+
+- `'mmap'`, the table is memory mapped and split into lines. Lines without
+  quotes are split on commas as bytes and only the requested columns are
+  decoded, quoted lines are handed over to the `csv` module. It only pays
+  off on unquoted tables, so a table with quotes or CR-only line endings in
+  its first `SNIFF_SIZE` bytes (e.g. the fully quoted exports of Keboola)
+  is read by the `csv` backend instead.
+- `'csv'`, the stdlib `csv.reader` over the file opened in text mode. The
+  default without pyarrow.
+- `'pyarrow'`, the multithreaded `pyarrow.csv` streaming reader, which parses
+  blocks of the file into column batches outside of the interpreter. The
+  default when pyarrow is installed. `column_batches()` hands its column
+  batches over as they are, without splitting them into rows.
+
+The `csv_backend` config parameter picks the backend of a run, see
+`csv_backend()`.
+
+The tables are always decoded as `ENCODING`. Gzipped tables (`.csv.gz`)
+are decompressed on the fly, they can't be memory mapped and are parsed by
+the `csv` backend instead of `mmap`.
+
+A sliced table is a directory of headerless part files (optionally gzipped)
+forming one table, with the columns listed in its manifest. The slices are
+read concurrently by `SLICE_WORKERS` threads, the rows are yielded in the
+order of the slices (sorted by name) and of the rows within them.
+
+Usage:
+    with open_table(path) as rows:
+        for batch in rows.dicts(500):
+            ...
+"""
+from contextlib import contextmanager
+import csv
+import gzip
+from itertools import islice
+import json
+import mmap
+import os
+import queue
+import re
+import threading
+import time
+from .exceptions import ConfigError
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+
+BACKENDS = ('mmap', 'csv', 'pyarrow')
+ENCODING = 'utf-8'
+PYARROW_BLOCK_SIZE = 1 << 24 # bytes parsed at once
+SLICE_WORKERS = 4
+SLICE_BUFFER = 2 # batches read ahead from every slice
+SNIFF_SIZE = 1 << 16 # bytes the mmap backend looks at to pick the parser
+_CR_ONLY = re.compile(rb'\r(?!\n)')
+
+# the backend of the current run, see `csv_backend`
+_backend = None
+
+
+def default_backend():
+    if _backend is not None:
+        return _backend
+    return 'pyarrow' if pyarrow is not None else 'csv'
+
+
+@contextmanager
+def csv_backend(backend):
+    """Read the tables with `backend` while inside the block
+
+    Args:
+        backend (str): one of BACKENDS, None keeps the default
+    """
+    global _backend
+    if not backend:
+        yield
+        return
+    _check_backend(backend)
+    _backend = backend
+    try:
+        yield
+    finally:
+        _backend = None
+
+
+def _mmap_fits(path):
+    """Whether the start of the table is unquoted with LF or CRLF line endings"""
+    with open(path, 'rb') as f:
+        sample = f.read(SNIFF_SIZE)
+    if len(sample) == SNIFF_SIZE:
+        # the LF of a trailing CR may be cut off
+        sample = sample.rstrip(b'\r')
+    return b'"' not in sample and not _CR_ONLY.search(sample)
+
+
+def resolve_table(path):
+    """Return where the table `path/to/table.csv` actually is
+
+    It is either the file itself, a sliced table directory of the same name
+    or `path/to/table.csv.gz`.
+    """
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        return path + '.gz'
+    return path
+
+
+def open_table(path, backend=None):
+    """Open a plain, gzipped or sliced table
+
+    Returns:
+        a RowSource or SlicedRowSource
+    """
+    path = resolve_table(path)
+    if os.path.isdir(path):
+        return SlicedRowSource(path, backend=backend)
+    return RowSource(path, backend=backend)
+
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ConfigError("Unknown csv backend '{}', use one of {}".format(
+            backend, BACKENDS))
+    if backend == 'pyarrow' and pyarrow is None:
+        raise ConfigError("The pyarrow csv backend needs pyarrow installed")
+
+
+def _open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='', encoding=ENCODING)
+    return open(path, 'r', newline='', encoding=ENCODING)
+
+
+class _Rows(object):
+    """What all the row sources share, they set `header` and `batches()`"""
+
+    def dicts(self, size):
+        """Yield lists of at most `size` rows as {column: value} dicts"""
+        header = self.header
+        for batch in self.batches(size):
+            yield [dict(zip(header, row)) for row in batch]
+
+    def column_batches(self, size):
+        """Yield {column: list of values} dicts of at most `size` rows"""
+        header = self.header
+        for batch in self.batches(size):
+            yield dict(zip(header, map(list, zip(*batch))))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RowSource(_Rows):
+    """Rows of one (optionally gzipped) csv file
+
+    Args:
+        path (str): path/to/table.csv or path/to/table.csv.gz
+        backend (str): one of BACKENDS, by default pyarrow if it is installed
+            and csv otherwise
+        header (list): the columns of a file without a header row (a slice)
+    """
+
+    def __init__(self, path, backend=None, header=None):
+        self.path = path
+        self.backend = backend or default_backend()
+        _check_backend(self.backend)
+        if self.backend == 'mmap' and (path.endswith('.gz') or not _mmap_fits(path)):
+            self.backend = 'csv'
+        # positions of the columns to decode, None for all of them
+        self._positions = None
+        self._mmap = None
+        self._file = None
+        if self.backend == 'mmap':
+            self._rows = self._mmap_rows()
+        else:
+            self._file = _open_text(path)
+            self._rows = csv.reader(self._file)
+        self._has_header = header is None
+        if header is None:
+            header = next(self._rows, ())
+        self.header = tuple(header)
+        self.index = {name: i for i, name in enumerate(self.header)}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def batches(self, size, columns=None):
+        """Yield lists of at most `size` rows, each row a sequence of strings
+
+        Empty lines are skipped, short rows are padded with None (as
+        `csv.DictReader` does).
+
+        Args:
+            columns (list): if given, the rows contain only these columns
+                (in this order)
+        """
+        if not self.header:
+            return
+        positions = None
+        if columns is not None:
+            positions = [self.index[column] for column in columns]
+        if self.backend == 'pyarrow':
+            rows = self._pyarrow_rows()
+        else:
+            rows = self._rows
+        if self.backend == 'mmap':
+            # the unused columns are not even decoded
+            self._positions = positions
+            positions = None
+        width = len(columns) if columns is not None else len(self.header)
+        while True:
+            batch = _take(rows, size)
+            if not batch:
+                return
+            if positions is not None:
+                batch = [_project(row, positions) for row in batch]
+            for i, row in enumerate(batch):
+                if len(row) < width:
+                    batch[i] = tuple(row) + (None, ) * (width - len(row))
+            yield batch
+
+    def dicts(self, size):
+        """Yield lists of at most `size` rows as {column: value} dicts
+
+        The csv backend builds the dicts straight from the csv reader, without
+        the intermediate batches of row tuples.
+        """
+        if self.backend != 'csv' or not self.header:
+            for batch in _Rows.dicts(self, size):
+                yield batch
+            return
+        header = self.header
+        width = len(header)
+        rows = self._rows
+        while True:
+            batch = []
+            for row in rows:
+                if len(row) != width:
+                    if not row:
+                        continue
+                    row += [None] * (width - len(row))
+                batch.append(dict(zip(header, row)))
+                if len(batch) == size:
+                    break
+            if not batch:
+                return
+            yield batch
+
+    def column_batches(self, size):
+        """Yield {column: list of values} dicts of at most `size` rows
+
+        The pyarrow backend slices its column batches into chunks of `size`
+        rows, the other backends transpose the batches of rows.
+        """
+        if self.backend != 'pyarrow':
+            for columns in _Rows.column_batches(self, size):
+                yield columns
+            return
+        if not self.header:
+            return
+        pending = []
+        pending_rows = 0
+        for record_batch in self._pyarrow_reader():
+            pending.append(record_batch)
+            pending_rows += record_batch.num_rows
+            while pending_rows >= size:
+                table = pyarrow.Table.from_batches(pending)
+                yield _arrow_columns(table.slice(0, size))
+                rest = table.slice(size)
+                pending = rest.to_batches()
+                pending_rows = rest.num_rows
+        if pending_rows:
+            yield _arrow_columns(pyarrow.Table.from_batches(pending))
+
+    def _mmap_rows(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._mmap, 'madvise'):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        readline = self._mmap.readline
+        for line in iter(readline, b''):
+            if b'"' in line:
+                # a quoted field may contain commas and span several lines,
+                # the csv reader pulls only the lines of this row
+                row = next(csv.reader(_lines_from(line, readline)), [])
+                if self._positions is not None and row:
+                    row = _project(row, self._positions)
+                yield row
+                continue
+            line = line.rstrip(b'\r\n')
+            if not line:
+                yield ()
+            elif self._positions is None:
+                yield line.decode(ENCODING).split(',')
+            else:
+                fields = line.split(b',')
+                yield [fields[i].decode(ENCODING) if i < len(fields) else None
+                       for i in self._positions]
+
+    def _pyarrow_rows(self):
+        for record_batch in self._pyarrow_reader():
+            columns = [column.to_pylist() for column in record_batch.columns]
+            for row in zip(*columns):
+                yield row
+
+    def _pyarrow_reader(self):
+        """The record batches of the table, all the columns as strings"""
+        string = pyarrow.string()
+        read_options = pyarrow_csv.ReadOptions(block_size=PYARROW_BLOCK_SIZE)
+        if not self._has_header:
+            read_options.column_names = list(self.header)
+        return pyarrow_csv.open_csv(
+            self.path,
+            read_options=read_options,
+            parse_options=pyarrow_csv.ParseOptions(newlines_in_values=True),
+            convert_options=pyarrow_csv.ConvertOptions(
+                column_types={name: string for name in self.header},
+                strings_can_be_null=False))
+
+
+class SlicedRowSource(_Rows):
+    """Rows of a sliced table, read by `workers` threads
+
+    Every slice is read into its own bounded queue and the queues are
+    emptied in the order of the slices, so the readers run ahead of the
+    slice being yielded by at most `SLICE_BUFFER` batches each.
+
+    Args:
+        path (str): the directory with the slices, its manifest
+            (path + '.manifest') lists the columns
+    """
+    _DONE = object()
+
+    def __init__(self, path, backend=None, workers=SLICE_WORKERS):
+        self.path = path
+        self.backend = backend
+        self.workers = workers
+        self.header = tuple(_manifest_columns(path))
+        self.index = {name: i for i, name in enumerate(self.header)}
+        self.slices = sorted(os.path.join(path, name) for name in os.listdir(path)
+                             if not name.endswith('.manifest'))
+
+    def close(self):
+        pass
+
+    def batches(self, size, columns=None):
+        """Yield lists of rows from all the slices, see RowSource.batches"""
+        if len(self.slices) <= 1 or self.workers <= 1:
+            for path in self.slices:
+                with RowSource(path, self.backend, header=self.header) as rows:
+                    for batch in rows.batches(size, columns):
+                        yield batch
+            return
+
+        # the slices are taken in order, so the slice being yielded has
+        # always been taken by a reader
+        todo = queue.Queue()
+        outputs = []
+        for path in self.slices:
+            # bounded, the reader waits until the batches are consumed
+            output = queue.Queue(maxsize=SLICE_BUFFER)
+            outputs.append(output)
+            todo.put((path, output))
+        stop = threading.Event()
+
+        def read_slices():
+            while not stop.is_set():
+                try:
+                    path, output = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    with RowSource(path, self.backend, header=self.header) as rows:
+                        for batch in rows.batches(size, columns):
+                            if stop.is_set():
+                                return
+                            output.put(batch)
+                except Exception as err:
+                    output.put(err)
+                    return
+                finally:
+                    output.put(self._DONE)
+
+        threads = [threading.Thread(target=read_slices, name='slice-reader')
+                   for _ in range(min(self.workers, len(self.slices)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for output in outputs:
+                while True:
+                    item = output.get()
+                    if item is self._DONE:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            stop.set()
+            # unblock the readers waiting on a full queue
+            while any(thread.is_alive() for thread in threads):
+                for output in outputs:
+                    try:
+                        output.get_nowait()
+                    except queue.Empty:
+                        pass
+                time.sleep(0.01)
+
+
+def _manifest_columns(path):
+    try:
+        with open(path + '.manifest', 'r') as f:
+            return json.load(f)['columns']
+    except (OSError, ValueError, KeyError):
+        raise ConfigError("The sliced table {} needs a manifest listing "
+                          "its columns".format(path))
+
+
+def _lines_from(first, readline):
+    yield first.decode(ENCODING)
+    for line in iter(readline, b''):
+        yield line.decode(ENCODING)
+
+
+def _arrow_columns(table):
+    return {name: column.to_pylist()
+            for name, column in zip(table.column_names, table.columns)}
+
+
+def _project(row, positions):
+    return [row[i] if i < len(row) else None for i in positions]
+
+
+def _take(rows, size):
+    """Next `size` non empty rows"""
+    batch = list(islice(rows, size))
+    while not all(batch):
+        batch = [row for row in batch if row]
+        more = list(islice(rows, size - len(batch)))
+        if not more:
+            break
+        batch.extend(more)
+    return batch
+
+
+def read_dicts(path, backend=None):
+    """Yield all rows of the table as dicts"""
+    with open_table(path, backend=backend) as rows:
+        for batch in rows.dicts(1000):
+            for row in batch:
+                yield row
@@ -0,0 +1,161 @@
+"""Merge field schemas of the lists, to validate merge values locally
+
+The merge fields of every list the members go to are fetched once per run
+(`MergeFieldSchemas`) and compiled into one coercer per (list, merge tag).
+The cleaning calls the coercer on the distinct values of a
+`merge_fields__TAG` column (see `clean_members_merge_field_columns`), so the
+rows with a bad date, a non-numeric number or an invalid choice are
+quarantined instead of failing an operation in a batch.
+
+A coercer returns the value to send (numbers are converted from strings)
+or raises ValueError. Empty values are accepted unless the merge field is
+required. Text and address merge fields, and tags the list doesn't have,
+aren't checked.
+"""
+import datetime
+import logging
+import math
+import re
+from .metrics import metrics
+from .utils import get_merge_fields
+
+_ZIP = re.compile(r'^\d{5}(-\d{4})?$')
+_URL = re.compile(r'^https?://\S+$', re.IGNORECASE)
+_NOT_DIGITS = re.compile(r'\D')
+_DATE_TOKENS = (('YYYY', '%Y'), ('MM', '%m'), ('DD', '%d'))
+ISO_DATE = '%Y-%m-%d'
+LEAP_YEAR = '2000'
+
+
+def _strptime_format(date_format):
+    """'MM/DD/YYYY' as a strptime format"""
+    for token, directive in _DATE_TOKENS:
+        date_format = date_format.replace(token, directive)
+    return date_format
+
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        return value
+    if '_' in value:
+        # float() accepts '1_000'
+        raise ValueError("isn't a number")
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError("isn't a number")
+    if not math.isfinite(number):
+        raise ValueError("isn't a number")
+    return int(number) if number.is_integer() and '.' not in value else number
+
+
+def _date(formats, description, yearless=False):
+    """Check that the value is a date in any of the formats
+
+    A yearless date (a birthday) is checked in a leap year, strptime
+    defaults to 1900 and would refuse 02/29.
+    """
+    if yearless:
+        formats = tuple(date_format + '/%Y' for date_format in formats)
+
+    def check(value):
+        dated = value + '/' + LEAP_YEAR if yearless else value
+        for date_format in formats:
+            try:
+                datetime.datetime.strptime(dated, date_format)
+                return value
+            except ValueError:
+                continue
+        raise ValueError("isn't a date in the {} format".format(description))
+    return check
+
+
+def _choice(choices):
+    def check(value):
+        if value not in choices:
+            raise ValueError("must be one of {}".format(sorted(choices)))
+        return value
+    return check
+
+
+def _matching(pattern, description):
+    def check(value):
+        if not pattern.match(value):
+            raise ValueError("isn't a valid {}".format(description))
+        return value
+    return check
+
+
+def _us_phone(value):
+    if len(_NOT_DIGITS.sub('', value)) != 10:
+        raise ValueError("isn't a US phone number")
+    return value
+
+
+def compile_coercer(merge_field):
+    """A function validating and converting the values of the merge field
+
+    Returns:
+        None if the values aren't checked
+    """
+    kind = merge_field.get('type')
+    options = merge_field.get('options') or {}
+    if kind == 'number':
+        check = _number
+    elif kind == 'date':
+        date_format = options.get('date_format') or 'MM/DD/YYYY'
+        check = _date((_strptime_format(date_format), ISO_DATE), date_format)
+    elif kind == 'birthday':
+        date_format = options.get('date_format') or 'MM/DD'
+        check = _date((_strptime_format(date_format), ), date_format,
+                      yearless=True)
+    elif kind in ('radio', 'dropdown'):
+        check = _choice(frozenset(options.get('choices') or ()))
+    elif kind == 'zip':
+        check = _matching(_ZIP, 'US zip code')
+    elif kind in ('url', 'imageurl'):
+        check = _matching(_URL, 'url')
+    elif kind == 'phone' and options.get('phone_format') == 'US':
+        check = _us_phone
+    else:
+        check = None
+    required = merge_field.get('required')
+    if check is None and not required:
+        return None
+
+    def coerce(value):
+        if value is None or value == '':
+            if required:
+                raise ValueError("is required")
+            return '' if value is None else value
+        if check is None:
+            return value
+        return check(value)
+    return coerce
+
+
+class MergeFieldSchemas(object):
+    """The merge fields of the lists, fetched once per list
+
+    Args:
+        client: the mailchimp client
+    """
+    def __init__(self, client):
+        self.client = client
+        self._coercers = {}
+
+    def coercers(self, list_id):
+        """{merge tag: coercer} of the list"""
+        coercers = self._coercers.get(list_id)
+        if coercers is None:
+            merge_fields = get_merge_fields(self.client, list_id)
+            metrics.incr('merge_fields.schemas')
+            logging.debug("Fetched %s merge fields of list %s", len(merge_fields), list_id)
+            coercers = self._coercers[list_id] = {
+                merge_field['tag']: compile_coercer(merge_field)
+                for merge_field in merge_fields}
+        return coercers
+
+    def coercer(self, list_id, tag):
+        """The coercer of the merge tag in the list, None if not checked"""
+        return self.coercers(list_id).get(tag)
@@ -0,0 +1,226 @@
+"""Local snapshots of the members of mailchimp lists
+
+A snapshot holds the current state of every member of one list, stored by
+column and indexed by `subscriber_hash`. With the snapshots at hand, the
+writer skips the members which are already in sync instead of sending them.
+
+The first export pages through all members of the list, the following ones
+only fetch the members changed since the previous export
+(`since_last_changed`). The lists are exported concurrently.
+
+The snapshots are written to `out/files` tagged with `SNAPSHOT_TAG`; map the
+files with this tag into `in/files` to reuse them in the next run.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+from .utils import differs
+
+SNAPSHOT_FIELDS = ('email_address', 'status', 'merge_fields', 'interests',
+                   'language', 'vip', 'email_type', 'last_changed')
+SNAPSHOT_TAG = 'mailchimp-writer-snapshot'
+SNAPSHOT_FILENAME = 'members_snapshot_{list_id}.json.gz'
+SNAPSHOT_WORKERS = 4 # mailchimp allows 10 simultaneous connections
+SNAPSHOT_MAX_AGE = datetime.timedelta(days=7) # then export everything again
+MEMBERS_PAGE_SIZE = 1000
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# the exports overlap by this much, in case our clock is ahead of mailchimp's
+_CLOCK_SKEW = datetime.timedelta(minutes=5)
+# keys of the serialized member which are not member properties
+_NOT_COMPARED = ('list_id', 'subscriber_hash', 'email_address', 'status_if_new')
+
+
+class ListSnapshot(object):
+    """Members of one list, stored by column and indexed by subscriber_hash"""
+
+    def __init__(self, list_id, synced_at=None, columns=None):
+        self.list_id = list_id
+        # the time the export started, as '%Y-%m-%dT%H:%M:%S+00:00'
+        self.synced_at = synced_at
+        self.columns = columns or {name: [] for name in
+                                   ('subscriber_hash', ) + SNAPSHOT_FIELDS}
+        self._index = {sub_hash: i for i, sub_hash
+                       in enumerate(self.columns['subscriber_hash'])}
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, subscriber_hash):
+        return subscriber_hash in self._index
+
+    def get(self, subscriber_hash):
+        """Return the member as a dict, None if it isn't in the list"""
+        i = self._index.get(subscriber_hash)
+        if i is None:
+            return None
+        return {name: self.columns[name][i] for name in SNAPSHOT_FIELDS}
+
+    def upsert(self, member):
+        """Add or replace a member as returned by the API"""
+        i = self._index.get(member['id'])
+        if i is None:
+            self._index[member['id']] = len(self.columns['subscriber_hash'])
+            self.columns['subscriber_hash'].append(member['id'])
+            for name in SNAPSHOT_FIELDS:
+                self.columns[name].append(member.get(name))
+        else:
+            for name in SNAPSHOT_FIELDS:
+                self.columns[name][i] = member.get(name)
+
+    def is_stale(self, now):
+        if not self.synced_at:
+            return True
+        synced_at = datetime.datetime.strptime(self.synced_at[:19], _TIMESTAMP_FORMAT)
+        return now - synced_at > SNAPSHOT_MAX_AGE
+
+    def save(self, outdir):
+        """Write the snapshot and its manifest into outdir, return the path"""
+        outpath = os.path.join(outdir, SNAPSHOT_FILENAME.format(list_id=self.list_id))
+        with gzip.open(outpath, 'wt') as f:
+            json.dump({'list_id': self.list_id, 'synced_at': self.synced_at,
+                       'columns': self.columns}, f, separators=(',', ':'))
+        with open(outpath + '.manifest', 'w') as f:
+            json.dump({'tags': [SNAPSHOT_TAG], 'is_permanent': False}, f)
+        return outpath
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt') as f:
+            data = json.load(f)
+        return cls(data['list_id'], synced_at=data['synced_at'],
+                   columns=data['columns'])
+
+
+def find_snapshot(indir, list_id):
+    """Load the most recent snapshot of the list found in indir (or None)
+
+    The input mapping prefixes the file names with the file id, so any file
+    ending with the snapshot filename matches.
+    """
+    pattern = os.path.join(indir, '*' + SNAPSHOT_FILENAME.format(list_id=list_id))
+    newest = None
+    for path in glob.glob(pattern):
+        try:
+            snapshot = ListSnapshot.load(path)
+        except (OSError, ValueError, KeyError):
+            logging.warning("Ignoring the unreadable snapshot %s", path)
+            continue
+        if newest is None or (snapshot.synced_at or '') > (newest.synced_at or ''):
+            newest = snapshot
+    return newest
+
+
+def fetch_members(client, list_id, since_last_changed=None,
+                  page_size=MEMBERS_PAGE_SIZE):
+    """Yield the members of a list, paging through them"""
+    queryparams = {
+        'count': page_size,
+        'fields': ','.join(['total_items', 'members.id'] +
+                           ['members.{}'.format(f) for f in SNAPSHOT_FIELDS])}
+    if since_last_changed:
+        queryparams['since_last_changed'] = since_last_changed
+    offset = 0
+    while True:
+        page = client.lists.members.all(list_id, offset=offset, **queryparams)
+        if not page:
+            # disabled client
+            return
+        for member in page['members']:
+            yield member
+        offset += len(page['members'])
+        if not page['members'] or offset >= page['total_items']:
+            return
+
+
+def member_count(client, list_id):
+    page = client.lists.members.all(list_id, count=1, fields='total_items')
+    return page['total_items'] if page else 0
+
+
+def refresh_snapshot(client, list_id, snapshot=None, now=None):
+    """Bring the snapshot of the list up to date
+
+    Only the members changed since the snapshot was taken are fetched, unless
+    there is no snapshot, it is older than SNAPSHOT_MAX_AGE or members were
+    deleted from the list since (then all members are fetched).
+
+    Returns:
+        the refreshed ListSnapshot
+    """
+    now = now or datetime.datetime.utcnow()
+    started = (now - _CLOCK_SKEW).strftime(_TIMESTAMP_FORMAT) + '+00:00'
+    if snapshot is not None and not snapshot.is_stale(now):
+        changed = 0
+        for member in fetch_members(client, list_id,
+                                    since_last_changed=snapshot.synced_at):
+            snapshot.upsert(member)
+            changed += 1
+        if len(snapshot) == member_count(client, list_id):
+            logging.info("Snapshot of list %s refreshed, %s members changed",
+                         list_id, changed)
+            snapshot.synced_at = started
+            return snapshot
+        logging.info("Members were removed from list %s, exporting all of them",
+                     list_id)
+
+    snapshot = ListSnapshot(list_id)
+    for member in fetch_members(client, list_id):
+        snapshot.upsert(member)
+    snapshot.synced_at = started
+    logging.info("Exported %s members of list %s", len(snapshot), list_id)
+    return snapshot
+
+
+def refresh_snapshots(client, list_ids, indir, outdir, workers=SNAPSHOT_WORKERS):
+    """Refresh the snapshots of the lists concurrently and save them
+
+    Args:
+        list_ids (iterable): lists to export
+        indir (str): where to look for the previous snapshots (in/files)
+        outdir (str): where to write the refreshed ones (out/files)
+
+    Returns:
+        a dict of {list_id: ListSnapshot}
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    def refresh(list_id):
+        snapshot = refresh_snapshot(client, list_id, find_snapshot(indir, list_id))
+        snapshot.save(outdir)
+        return snapshot
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return {snapshot.list_id: snapshot
+                for snapshot in executor.map(refresh, sorted(set(list_ids)))}
+
+
+def member_in_sync(snapshots, member, action):
+    """True if sending the serialized `member` would change nothing
+
+    Args:
+        snapshots (dict): {list_id: ListSnapshot}, lists without a snapshot
+            are never in sync
+        member (dict): as serialized by `serialize_members_input`
+        action (str): 'add_or_update', 'update' or 'delete'
+    """
+    snapshot = snapshots.get(member['list_id'])
+    if snapshot is None:
+        return False
+    existing = snapshot.get(member['subscriber_hash'])
+    if action == 'delete':
+        # deleting archives the member
+        return existing is None or existing['status'] == 'archived'
+    if existing is None:
+        return False
+    return not member_changed(existing, member)
+
+
+def member_changed(existing, member):
+    """True if the serialized `member` differs from the `existing` one"""
+    return differs(existing, {k: v for k, v in member.items()
+                              if k not in _NOT_COMPARED})
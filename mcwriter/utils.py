@@ -2,23 +2,51 @@
 
 @author robin@keboola.com
 """
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import csv
+import datetime
+import heapq
 import os
 import json
+import tarfile
 import time
 import logging
+import requests
 from mailchimp3 import MailChimp
 from requests import HTTPError, ConnectionError
 from .cleaning import (clean_and_validate_lists_data,
                        clean_and_validate_members_data,
                        _hash_email,
+                       normalize_email,
+                       is_valid_email,
+                       INVALID_EMAIL,
                        clean_and_validate_members_delete_data,
                        clean_and_validate_members_update_data,
+                       clean_and_validate_members_columns,
+                       clean_members_merge_fields,
                        clean_and_validate_tags_data)
 from .exceptions import CleaningError, ConfigError, MissingFieldError
+from .metrics import metrics, instrument_client
+from .rowsource import open_table, read_dicts
+from .records import MemberRecord, as_dict, encode_member
+from .webhook import current_receiver, FALLBACK_POLLING_DELAY
 BATCH_POLLING_DELAY = 10 #seconds
+MAX_POLLING_DELAY = 60 #seconds, even if the batch is estimated to take longer
 CHUNK_SIZE = 500 #rows
+MERGE_FIELDS_PAGE_SIZE = 1000 # the max count the API allows
+LISTS_PAGE_SIZE = 1000
+SUBSCRIBE_SIZE = 500 # members in one batch subscribe request, the API maximum
+SEGMENTS_PAGE_SIZE = 1000
+SEGMENT_MEMBERS_SIZE = 500 # emails in one static segment request, the API maximum
+# tag status: the other one
+_TAG_STATUSES = {'active': 'inactive', 'inactive': 'active'}
+# columns of the output tables with batch results
+BATCH_RESULT_FIELDS = ('id', 'status', 'total_operations', 'finished_operations',
+                       'errored_operations', 'submitted_at', 'completed_at',
+                       'response_body_url')
+# columns of the output tables with the rows left out for an invalid email
+# or merge field
+QUARANTINE_FIELDS = ('row', 'email_address', 'list_id', 'reason')
 
 def serialize_dotted_path_dict(cleaned_flat_data, delimiter='__'):
     """Convert fields from csv file into required nested format
@@ -58,38 +86,83 @@ def serialize_lists_input(path):
         a list of serialized dicts in a format that can be used by MC Api
     """
     serialized = []
-    with open(path, 'r') as lists:
-        reader = csv.DictReader(lists)
-        for line in reader:
-            cleaned_flat_data = clean_and_validate_lists_data(line)
-            serialized_line = serialize_dotted_path_dict(cleaned_flat_data)
-            serialized.append(serialized_line)
+    for line in read_dicts(path):
+        cleaned_flat_data = clean_and_validate_lists_data(line)
+        serialized_line = serialize_dotted_path_dict(cleaned_flat_data)
+        serialized.append(serialized_line)
     return serialized
 
 def serialize_add_member_tags_input(path, chunk_size=CHUNK_SIZE):
-    '''
-    '''
-
-    with open(path, 'r') as lists:
-        reader = csv.DictReader(lists)
-        while reader:
-            serialized = []
-            for _ in range(chunk_size):
-                try:
-                    line = next(reader)
-                except StopIteration:
-                    break
-                else:
-                    line['tags'] = json.loads(line['tags'])
-                    line['subscriber_hash'] = _hash_email(line.pop('email_address'))
-                    serialized.append(line)
-            # make sure there are no leftovers
-            if len(serialized) == 0:
-                raise StopIteration
-            yield serialized
-
+    """Parse the add_member_tags csv file in chunks
 
-def serialize_members_input(path, action, created_lists=None, chunk_size=CHUNK_SIZE):
+    Yields:
+        lists of at most `chunk_size` dicts with `tags` decoded and the email
+        replaced by its `subscriber_hash`
+    """
+    with open_table(path) as rows:
+        start = time.perf_counter()
+        for batch in rows.dicts(chunk_size):
+            parsed = time.perf_counter()
+            metrics.add_time('stage.csv_parsing', parsed - start)
+            for line in batch:
+                line['tags'] = json.loads(line['tags'])
+                line['subscriber_hash'] = _hash_email(line.pop('email_address'))
+            metrics.add_time('stage.cleaning', time.perf_counter() - parsed)
+            yield batch
+            start = time.perf_counter()
+
+
+def serialize_member_tags_by_tag(path, size=SEGMENT_MEMBERS_SIZE):
+    """Parse the add_member_tags csv file grouping the members by tag
+
+    The groups are yielded as soon as they are full, the rest at the end, so
+    only the emails of the incomplete groups are kept in memory. The last
+    status of a member's tag in the file wins: a member is taken out of the
+    incomplete group of the other status, and a full group is yielded
+    before any later group of the other status, which has to be applied
+    after it (see `_add_member_tags_by_segments`).
+
+    Yields:
+        (list_id, tag name, status, emails) tuples with at most `size` emails,
+        status is 'active' or 'inactive'
+    """
+    # {(list_id, tag name, status): {email: None}}, ordered sets of emails
+    groups = OrderedDict()
+    rows = 0
+    for list_id, email, tags in _member_tags_rows(path):
+        rows += 1
+        email = normalize_email(email)
+        for tag in json.loads(tags):
+            status = tag.get('status', 'active')
+            if status not in _TAG_STATUSES:
+                raise CleaningError("The status of tag '{}' must be either 'active' "
+                                    "or 'inactive', not '{}'".format(tag['name'], status))
+            other = (list_id, tag['name'], _TAG_STATUSES[status])
+            if other in groups:
+                groups[other].pop(email, None)
+            key = (list_id, tag['name'], status)
+            emails = groups.setdefault(key, OrderedDict())
+            emails[email] = None
+            if len(emails) >= size:
+                del groups[key]
+                yield key + (list(emails), )
+    metrics.incr('rows.add_member_tags', rows)
+    for key, emails in groups.items():
+        if emails:
+            yield key + (list(emails), )
+
+
+def _member_tags_rows(path):
+    """Yield (list_id, email_address, tags) of every row, nothing else is decoded"""
+    with open_table(path) as rows:
+        for batch in rows.batches(CHUNK_SIZE,
+                                  columns=['list_id', 'email_address', 'tags']):
+            for row in batch:
+                yield row
+
+
+def serialize_members_input(path, action, created_lists=None, chunk_size=CHUNK_SIZE,
+                            columnar=True, schemas=None, quarantine_outpath=None):
     """Parse the members csvfile containing subscribers and lists
 
     optionally (created_lists arg) appends the list_id to the data based on the
@@ -97,10 +170,19 @@ def serialize_members_input(path, action, created_lists=None, chunk_size=CHUNK_S
 
     Args:
         path (str): /path/to/inputs/add_members.csv
-        created_lists (dict): Mapping of custom_list_id: actual mailchimp list_id
-
-    Returns:
-        a list of serialized dicts in a format that can be used by MC Api
+        created_lists (dict): Mapping of custom_list_id: actual mailchimp list_id,
+            e.g. a `ListResolver`, used if the csv has a custom_list_id column
+        columnar (bool): clean each chunk column by column
+            (`clean_and_validate_members_columns`) instead of row by row
+        schemas (MergeFieldSchemas): validate the merge fields against the
+            merge fields of the lists
+        quarantine_outpath (str): where the rows with an invalid email
+            address or merge field are written (QUARANTINE_FIELDS), they are
+            never sent
+
+    Yields:
+        lists of at most `chunk_size` MemberRecords, in the nested format
+        used by the MC Api
 
     """
     actions = ('add_or_update', 'update', 'delete')
@@ -108,33 +190,102 @@ def serialize_members_input(path, action, created_lists=None, chunk_size=CHUNK_S
         raise ConfigError("When serializing members data, you must choose one"
                           "of the following actions {}, not {}".format(
                               actions, action))
-    with open(path, 'r') as lists:
-        reader = csv.DictReader(lists)
-        while reader:
-            serialized = []
-            for _ in range(chunk_size):
-                try:
-                    line = next(reader)
-                except StopIteration:
-                    break
-                else:
-                    if created_lists:
-                        mailchimp_list_id = created_lists[line.pop('custom_list_id')]
-                        line['list_id'] = mailchimp_list_id
-                    if action == 'add_or_update':
-                        cleaned_flat_data = clean_and_validate_members_data(line)
-                    elif action == 'update':
-                        cleaned_flat_data = clean_and_validate_members_update_data(line)
-                    else:
-                        # it's delete
-                        cleaned_flat_data = clean_and_validate_members_delete_data(line)
-
-                    serialized_line = serialize_dotted_path_dict(cleaned_flat_data)
-                    serialized.append(serialized_line)
-            # make sure there are no leftovers
-            if len(serialized) == 0:
-                raise StopIteration
+    with BatchesCsvWriter(quarantine_outpath, QUARANTINE_FIELDS) as quarantine:
+        if columnar:
+            chunks = _serialize_members_columns(path, action, created_lists, chunk_size,
+                                                schemas, quarantine)
+        else:
+            chunks = _serialize_members_rows(path, action, created_lists, chunk_size,
+                                             schemas, quarantine)
+        for chunk in chunks:
+            yield chunk
+    if quarantine.written:
+        logging.warning("%s rows of %s have an invalid email address or merge "
+                        "field and weren't sent", quarantine.written, path)
+
+
+def _quarantine(quarantine, rows):
+    for row in rows:
+        quarantine.write(row)
+    metrics.incr('rows.quarantined', len(rows))
+
+
+def _serialize_members_rows(path, action, created_lists, chunk_size, schemas,
+                            quarantine):
+    if action == 'add_or_update':
+        clean = clean_and_validate_members_data
+    elif action == 'update':
+        clean = clean_and_validate_members_update_data
+    else:
+        # it's delete
+        clean = clean_and_validate_members_delete_data
+    offset = 0
+    with open_table(path) as rows:
+        start = time.perf_counter()
+        for batch in rows.dicts(chunk_size):
+            parsed = time.perf_counter()
+            metrics.add_time('stage.csv_parsing', parsed - start)
+            cleaned_flat_data = []
+            quarantined = []
+            for index, line in enumerate(batch, offset):
+                if created_lists and 'custom_list_id' in line:
+                    mailchimp_list_id = created_lists[line.pop('custom_list_id')]
+                    line['list_id'] = mailchimp_list_id
+                line = clean(line)
+                reason = None
+                if not is_valid_email(line['email_address']):
+                    reason = INVALID_EMAIL
+                elif schemas is not None and action != 'delete':
+                    reason = clean_members_merge_fields(line, schemas)
+                if reason is not None:
+                    quarantined.append({'row': index,
+                                        'email_address': line['email_address'],
+                                        'list_id': line['list_id'],
+                                        'reason': reason})
+                    continue
+                cleaned_flat_data.append(line)
+            offset += len(batch)
+            if quarantined:
+                _quarantine(quarantine, quarantined)
+            cleaned = time.perf_counter()
+            metrics.add_time('stage.cleaning', cleaned - parsed)
+
+            serialized = [MemberRecord(line) for line in cleaned_flat_data]
+            del batch, cleaned_flat_data
+            metrics.add_time('stage.serialization', time.perf_counter() - cleaned)
+            yield serialized
+            start = time.perf_counter()
+
+
+def _serialize_members_columns(path, action, created_lists, chunk_size, schemas,
+                               quarantine):
+    offset = 0
+    with open_table(path) as rows:
+        start = time.perf_counter()
+        for columns in rows.column_batches(chunk_size):
+            parsed = time.perf_counter()
+            metrics.add_time('stage.csv_parsing', parsed - start)
+            size = len(columns[rows.header[0]])
+            if created_lists and 'custom_list_id' in columns:
+                custom_list_ids = columns.pop('custom_list_id')
+                resolved = {custom_list_id: created_lists[custom_list_id]
+                            for custom_list_id in set(custom_list_ids)}
+                columns['list_id'] = [resolved[custom_list_id]
+                                      for custom_list_id in custom_list_ids]
+            quarantined = []
+            keys, cleaned_rows = clean_and_validate_members_columns(
+                columns, action, offset, schemas, quarantined)
+            offset += size
+            if quarantined:
+                _quarantine(quarantine, quarantined)
+            cleaned = time.perf_counter()
+            metrics.add_time('stage.cleaning', cleaned - parsed)
+
+            serialized = [MemberRecord.from_row(keys, row) for row in cleaned_rows]
+            del columns, cleaned_rows
+            metrics.add_time('stage.serialization', time.perf_counter() - cleaned)
             yield serialized
+            start = time.perf_counter()
 
 def serialize_tags_input(path_csv, created_lists=None):
     """Parse the csv file for adding tags to existing list
@@ -148,18 +299,174 @@ def serialize_tags_input(path_csv, created_lists=None):
         a list of dicts containing cleaned and serialized data
     """
     serialized = []
-    with open(path_csv, 'r') as tags:
-        reader = csv.DictReader(tags)
-        for line in reader:
-            if created_lists:
-                mailchimp_list_id = created_lists[line.pop('custom_list_id')]
-                line['list_id'] = mailchimp_list_id
-            cleaned_flat = clean_and_validate_tags_data(line)
-            serialized_line = serialize_dotted_path_dict(cleaned_flat)
-            serialized.append(serialized_line)
+    for line in read_dicts(path_csv):
+        if created_lists and 'custom_list_id' in line:
+            mailchimp_list_id = created_lists[line.pop('custom_list_id')]
+            line['list_id'] = mailchimp_list_id
+        cleaned_flat = clean_and_validate_tags_data(line)
+        serialized_line = serialize_dotted_path_dict(cleaned_flat)
+        serialized.append(serialized_line)
     return serialized
 
 
+def get_lists(client, fields=None, page_size=LISTS_PAGE_SIZE):
+    """Fetch all lists of the account, paging through them
+
+    Args:
+        fields (list): if given, only these (dotted) fields of every list are
+            requested, e.g. ['name', 'contact.city']
+
+    Returns:
+        a dict of {list_id: list}
+    """
+    queryparams = {}
+    if fields:
+        queryparams['fields'] = ','.join(
+            ['total_items', 'lists.id'] + ['lists.{}'.format(f) for f in fields])
+    lists = {}
+    while True:
+        page = client.lists.all(count=page_size, offset=len(lists), **queryparams)
+        if not page:
+            # disabled client
+            return lists
+        for mc_list in page['lists']:
+            lists[mc_list['id']] = mc_list
+        if not page['lists'] or len(lists) >= page['total_items']:
+            return lists
+
+
+def differs(existing, wanted):
+    """True if any value in `wanted` isn't the same in `existing`
+
+    Nested dicts are compared key by key, keys only present in `existing`
+    are ignored.
+    """
+    for key, value in wanted.items():
+        current = existing.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            if differs(current, value):
+                return True
+        elif current != value:
+            return True
+    return False
+
+
+def get_tag_segments(client, list_id, page_size=SEGMENTS_PAGE_SIZE):
+    """Fetch the tags of a list (its static segments), paging through them
+
+    Returns:
+        a dict of {tag name: segment id}
+    """
+    segments = {}
+    offset = 0
+    while True:
+        page = client.lists.segments.all(list_id, type='static', count=page_size,
+                                         offset=offset,
+                                         fields='total_items,segments.id,segments.name')
+        if not page:
+            # disabled client
+            return segments
+        for segment in page['segments']:
+            segments[segment['name']] = segment['id']
+        offset += len(page['segments'])
+        if not page['segments'] or offset >= page['total_items']:
+            return segments
+
+
+def get_merge_fields(client, list_id, page_size=MERGE_FIELDS_PAGE_SIZE):
+    """Fetch all merge fields of a list, paging through them
+
+    Returns:
+        a list of merge fields as returned by the API
+    """
+    merge_fields = []
+    while True:
+        page = client.lists.merge_fields.all(list_id, count=page_size,
+                                             offset=len(merge_fields))
+        if not page:
+            # disabled client
+            return merge_fields
+        merge_fields.extend(page['merge_fields'])
+        if not page['merge_fields'] or len(merge_fields) >= page['total_items']:
+            return merge_fields
+
+
+def _merge_field_changes(existing, wanted):
+    """Return the attributes of `wanted` which differ from the `existing` field"""
+    changes = {}
+    for key, value in wanted.items():
+        if key in ('tag', 'type'):
+            continue
+        if key == 'options':
+            current = existing.get('options') or {}
+            if any(current.get(k) != v for k, v in value.items()):
+                changes[key] = value
+        elif existing.get(key) != value:
+            changes[key] = value
+    return changes
+
+
+def diff_merge_fields(existing, wanted):
+    """Compare the merge fields of a list with the wanted ones
+
+    The fields are matched by their tag (case insensitive) or by their name
+    if the tag isn't given. The type of an existing merge field can't be
+    changed.
+
+    Args:
+        existing (list): merge fields of the list as returned by the API
+        wanted (list): serialized rows of add_tags.csv for the same list
+
+    Returns:
+        a tuple (to_create, to_update), to_update is a list of
+        (merge_id, {changed attributes}) tuples
+    """
+    by_tag = {field['tag'].upper(): field for field in existing if field.get('tag')}
+    by_name = {field['name']: field for field in existing}
+    to_create = []
+    to_update = []
+    for field in wanted:
+        tag = field.get('tag')
+        current = by_tag.get(tag.upper()) if tag else by_name.get(field['name'])
+        if current is None:
+            to_create.append(field)
+            continue
+        if current.get('type') != field['type']:
+            logging.warning("Merge field '%s' already exists as '%s', "
+                            "it can't be changed to '%s'",
+                            current['tag'], current.get('type'), field['type'])
+        changes = _merge_field_changes(current, field)
+        if changes:
+            # the name is mandatory in the update request
+            changes['name'] = field['name']
+            to_update.append((current['merge_id'], changes))
+    return to_create, to_update
+
+
+def prepare_batch_data_merge_fields(list_id, to_create, to_update):
+    """Prepare the batch operations creating and updating merge fields
+
+    Args:
+        list_id (str): the list the merge fields belong to
+        to_create (list), to_update (list): as returned by `diff_merge_fields`
+
+    """
+    operations = []
+    for data in to_create:
+        operations.append({
+            'method': 'POST',
+            'path': '/lists/{}/merge-fields'.format(list_id),
+            'operation_id': '{}:{}'.format(list_id, data.get('tag') or data['name']),
+            'body': json.dumps(data)})
+    for merge_id, data in to_update:
+        operations.append({
+            'method': 'PATCH',
+            'path': '/lists/{}/merge-fields/{}'.format(list_id, merge_id),
+            'operation_id': '{}:{}'.format(list_id, merge_id),
+            'body': json.dumps(data)})
+    return {'operations': operations}
+
+
 def prepare_batch_data_lists(serialized_data):
     """Prepare data for batch operation
 
@@ -181,14 +488,34 @@ def prepare_batch_data_lists(serialized_data):
 
     operations = []
 
-    for data in serialized_data:
+    for index, data in enumerate(serialized_data):
         temp = template.copy()
-        temp['operation_id'] = data['name']
+        # the index maps the results back to the lists, the names and
+        # custom_ids of different lists may be the same
+        temp['operation_id'] = str(index)
         temp['body'] = json.dumps(data)
         operations.append(temp)
 
     return {'operations': operations}
 
+def prepare_batch_data_update_lists(serialized_data):
+    """Prepare the batch operations updating existing lists
+
+    Args:
+        serialized_data (list): serialized rows of update_lists.csv, each
+            containing the `list_id`
+    """
+    operations = []
+    for data in serialized_data:
+        data = dict(data)
+        list_id = data.pop('list_id')
+        operations.append({
+            'method': 'PATCH',
+            'path': '/lists/{}'.format(list_id),
+            'operation_id': list_id,
+            'body': json.dumps(data)})
+    return {'operations': operations}
+
 def prepare_batch_data_delete_members(serialized_data):
     """Prepare data for batch operation
 
@@ -246,7 +573,7 @@ def prepare_batch_data_update_members(serialized_data):
             list_id=data.pop('list_id'),
             subscriber_hash=sub_hash)
         temp['operation_id'] = data['email_address']
-        temp['body'] = json.dumps(data)
+        temp['body'] = encode_member(data)
         operations.append(temp)
     return {'operations': operations}
 
@@ -297,11 +624,32 @@ def prepare_batch_data_add_members(serialized_data):
             list_id=data.pop('list_id'),
             subscriber_hash=sub_hash)
         temp['operation_id'] = sub_hash
-        temp['body'] = json.dumps(data)
+        temp['body'] = encode_member(data)
         operations.append(temp)
 
     return {'operations': operations}
 
+def prepare_batch_subscribe_data(serialized_data, size=SUBSCRIBE_SIZE):
+    """Prepare the requests to the list batch subscribe endpoint
+
+    The members are grouped by list into requests of at most `size` members,
+    existing members are updated.
+
+    Returns:
+        a list of (list_id, request data) tuples
+    """
+    by_list = OrderedDict()
+    for member in serialized_data:
+        data = as_dict(member)
+        data.pop('subscriber_hash', None)
+        by_list.setdefault(data.pop('list_id'), []).append(data)
+    prepared = []
+    for list_id, members in by_list.items():
+        for start in range(0, len(members), size):
+            prepared.append((list_id, {'members': members[start:start + size],
+                                       'update_existing': True}))
+    return prepared
+
 
 def _setup_client(params, enabled=True):
     """Set up mailchimp client using supplied credentials
@@ -318,7 +666,7 @@ def _setup_client(params, enabled=True):
         raise MissingFieldError(
             "Please provide your mailchimp apikey in #encrypted format")
 
-    client = MailChimp(**client_config)
+    client = instrument_client(MailChimp(**client_config))
     client = _verify_credentials(client)
     return client
 
@@ -353,37 +701,267 @@ def _retry_get_batch_status(client, batch_id, retries=5, delay=5):
             raise
         else:
             logging.info(err)
-            logging.info("Retrying attempt", retries)
-            time.sleep(delay)
+            logging.info("Retrying attempt %s", retries)
+            metrics.incr('retries.get_batch_status')
+            metrics.sleep('sleep.retry', delay)
             return _retry_get_batch_status(client=client,
                                            batch_id=batch_id,
                                            retries=retries-1,
                                            delay=delay)
 
 
+def _batch_latency(batch_status):
+    """Seconds between submitting and completing the batch"""
+    try:
+        # py3.6 strptime can't parse the colon in '+00:00'
+        submitted, completed = (
+            datetime.datetime.strptime(batch_status[field][:19], '%Y-%m-%dT%H:%M:%S')
+            for field in ('submitted_at', 'completed_at'))
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (completed - submitted).total_seconds()
+
+
+class BatchProgress(object):
+    """Progress of one running batch, estimates when it finishes
+
+    The rate of finished operations is measured between the polls which saw
+    some progress, the time the batch spent queued doesn't count.
+    """
+    def __init__(self, batch_id, clock=time.monotonic):
+        self.batch_id = batch_id
+        self.clock = clock
+        self.status = None
+        self.polls = 0
+        # (time, finished_operations) of the first and the last poll with progress
+        self._first = None
+        self._last = None
+
+    def update(self, batch_status):
+        self.status = batch_status
+        self.polls += 1
+        finished = batch_status.get('finished_operations') or 0
+        if finished:
+            self._last = (self.clock(), finished)
+            if self._first is None:
+                self._first = self._last
+
+    def rate(self):
+        """Finished operations per second, None until measured"""
+        if self._first is None:
+            return None
+        elapsed = self._last[0] - self._first[0]
+        done = self._last[1] - self._first[1]
+        if elapsed <= 0 or done <= 0:
+            return None
+        return done / elapsed
+
+    def eta(self):
+        """Estimated seconds until the batch finishes, None if unknown"""
+        if self.status is None:
+            return None
+        remaining = ((self.status.get('total_operations') or 0)
+                     - (self.status.get('finished_operations') or 0))
+        if self.status.get('status') == 'finalizing' or (
+                self.status.get('total_operations') and remaining <= 0):
+            return 0.0
+        rate = self.rate()
+        if rate is None:
+            return None
+        return remaining / rate
+
+    def next_delay(self, min_delay, max_delay=MAX_POLLING_DELAY):
+        """Seconds until the next poll
+
+        The batch is polled when it is estimated to finish. Until the rate is
+        known, the delay grows linearly with the number of polls.
+        """
+        eta = self.eta()
+        delay = min_delay * self.polls if eta is None else eta
+        return max(min_delay, min(delay, max_delay))
+
+
 def wait_for_batch_to_finish(client, batch_id, api_delay=BATCH_POLLING_DELAY):
-    batch_status = _retry_get_batch_status(client, batch_id)
-    logging.info("Waiting for batch operation %s to finish", batch_id)
-    while batch_still_pending(batch_status):
-        batch_status = _retry_get_batch_status(client, batch_id)
-        time.sleep(api_delay)
-    else:
-        logging.info("Batch %s finished.\n"
-                     "total_operations: %s\n"
-                     "erorred_opeartions: %s\n"
-                     "finished_opeartions: %s\n",
-                     batch_status['id'],
-                     batch_status['total_operations'],
-                     batch_status['errored_operations'],
-                     batch_status['finished_operations'])
+    for batch_status in wait_for_batches(client, [batch_id], api_delay):
         return batch_status
 
+
+def wait_for_batches(client, batch_ids, api_delay=BATCH_POLLING_DELAY,
+                     clock=time.monotonic, receiver=None):
+    """Wait for the batches to finish, yield their statuses as they do
+
+    Each batch is polled once right away and then whenever it is estimated to
+    finish (see `BatchProgress`), so batches that are far from done are
+    polled rarely and the ones about to finish promptly. There is no sleep
+    after the last poll.
+
+    With a `receiver` (by default the one of the running `batch_webhook`),
+    the batches it was notified about are finished without polling and the
+    others are polled only every `FALLBACK_POLLING_DELAY`.
+
+    Args:
+        api_delay (float): the shortest delay between two polls of a batch
+        receiver (BatchWebhookReceiver): the batch completion notifications
+    """
+    receiver = receiver or current_receiver()
+    due = [(clock(), i, BatchProgress(batch_id, clock))
+           for i, batch_id in enumerate(batch_ids)]
+    heapq.heapify(due)
+    if receiver is not None:
+        batch_ids = [entry[2].batch_id for entry in due]
+        receiver.expect(batch_ids)
+        try:
+            yield from _wait_for_batches(client, due, api_delay, clock, receiver)
+        finally:
+            # the polled batches and the ones left when the caller stops early
+            receiver.forget(batch_ids)
+    else:
+        yield from _wait_for_batches(client, due, api_delay, clock, receiver)
+
+
+def _wait_for_batches(client, due, api_delay, clock, receiver):
+    logging.info("Waiting for %s batch operations to finish", len(due))
+    waiting_since = time.perf_counter()
+    while due:
+        finished = []
+        if receiver is not None:
+            received = receiver.received
+            notified = [(entry, receiver.finished(entry[2].batch_id)) for entry in due]
+            notified = [(entry, status) for entry, status in notified if status is not None]
+            for entry, batch_status in notified:
+                due.remove(entry)
+                finished.append(batch_status)
+            heapq.heapify(due)
+        if not finished:
+            poll_at, i, progress = due[0]
+            delay = poll_at - clock()
+            if delay > 0 and receiver is not None:
+                with metrics.timer('sleep.batch_webhook'):
+                    receiver.wait(delay, received)
+                continue
+            if delay > 0:
+                metrics.sleep('sleep.batch_polling', delay)
+            heapq.heappop(due)
+            progress.update(_retry_get_batch_status(client, progress.batch_id))
+            metrics.incr('batches.polls')
+            batch_status = progress.status
+            if batch_still_pending(batch_status):
+                eta = progress.eta()
+                logging.info("Batch %s is %s, %s of %s operations finished, ETA %s",
+                             progress.batch_id, batch_status.get('status'),
+                             batch_status.get('finished_operations'),
+                             batch_status.get('total_operations'),
+                             'unknown' if eta is None else '{:.0f}s'.format(eta))
+                delay = progress.next_delay(api_delay)
+                if receiver is not None:
+                    delay = max(delay, FALLBACK_POLLING_DELAY)
+                heapq.heappush(due, (clock() + delay, i, progress))
+                continue
+            finished.append(batch_status)
+        for batch_status in finished:
+            now = time.perf_counter()
+            metrics.add_time('wait_for_batch', now - waiting_since)
+            waiting_since = now
+            _record_finished_batch(batch_status)
+            yield batch_status
+
+
+def _record_finished_batch(batch_status):
+    logging.info("Batch %s finished.\n"
+                 "total_operations: %s\n"
+                 "erorred_opeartions: %s\n"
+                 "finished_opeartions: %s\n",
+                 batch_status.get('id'),
+                 batch_status.get('total_operations'),
+                 batch_status.get('errored_operations'),
+                 batch_status.get('finished_operations'))
+    metrics.incr('batches.finished')
+    metrics.incr('batches.operations', batch_status.get('total_operations') or 0)
+    metrics.incr('batches.errored_operations',
+                 batch_status.get('errored_operations') or 0)
+    latency = _batch_latency(batch_status)
+    if latency is not None:
+        metrics.observe('batch.latency_seconds', latency)
+
+class BatchesCsvWriter(object):
+    """Stream finished batch statuses into a csv file
+
+    The rows are written (and flushed) one by one as the batches finish, so
+    the memory footprint doesn't grow with the number of batches and a crashed
+    run leaves the results gathered so far on disk. The file is created lazily
+    on the first row, hence no output table is created if no batch was run.
+
+    Args:
+        outpath (str): /path/to/out/tables/batches.csv. If None, the statuses
+            are only counted.
+        fieldnames (tuple): the fixed schema of the output table. Any other
+            keys of the batch status (such as `_links`) are ignored.
+    """
+    def __init__(self, outpath, fieldnames=BATCH_RESULT_FIELDS):
+        self.outpath = outpath
+        self.fieldnames = fieldnames
+        self.written = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, batch_status):
+        self.written += 1
+        if self.outpath is None:
+            return
+        if self._writer is None:
+            self._file = open(self.outpath, 'w')
+            self._writer = csv.DictWriter(self._file, self.fieldnames,
+                                          extrasaction='ignore')
+            self._writer.writeheader()
+        self._writer.writerow(batch_status)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_batch_results(batch_status, timeout=60):
+    """Download and parse the responses of a finished batch operation
+
+    Mailchimp stores the responses as a gzipped tarball of json files, each
+    containing a list of `{status_code, operation_id, response}` objects
+    where `response` is the json encoded response body.
+
+    Args:
+        batch_status (dict): as returned by `wait_for_batch_to_finish`
+
+    Yields:
+        `{status_code, operation_id, response}` dicts with `response` decoded
+    """
+    url = batch_status.get('response_body_url')
+    if not url:
+        return
+    metrics.incr('api_calls.GET batch_results')
+    resp = requests.get(url, stream=True, timeout=timeout)
+    resp.raise_for_status()
+    with tarfile.open(fileobj=resp.raw, mode='r|gz') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            for result in json.loads(archive.extractfile(member).read().decode('utf-8')):
+                try:
+                    result['response'] = json.loads(result['response'])
+                except (TypeError, ValueError):
+                    pass
+                yield result
+
+
 def write_batches_to_csv(batches, outpath, bucketname='in.c-mailchimp-writer'):
-    fieldnames = [col for col in batches[0].keys() if col != '_links']
-    with open(outpath, 'w') as f:
-        writer = csv.DictWriter(f, fieldnames)
-        writer.writeheader()
+    with BatchesCsvWriter(outpath) as writer:
         for batch in batches:
-            del batch['_links']
-            writer.writerow(batch)
+            writer.write(batch)
     return outpath
@@ -0,0 +1,222 @@
+"""Batch completion notifications through a mailchimp batch webhook
+
+Instead of polling every running batch, the writer can start a small HTTP
+receiver, register it as a batch webhook and let mailchimp notify it when a
+batch finishes. `wait_for_batches` then picks the finished batches from the
+receiver and only polls as a slow fallback (every `FALLBACK_POLLING_DELAY`),
+in case a notification gets lost. The receiver keeps only the notifications
+of the batches somebody waits for, the others are dropped (a batch finished
+before the waiting started is found by its first poll).
+
+Mailchimp must be able to reach the receiver: `url` is the public address
+forwarded to the port the receiver listens on. The webhook path contains a
+random token, requests to any other path are refused.
+
+Usage:
+    with batch_webhook(client, url='https://writer.example.com:8080', port=8080):
+        ...  # wait_for_batches uses the receiver
+"""
+from contextlib import contextmanager
+import http.server
+import json
+import logging
+import secrets
+import socketserver
+import threading
+from urllib.parse import parse_qs
+from .metrics import metrics
+
+FALLBACK_POLLING_DELAY = 300 #seconds between polls when notified by the webhook
+WEBHOOK_PATH = '/batch-webhook/{token}'
+_INTEGER_FIELDS = ('total_operations', 'finished_operations', 'errored_operations')
+
+_current = None
+
+
+def current_receiver():
+    """The receiver of the running `batch_webhook`, None outside of it"""
+    return _current
+
+
+def parse_notification(body, content_type=''):
+    """The batch status from a webhook request body, None for other events
+
+    Mailchimp posts the event form encoded ('data[id]=...'), json bodies
+    with the same structure are accepted as well. Raises ValueError for a
+    batch notification without the operation counts.
+    """
+    if 'json' in content_type:
+        event = json.loads(body)
+        if not isinstance(event, dict):
+            raise ValueError("Expected a json object, got {!r}".format(body[:100]))
+        data = event.get('data') or {}
+        event_type = event.get('type')
+    else:
+        form = parse_qs(body, keep_blank_values=True)
+        event_type = form.get('type', [None])[0]
+        data = {key[len('data['):-1]: values[0] for key, values in form.items()
+                if key.startswith('data[') and key.endswith(']')}
+    if event_type != 'batch_operation_completed' or not isinstance(data, dict) \
+            or not data.get('id'):
+        return None
+    for field in _INTEGER_FIELDS:
+        try:
+            data[field] = int(data.get(field))
+        except (TypeError, ValueError):
+            raise ValueError("The notification of batch {} has no valid '{}': {!r}".format(
+                data['id'], field, data.get(field)))
+    data.setdefault('status', 'finished')
+    return data
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class BatchWebhookReceiver(object):
+    """Collects the batch completion notifications
+
+    Args:
+        host (str): the interface to listen on
+        port (int): 0 picks a free port
+    """
+    def __init__(self, host='', port=0):
+        self.token = secrets.token_hex(16)
+        self.path = WEBHOOK_PATH.format(token=self.token)
+        self._finished = {}
+        # the batch ids somebody waits for, see `expect`
+        self._expected = set()
+        # the number of notifications received so far
+        self.received = 0
+        self._changed = threading.Condition()
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _handler(self):
+        receiver = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                # mailchimp checks the url is reachable when registering it
+                self._reply(200 if self.path == receiver.path else 404)
+
+            def do_POST(self):
+                if self.path != receiver.path:
+                    self._reply(404)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                try:
+                    batch_status = parse_notification(
+                        body, self.headers.get('Content-Type') or '')
+                except ValueError as exc:
+                    logging.warning("Ignoring an invalid batch notification: %s", exc)
+                    self._reply(400)
+                    return
+                if batch_status is not None:
+                    receiver.notify(batch_status)
+                self._reply(200)
+
+            def _reply(self, code):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug("Batch webhook: " + format, *args)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='batch-webhook')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("Listening for batch notifications on port %s", self.port)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def notify(self, batch_status):
+        metrics.incr('batches.notifications')
+        with self._changed:
+            if batch_status['id'] not in self._expected:
+                logging.debug("Dropping the notification of batch %s, nobody waits for it",
+                              batch_status['id'])
+                return
+            self._finished[batch_status['id']] = batch_status
+            self.received += 1
+            self._changed.notify_all()
+
+    def expect(self, batch_ids):
+        """Keep the notifications of `batch_ids` until they're picked up"""
+        with self._changed:
+            self._expected.update(batch_ids)
+
+    def forget(self, batch_ids):
+        """Stop keeping the notifications of `batch_ids`, drop the ones kept"""
+        with self._changed:
+            for batch_id in batch_ids:
+                self._expected.discard(batch_id)
+                self._finished.pop(batch_id, None)
+
+    def finished(self, batch_id):
+        """The status of the batch if it was notified as finished, else None"""
+        with self._changed:
+            batch_status = self._finished.pop(batch_id, None)
+            if batch_status is not None:
+                self._expected.discard(batch_id)
+            return batch_status
+
+    def wait(self, timeout, received):
+        """Wait at most `timeout` seconds for a notification
+
+        Returns right away if there were more than `received` notifications
+        already, so the ones which came after the caller checked the
+        finished batches aren't missed.
+        """
+        with self._changed:
+            if self.received != received:
+                return True
+            return self._changed.wait(timeout)
+
+
+def register(client, url):
+    """Register `url` as the batch webhook, return the webhook id"""
+    response = client._post(url='batch-webhooks', data={'url': url})
+    return response['id'] if response else None
+
+
+def unregister(client, webhook_id):
+    client._delete(url='batch-webhooks/{}'.format(webhook_id))
+
+
+@contextmanager
+def batch_webhook(client, url, port, host=''):
+    """Receive the batch notifications while inside the block
+
+    Args:
+        url (str): the public address of the receiver, without the path
+        port (int): the port to listen on
+    """
+    global _current
+    receiver = BatchWebhookReceiver(host, port)
+    receiver.start()
+    webhook_id = None
+    try:
+        webhook_id = register(client, url.rstrip('/') + receiver.path)
+        logging.info("Registered the batch webhook %s", webhook_id)
+        _current = receiver
+        yield receiver
+    finally:
+        _current = None
+        try:
+            if webhook_id is not None:
+                unregister(client, webhook_id)
+        finally:
+            receiver.stop()
@@ -9,27 +9,56 @@ import logging
 import datetime
 from pathlib import Path
 import json
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import csv
 import time
 import traceback
+import tempfile
 from pathlib import Path
 import os
 from keboola import docker
 from requests import HTTPError, RequestException
-from .exceptions import UserError, ConfigError
+from .exceptions import UserError, ConfigError, BatchOperationError
 from .cleaning import _hash_email
+from .metrics import metrics
+from .profiling import profiled
+from .webhook import batch_webhook
+from .snapshot import ListSnapshot, refresh_snapshots, member_in_sync
+from .mirror import mirror_changes, chunked
+from .planner import EnginePlanner, SERIAL, BATCH, BULK, MAX_RUNNING_BATCHES
+from .dryrun import plan_run, Throttle
+from .journal import (compile_journal, replay_journal, needs_compiling,
+                      JOURNAL_TABLES)
+from .resolver import ListResolver, LISTS_INDEX_TTL
+from .schema import MergeFieldSchemas
+from .rowsource import csv_backend, open_table
 from .utils import (serialize_lists_input,
                     serialize_members_input,
                     serialize_add_member_tags_input,
+                    serialize_member_tags_by_tag,
                     serialize_tags_input,
                     prepare_batch_data_add_members,
                     prepare_batch_data_add_member_tags,
                     prepare_batch_data_delete_members,
                     prepare_batch_data_add_member_tags,
-                    write_batches_to_csv,
+                    prepare_batch_data_lists,
+                    prepare_batch_data_update_lists,
+                    get_lists,
+                    differs,
+                    prepare_batch_data_merge_fields,
+                    get_merge_fields,
+                    get_tag_segments,
+                    diff_merge_fields,
+                    get_batch_results,
+                    BatchesCsvWriter,
                     prepare_batch_data_update_members,
+                    prepare_batch_subscribe_data,
                     _setup_client,
-                    wait_for_batch_to_finish)
+                    CHUNK_SIZE,
+                    wait_for_batch_to_finish,
+                    wait_for_batches)
 
 # valid fields for creating mailing list according to
 # https://us1.api.mailchimp.com/schema/3.0/Definitions/Lists/POST.json
@@ -41,13 +70,30 @@ FILE_ADD_MEMBER_TAGS = 'add_member_tags.csv'
 FILE_ADD_TAGS = 'add_tags.csv'
 FILE_DELETE_MEMBERS = 'delete_members.csv'
 FILE_UPDATE_MEMBERS = 'update_members.csv'
+FILE_MIRROR_MEMBERS = 'mirror_members.csv'
 PATH_OUT_BATCHES_DELETE = '/data/out/tables/delete_members_batches.csv'
 PATH_OUT_BATCHES_UPDATE = '/data/out/tables/update_members_batches.csv'
 PATH_OUT_BATCHES_ADD = '/data/out/tables/add_members_batches.csv'
-BATCH_THRESHOLD = 5 # When to switch from serial jobs to batch jobs
+PATH_OUT_BATCHES_MIRROR = '/data/out/tables/mirror_members_batches.csv'
+PATH_OUT_SUBSCRIBE_ERRORS = '/data/out/tables/add_members_errors.csv'
+PATH_OUT_TAG_ERRORS = '/data/out/tables/add_member_tags_errors.csv'
+PATH_OUT_QUARANTINE_ADD = '/data/out/tables/add_members_quarantine.csv'
+PATH_OUT_QUARANTINE_UPDATE = '/data/out/tables/update_members_quarantine.csv'
+PATH_OUT_QUARANTINE_DELETE = '/data/out/tables/delete_members_quarantine.csv'
+PATH_OUT_QUARANTINE_MIRROR = '/data/out/tables/mirror_members_quarantine.csv'
+PATH_OUT_METRICS = '/data/out/tables/writer_metrics.csv'
+PATH_OUT_PLAN = '/data/out/tables/writer_plan.csv'
+PATH_OUT_FILES = '/data/out/files'
+BATCH_THRESHOLD = 5 # When to switch from serial jobs to batch jobs, members see EnginePlanner
 BATCH_DELAY = 0.5 #seconds between submitting batches
 SEQUENTIAL_REQUEST_DELAY = 0.8 #seconds between sequential requests
-BATCH_WAIT_DELAY = 5 #seconds, there is linear growth polling implemented
+BATCH_WAIT_DELAY = 5 #seconds, the shortest polling delay, see wait_for_batches
+ENGINES = ('batches', 'subscribe', 'auto') # how add_members.csv is sent
+SUBSCRIBE_WORKERS = 4 # concurrent batch subscribe requests, mailchimp allows 10 connections
+SUBSCRIBE_ERROR_FIELDS = ('list_id', 'email_address', 'error_code', 'error')
+TAGS_ENGINES = ('batches', 'segments') # how add_member_tags.csv is sent
+TAG_ERROR_FIELDS = ('list_id', 'tag', 'email_address', 'error')
+JOURNAL_MODES = ('compile', 'replay', 'run')
 
 LISTS_VALID_FIELDS = ["name",
                       "contact.company", "contact.address1", "contact.address2",
@@ -66,7 +112,7 @@ def set_up(path_config='/data/'):
     '''
     cfg = docker.Config(path_config)
     params = cfg.get_parameters()
-    tables = [str(p) for p in Path(path_config).glob('in/tables/*.csv')]
+    tables = _find_tables(Path(path_config) / 'in' / 'tables')
     if params.get('debug'):
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -76,6 +122,16 @@ def set_up(path_config='/data/'):
     return client, params, tables
 
 
+def _find_tables(tables_dir):
+    """Paths of the input tables, `.csv.gz` tables are listed as `.csv`
+
+    Sliced tables are directories named like the table.
+    """
+    tables = set(str(p) for p in tables_dir.glob('*.csv'))
+    tables.update(str(p)[:-len('.gz')] for p in tables_dir.glob('*.csv.gz'))
+    return sorted(tables)
+
+
 def show_lists():
     """Show existing mailing lists"""
     pass
@@ -93,9 +149,10 @@ def _create_lists_serial(client, serialized_data):
         try:
             resp = client.lists.create(data=data)
             custom_id = data.get('custom_id')
-            if custom_id:
+            # None for a disabled client
+            if custom_id and resp:
                 created_lists[custom_id] = resp['id']
-            time.sleep(SEQUENTIAL_REQUEST_DELAY)
+            metrics.sleep('sleep.sequential_delay', SEQUENTIAL_REQUEST_DELAY)
         except HTTPError as exc:
             err_resp = exc.response.text
             logging.error("Error while creating request:\n"
@@ -105,74 +162,266 @@ def _create_lists_serial(client, serialized_data):
 
     return created_lists
 
+def _create_lists_in_batch(client, serialized_data):
+    """Create lists in one batch operation
+
+    The ids of the new lists are read from the batch results, the
+    operation_id of every operation is the index of the list in
+    `serialized_data`.
+
+    Returns:
+        a mapping of {custom_list_id: real_list_id} for every created list
+    """
+    logging.debug('Creating lists in batch.')
+    with metrics.timer('stage.prepare_batch'):
+        operations = prepare_batch_data_lists(serialized_data)
+    created_lists = {}
+    for result in _run_batch_operations(client, operations, 'create list'):
+        custom_id = serialized_data[int(result['operation_id'])].get('custom_id')
+        if custom_id:
+            created_lists[custom_id] = result['response']['id']
+    return created_lists
+
+
+def _run_batch_operations(client, batch_data, description):
+    """Submit a batch operation, wait for it and return its results
+
+    Args:
+        batch_data (dict): {'operations': [...]}
+        description (str): what the operations do, for the error messages
+
+    Returns:
+        a list of the results of the successful operations
+
+    Raises:
+        BatchOperationError: if any of the operations failed
+    """
+    try:
+        batch_response = client.batches.create(data=batch_data)
+        logging.debug("Got batch response: %s", batch_response)
+    except HTTPError as exc:
+        err_resp = exc.response.text
+        logging.error("Error while creating batch request:\n%s\nAborting.", err_resp)
+        raise
+    if not batch_response:
+        # a disabled client sends nothing
+        return []
+    batch_status = wait_for_batch_to_finish(client, batch_response['id'],
+                                            api_delay=SEQUENTIAL_REQUEST_DELAY)
+
+    succeeded = []
+    errors = 0
+    for result in get_batch_results(batch_status):
+        if result['status_code'] != 200:
+            errors += 1
+            logging.error("Error in operation '%s' (%s):\n%s",
+                          result['operation_id'], description, result['response'])
+        else:
+            succeeded.append(result)
+    if errors:
+        raise BatchOperationError(
+            "{} of {} operations ({}) failed, see the log for details".format(
+                errors, len(batch_data['operations']), description))
+    return succeeded
+
+
 def create_lists(client, csv_lists):
     """Create new mailing list
 
-    The reason for this wrapper function is that it is possible to create lists
-    in batch. A function once present, but removed because it is PITA to
-    retrieve the results created by the batch job and probably not worth the
-    hassle, since one is not expected to create hundreds of lists.
+    Up to BATCH_THRESHOLD lists are created one by one, more lists are
+    created in one batch operation and their ids are read from the batch
+    results.
 
     """
     serialized_data = serialize_lists_input(csv_lists)
     logging.debug("Creating %d new lists defined in %s", len(serialized_data), csv_lists)
-    created_lists = _create_lists_serial(client=client, serialized_data=serialized_data)
+    if len(serialized_data) <= BATCH_THRESHOLD:
+        created_lists = _create_lists_serial(client=client, serialized_data=serialized_data)
+    else:
+        created_lists = _create_lists_in_batch(client=client, serialized_data=serialized_data)
     logging.info("New lists created.")
     return created_lists
 
-def add_member_tags(client, path):
+def add_member_tags(client, path, outpath=None, engine='batches',
+                    errors_outpath=None):
+    """Add tags to members in batch
+
+    The results of the batch jobs are streamed into `outpath` as they finish.
+
+    Args:
+        engine (str): 'batches' sends one operation per row, 'segments'
+            bulk updates the static segments of the tags, see
+            `_add_member_tags_by_segments`
+        errors_outpath (str): where the 'segments' engine writes the
+            members refused by the API
+
+    Returns:
+        the number of finished batch jobs (or segment requests)
+    """
+    if engine not in TAGS_ENGINES:
+        raise ConfigError("Unknown tags engine '{}', use one of {}".format(
+            engine, TAGS_ENGINES))
+    if engine == 'segments':
+        return _add_member_tags_by_segments(client, path, outpath=errors_outpath)
     running_batches = []
-    completed_batches = []
     processed = 0
-    for chunk in serialize_add_member_tags_input(path):
-        batch_data = prepare_batch_data_add_member_tags(chunk)
-        no_members = len(batch_data)
-        processed += no_members
-        logging.info("So far processed %s rows", processed)
+    with BatchesCsvWriter(outpath) as batches_writer:
+        for chunk in serialize_add_member_tags_input(path):
+            with metrics.timer('stage.prepare_batch'):
+                batch_data = prepare_batch_data_add_member_tags(chunk)
+            no_members = len(chunk)
+            processed += no_members
+            metrics.incr('rows.add_member_tags', no_members)
+            logging.info("So far processed %s rows", processed)
+
+            if len(running_batches) >= 480:
+                # mailchimp limit is 500 running batches
+                # It's not the most effective in the world, but I dont fell like
+                # messing around with threads and stuff
+                # so we just wait for one particular job to finish
+                # while others might finish as well
+                logging.info("There are %s running batch jobs. We need to wait"
+                                "for some of them to finish before submitting new one",
+                                len(running_batches))
+                batch_status = wait_for_batch_to_finish(
+                    client,
+                    batch_id=running_batches.pop(0),
+                    api_delay=BATCH_WAIT_DELAY)
+                batches_writer.write(batch_status)
+            batch_response = _add_member_tags_in_batch(client, batch_data)
+            logging.info("Batch job request sent %s", batch_response)
+            running_batches.append(batch_response['id'])
+            metrics.sleep('sleep.batch_delay', BATCH_DELAY)
+
+        logging.info("Waiting for batches to finish.")
+        for batch_status in wait_for_batches(client, running_batches,
+                                             api_delay=SEQUENTIAL_REQUEST_DELAY):
+            batches_writer.write(batch_status)
+    return batches_writer.written
+
+def _add_member_tags_by_segments(client, path, outpath=None,
+                                 workers=SUBSCRIBE_WORKERS):
+    """Tag members through the static segments of the tags
+
+    A tag of a list is a static segment named after it. The rows are grouped
+    by (list, tag, status) and every group is sent as bulk requests adding
+    (or removing) up to 500 emails to the segment, instead of one operation
+    per row. The segments are looked up once per list, missing ones are
+    created. The requests are sent by `workers` threads, the members refused
+    by the API are logged and streamed into `outpath`. The adding and the
+    removing requests of a segment never run at the same time, so that the
+    statuses apply in the order of the rows.
+
+    Returns:
+        the number of requests sent
+    """
+    segments = {}
+    sent = 0
+    pending = deque()
+    # {(list_id, tag name): 'members_to_add' or 'members_to_remove'} last sent
+    actions = {}
+    with BatchesCsvWriter(outpath, fieldnames=TAG_ERROR_FIELDS) as errors_writer, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        for list_id, name, status, emails in serialize_member_tags_by_tag(path):
+            if status == 'active':
+                data = {'members_to_add': emails}
+            elif name in _list_tags(client, segments, list_id):
+                data = {'members_to_remove': emails}
+            else:
+                logging.debug("Tag %s of list %s doesn't exist, nothing to remove",
+                              name, list_id)
+                continue
+            segment_id = _tag_segment(client, segments, list_id, name)
+            action = next(iter(data))
+            if actions.setdefault((list_id, name), action) != action:
+                # wait for the requests of the other action on the segment
+                while any(tag == (list_id, name) for tag, _ in pending):
+                    _collect_segment_response(errors_writer, *pending.popleft())
+                actions[(list_id, name)] = action
+            pending.append(((list_id, name), executor.submit(
+                _segment_request, client, list_id, segment_id, data)))
+            sent += 1
+            while len(pending) > 2 * workers:
+                _collect_segment_response(errors_writer, *pending.popleft())
+        while pending:
+            _collect_segment_response(errors_writer, *pending.popleft())
+    logging.info("Sent %s tag segment requests, %s members refused",
+                 sent, errors_writer.written)
+    return sent
+
+
+def _list_tags(client, segments, list_id):
+    if list_id not in segments:
+        segments[list_id] = get_tag_segments(client, list_id)
+    return segments[list_id]
+
+
+def _tag_segment(client, segments, list_id, name):
+    """The id of the static segment of the tag, created if missing"""
+    tags = _list_tags(client, segments, list_id)
+    if name not in tags:
+        logging.info("Creating tag %s in list %s", name, list_id)
+        response = client.lists.segments.create(list_id, {'name': name,
+                                                          'static_segment': []})
+        tags[name] = response['id'] if response else None
+    return tags[name]
+
+
+def _segment_request(client, list_id, segment_id, data):
+    try:
+        return client.lists.segments.update_members(list_id, segment_id, data)
+    except HTTPError as exc:
+        logging.error("Error while tagging members of list %s:\n%s",
+                      list_id, exc.response.text)
+        raise
+
+
+def _collect_segment_response(errors_writer, tag, future):
+    list_id, name = tag
+    # None for a disabled client
+    response = future.result() or {}
+    metrics.incr('member_tags.added', response.get('total_added') or 0)
+    metrics.incr('member_tags.removed', response.get('total_removed') or 0)
+    for error in response.get('errors') or []:
+        emails = error.get('email_addresses') or []
+        metrics.incr('member_tags.errored', len(emails))
+        logging.warning("Tag %s of list %s not changed for %s members: %s",
+                        name, list_id, len(emails), error.get('error'))
+        for email in emails:
+            errors_writer.write({'list_id': list_id, 'tag': name,
+                                 'email_address': email, 'error': error.get('error')})
 
-        if len(running_batches) >= 480:
-            # mailchimp limit is 500 running batches
-            # It's not the most effective in the world, but I dont fell like
-            # messing around with threads and stuff
-            # so we just wait for one particular job to finish
-            # while others might finish as well
-            logging.info("There are %s running batch jobs. We need to wait"
-                            "for some of them to finish before submitting new one",
-                            len(running_batches))
-            wait_for_this_batch = running_batches.pop(0)
-            batch_status = wait_for_batch_to_finish(
-                client,
-                batch_id=wait_for_this_batch['id'],
-                api_delay=BATCH_WAIT_DELAY)
-            completed_batches.append(batch_status)
-        batch_response = _add_member_tags_in_batch(client, batch_data)
-        logging.info("Batch job request sent %s", batch_response)
-        running_batches.append(batch_response)
-        time.sleep(BATCH_DELAY)
-
-    # processed_batches = []
-    logging.info("Waiting for batches to finish.")
-    while running_batches:
-        batch_response = running_batches.pop()
-        # batch_response in running_batches:
-        # Wait untill all batches are finished
-        batch_status = wait_for_batch_to_finish(client, batch_id=batch_response['id'],
-                                                api_delay=SEQUENTIAL_REQUEST_DELAY)
-        completed_batches.append(batch_status)
-    return completed_batches
 
 def update_lists(client, csv_lists):
     """Update existing mailing lists
 
     the input csv file should have the same structure as for lists creation
     with an additional column `list_id` used to reference existing lists.
+
+    The current settings of all lists are read at once and only the lists
+    which differ from the csv are updated, in one batch operation if there
+    are more than BATCH_THRESHOLD of them.
     """
     serialized_data = serialize_lists_input(csv_lists)
     logging.debug("Updating %d new lists defined in %s", len(serialized_data), csv_lists)
-    _update_lists_serial(client=client, serialized_data=serialized_data)
+    existing_lists = get_lists(client, fields=LISTS_VALID_FIELDS)
+    changed = [data for data in serialized_data
+               if _list_changed(existing_lists.get(data['list_id'], {}), data)]
+    logging.info("%d of %d lists changed", len(changed), len(serialized_data))
+    metrics.incr('rows.update_lists', len(changed))
+    if 0 < len(changed) <= BATCH_THRESHOLD:
+        _update_lists_serial(client=client, serialized_data=changed)
+    elif changed:
+        with metrics.timer('stage.prepare_batch'):
+            batch_data = prepare_batch_data_update_lists(changed)
+        _run_batch_operations(client, batch_data, 'update lists')
     logging.info("Lists updated.")
 
 
+def _list_changed(existing, data):
+    return differs(existing, {k: v for k, v in data.items() if k != 'list_id'})
+
+
 def _update_lists_serial(client, serialized_data):
     for data in serialized_data:
         list_id = data.pop('list_id')
@@ -184,7 +433,7 @@ def _update_lists_serial(client, serialized_data):
                           "POST data:\n%s"
                           "Error message\n%s", data, err_resp)
             raise
-        time.sleep(0.2)
+        metrics.sleep('sleep.sequential_delay', 0.2)
 
     logging.info("")
 
@@ -193,10 +442,12 @@ def _update_members_serial(client, serialized_data):
     """Add members to list"""
     logging.debug('Updating members serially')
     for data in serialized_data:
+        list_id = data.pop('list_id')
+        subscriber_hash = data.pop('subscriber_hash')
         try:
-            client.lists.members.update(data=data,
-                                        list_id=data.pop('list_id'),
-                                        subscriber_hash=data.pop('subscriber_hash'))
+            client.lists.members.update(list_id=list_id,
+                                        subscriber_hash=subscriber_hash,
+                                        data=dict(data))
         except HTTPError as exc:
             err_resp = exc.response.text
             logging.error("Error while creating request:\n"
@@ -210,7 +461,8 @@ def _update_members_in_batch(client, serialized_data):
         datetime.datetime.now())
     logging.debug('updating members in batch mode: operation_id %s', operation_id)
 
-    operations = prepare_batch_data_update_members(serialized_data)
+    with metrics.timer('stage.prepare_batch'):
+        operations = prepare_batch_data_update_members(serialized_data)
     try:
         batch_response = client.batches.create(data=operations)
         logging.debug("Got batch response: %s", batch_response)
@@ -226,7 +478,8 @@ def _delete_members_in_batch(client, serialized_data):
         datetime.datetime.now())
     logging.debug('deleting members in batch mode: operation_id %s', operation_id)
 
-    operations = prepare_batch_data_delete_members(serialized_data)
+    with metrics.timer('stage.prepare_batch'):
+        operations = prepare_batch_data_delete_members(serialized_data)
     try:
         batch_response = client.batches.create(data=operations)
         logging.debug("Got batch response: %s", batch_response)
@@ -256,10 +509,12 @@ def _add_members_serial(client, serialized_data):
     """Add members to list"""
     logging.debug('Adding members to lists in serial.')
     for data in serialized_data:
+        list_id = data.pop('list_id')
+        subscriber_hash = data.pop('subscriber_hash')
         try:
-            client.lists.members.create_or_update(data=data,
-                                                  list_id=data.pop('list_id'),
-                                                  subscriber_hash=data.pop('subscriber_hash'))
+            client.lists.members.create_or_update(list_id=list_id,
+                                                  subscriber_hash=subscriber_hash,
+                                                  data=dict(data))
         except HTTPError as exc:
             err_resp = exc.response.text
             logging.error("Error while creating request:\n"
@@ -273,7 +528,8 @@ def _add_members_in_batch(client, serialized_data):
         datetime.datetime.now())
     logging.debug('Adding members in batch mode: operation_id %s', operation_id)
 
-    operations = prepare_batch_data_add_members(serialized_data)
+    with metrics.timer('stage.prepare_batch'):
+        operations = prepare_batch_data_add_members(serialized_data)
     try:
         batch_response = client.batches.create(data=operations)
         logging.debug("Got batch response: %s", batch_response)
@@ -302,7 +558,8 @@ def add_memebr_tags_in_batch(client, serialized_data):
 
 
 
-def delete_members(client, csv_members):
+def delete_members(client, csv_members, outpath=None, snapshots=None,
+                   created_lists=None, quarantine_outpath=None):
     """
     Delete members of given lists. Always in batch
 
@@ -314,10 +571,15 @@ def delete_members(client, csv_members):
                                           csv_members,
                                           action='delete',
                                           batch_action=_delete_members_in_batch,
-                                          batch=True)
+                                          batch=True,
+                                          created_lists=created_lists,
+                                          outpath=outpath,
+                                          snapshots=snapshots,
+                                          quarantine_outpath=quarantine_outpath)
     return batches
 
-def update_members(client, csv_members, batch=None):
+def update_members(client, csv_members, batch=None, outpath=None, snapshots=None,
+                   created_lists=None, schemas=None, quarantine_outpath=None):
     """
     Update members of given lists.
 
@@ -328,7 +590,12 @@ def update_members(client, csv_members, batch=None):
                                           csv_members,
                                           action='update',
                                           batch_action=_update_members_in_batch,
-                                          serial_action=_update_members_serial)
+                                          serial_action=_update_members_serial,
+                                          created_lists=created_lists,
+                                          outpath=outpath,
+                                          snapshots=snapshots,
+                                          schemas=schemas,
+                                          quarantine_outpath=quarantine_outpath)
 
     return batches
 
@@ -338,81 +605,343 @@ def _do_members_action_and_wait_for_batch(client,
                                           batch_action,
                                           serial_action=None,
                                           batch=None,
-                                          created_lists=None):
-    running_batches = []
-    completed_batches = []
+                                          created_lists=None,
+                                          outpath=None,
+                                          snapshots=None,
+                                          bulk=False,
+                                          errors_outpath=None,
+                                          schemas=None,
+                                          quarantine_outpath=None):
+    """Serialize the members csv in chunks and send each chunk to mailchimp
+
+    Only the ids of the running batches are kept in memory, the statuses of
+    finished batches are streamed into `outpath` (see `BatchesCsvWriter`).
+    With `snapshots` ({list_id: ListSnapshot}), members already in sync are
+    skipped. With `schemas` (MergeFieldSchemas), the merge fields are
+    validated. The rows with an invalid email address are written to
+    `quarantine_outpath` instead of being sent.
+
+    Returns:
+        the number of finished batch jobs
+    """
+    chunks = _member_chunks(csv_members, action, created_lists, snapshots, schemas,
+                            quarantine_outpath)
+    return _send_chunks_and_wait_for_batches(client, chunks,
+                                             batch_action=batch_action,
+                                             serial_action=serial_action,
+                                             batch=batch,
+                                             outpath=outpath,
+                                             bulk=bulk,
+                                             errors_outpath=errors_outpath)
+
+
+def _member_chunks(csv_members, action, created_lists=None, snapshots=None,
+                   schemas=None, quarantine_outpath=None):
+    """Yield the chunks of serialized members to send
+
+    With `snapshots` ({list_id: ListSnapshot}), members already in sync are
+    left out.
+    """
     processed = 0
     for serialized_data in serialize_members_input(csv_members,
                                                    action=action,
-                                                   created_lists=created_lists):
+                                                   created_lists=created_lists,
+                                                   schemas=schemas,
+                                                   quarantine_outpath=quarantine_outpath):
         no_members = len(serialized_data)
         processed += no_members
+        metrics.incr('rows.{}'.format(action), no_members)
         logging.info("So far processed %s rows", processed)
+        if snapshots is not None:
+            serialized_data = [member for member in serialized_data
+                               if not member_in_sync(snapshots, member, action)]
+            metrics.incr('members.in_sync', no_members - len(serialized_data))
+            if not serialized_data:
+                continue
+        yield serialized_data
 
-        if no_members <= BATCH_THRESHOLD and (batch is None or batch is False) and callable(serial_action):
-            serial_action(client, serialized_data)
-        else:
-            if len(running_batches) >= 480:
-                # mailchimp limit is 500 running batches
-                # It's not the most effective in the world, but I dont fell like
-                # messing around with threads and stuff
-                # so we just wait for one particular job to finish
-                # while others might finish as well
-                logging.info("There are %s running batch jobs. We need to wait"
-                             "for some of them to finish before submitting new one",
-                             len(running_batches))
-                wait_for_this_batch = running_batches.pop(0)
-                batch_status = wait_for_batch_to_finish(
-                    client,
-                    batch_id=wait_for_this_batch['id'],
-                    api_delay=BATCH_WAIT_DELAY)
-                completed_batches.append(batch_status)
-            batch_response = batch_action(client, serialized_data)
-            logging.info("Batch job request sent %s", batch_response)
-            running_batches.append(batch_response)
-            time.sleep(BATCH_DELAY)
-
-    # processed_batches = []
-    logging.info("Waiting for batches to finish.")
-    while running_batches:
-        batch_response = running_batches.pop()
-        # batch_response in running_batches:
-        # Wait untill all batches are finished
-        batch_status = wait_for_batch_to_finish(client, batch_id=batch_response['id'],
-                                                api_delay=SEQUENTIAL_REQUEST_DELAY)
-        completed_batches.append(batch_status)
-    return completed_batches
-
-def add_members_to_lists(client, csv_members, batch=None, created_lists=None):
+
+def _send_chunks_and_wait_for_batches(client, chunks, batch_action,
+                                      serial_action=None, batch=None,
+                                      outpath=None, bulk=False,
+                                      errors_outpath=None):
+    """Send every chunk serially, as a batch or in bulk and wait for the batches
+
+    The strategy is picked for the members of every list of a chunk by the
+    `EnginePlanner`, from the latencies observed so far and the number of
+    running batches. With `batch` set, everything is sent in batches.
+
+    Args:
+        bulk (bool): the members may be sent through the list batch
+            subscribe endpoint, the refused ones are written to
+            `errors_outpath`
+
+    Returns:
+        the number of finished batch jobs
+    """
+    if batch or not callable(serial_action):
+        strategies = (BATCH, )
+    else:
+        strategies = (SERIAL, BATCH)
+    if bulk:
+        strategies += (BULK, )
+    planner = EnginePlanner(strategies, batch_delay=BATCH_DELAY)
+    running_batches = []
+    with BatchesCsvWriter(outpath) as batches_writer, \
+            BatchesCsvWriter(errors_outpath, fieldnames=SUBSCRIBE_ERROR_FIELDS) as errors_writer:
+        for serialized_data in chunks:
+            for strategy, members in planner.plan(serialized_data,
+                                                  running=len(running_batches)):
+                if strategy == BATCH and len(running_batches) >= MAX_RUNNING_BATCHES:
+                    # mailchimp limit is 500 running batches
+                    # It's not the most effective in the world, but I dont fell like
+                    # messing around with threads and stuff
+                    # so we just wait for one particular job to finish
+                    # while others might finish as well
+                    logging.info("There are %s running batch jobs. We need to wait"
+                                 "for some of them to finish before submitting new one",
+                                 len(running_batches))
+                    batch_status = wait_for_batch_to_finish(
+                        client,
+                        batch_id=running_batches.pop(0),
+                        api_delay=BATCH_WAIT_DELAY)
+                    batches_writer.write(batch_status)
+                prepared = metrics.timers.get('stage.prepare_batch', 0.0)
+                start = time.perf_counter()
+                if strategy == SERIAL:
+                    serial_action(client, members)
+                elif strategy == BULK:
+                    _subscribe_chunk(client, members, errors_writer)
+                else:
+                    batch_response = batch_action(client, members)
+                    logging.info("Batch job request sent %s", batch_response)
+                    running_batches.append(batch_response['id'])
+                # only the requests, not the preparation of their data
+                seconds = time.perf_counter() - start - (
+                    metrics.timers.get('stage.prepare_batch', 0.0) - prepared)
+                planner.observe(strategy, len(members), seconds)
+                if strategy == BATCH:
+                    metrics.sleep('sleep.batch_delay', BATCH_DELAY)
+
+        logging.info("Waiting for batches to finish.")
+        for batch_status in wait_for_batches(client, running_batches,
+                                             api_delay=SEQUENTIAL_REQUEST_DELAY):
+            batches_writer.write(batch_status)
+    return batches_writer.written
+
+def mirror_members(client, csv_members, created_lists=None, outpath=None,
+                   schemas=None, quarantine_outpath=None):
+    """Make the lists in the csv contain exactly the members of the csv
+
+    The csv has the same structure as add_members.csv. Members missing in
+    mailchimp are added, changed members are updated and members of the
+    lists which aren't in the csv are deleted, see `mcwriter.mirror`.
+    """
+    logging.info("Mirroring members of the lists in %s", csv_members)
+
+    def chunks(tmpdir):
+        desired = serialize_members_input(csv_members, action='add_or_update',
+                                          created_lists=created_lists,
+                                          schemas=schemas,
+                                          quarantine_outpath=quarantine_outpath)
+        for chunk in chunked(mirror_changes(client, desired, tmpdir), CHUNK_SIZE):
+            for action, _ in chunk:
+                metrics.incr('mirror.{}'.format(action))
+            yield chunk
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        return _send_chunks_and_wait_for_batches(client, chunks(tmpdir),
+                                                 batch_action=_mirror_members_in_batch,
+                                                 batch=True,
+                                                 outpath=outpath)
+
+
+def _mirror_members_in_batch(client, changes):
+    """Send (action, member) changes of all kinds as one batch"""
+    by_action = {'add_or_update': [], 'update': [], 'delete': []}
+    for action, member in changes:
+        by_action[action].append(member)
+    with metrics.timer('stage.prepare_batch'):
+        operations = (
+            prepare_batch_data_add_members(by_action['add_or_update'])['operations'] +
+            prepare_batch_data_update_members(by_action['update'])['operations'] +
+            prepare_batch_data_delete_members(by_action['delete'])['operations'])
+    try:
+        batch_response = client.batches.create(data={'operations': operations})
+        logging.debug("Got batch response: %s", batch_response)
+    except HTTPError as exc:
+        err_resp = exc.response.text
+        logging.error("Error while creating batch request:\n%s\nAborting.", err_resp)
+        raise
+    else:
+        return batch_response
+
+
+def add_members_to_lists(client, csv_members, batch=None, created_lists=None,
+                         outpath=None, snapshots=None, engine='batches',
+                         errors_outpath=None, schemas=None, quarantine_outpath=None):
     """Add members to list. Update if they are already there.
 
     Parse data from csv (default /data/in/tables/add_members.csv)
+
+    Args:
+        engine (str): 'batches' sends the chunks as batch operations (or
+            serially if that's estimated to be faster), 'subscribe' through
+            the list batch subscribe endpoint, see `_subscribe_members`,
+            'auto' picks any of them for every chunk and list, see
+            `EnginePlanner`
+        errors_outpath (str): where the 'subscribe' and 'auto' engines write
+            the members refused by the API
+        schemas (MergeFieldSchemas): validate the merge fields locally
+        quarantine_outpath (str): where the rows with an invalid email
+            address are written, they aren't sent
     """
+    if engine not in ENGINES:
+        raise ConfigError("Unknown engine '{}', use one of {}".format(engine, ENGINES))
     logging.info("Adding members to list as described in %s", csv_members)
+    if engine == 'subscribe':
+        chunks = _member_chunks(csv_members, 'add_or_update', created_lists, snapshots,
+                                schemas, quarantine_outpath)
+        return _subscribe_members(client, chunks, outpath=errors_outpath)
     batches = _do_members_action_and_wait_for_batch(client,
                                                     csv_members,
                                                     action='add_or_update',
                                                     created_lists=created_lists,
                                                     serial_action=_add_members_serial,
-                                                    batch_action=_add_members_in_batch)
+                                                    batch_action=_add_members_in_batch,
+                                                    outpath=outpath,
+                                                    snapshots=snapshots,
+                                                    bulk=engine == 'auto',
+                                                    errors_outpath=errors_outpath,
+                                                    schemas=schemas,
+                                                    quarantine_outpath=quarantine_outpath)
     return batches
 
 
+def _subscribe_members(client, chunks, outpath=None, workers=SUBSCRIBE_WORKERS):
+    """Add or update members through the list batch subscribe endpoint
+
+    Unlike the batch operations, the requests are synchronous, there is no
+    queue to wait in and nothing to poll. The members of every chunk are
+    grouped by list (see `prepare_batch_subscribe_data`) and the requests are
+    sent by `workers` threads. The members refused by the API are logged and
+    streamed into `outpath`.
+
+    Returns:
+        the number of requests sent
+    """
+    sent = 0
+    pending = deque()
+    with BatchesCsvWriter(outpath, fieldnames=SUBSCRIBE_ERROR_FIELDS) as errors_writer, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks:
+            with metrics.timer('stage.prepare_batch'):
+                prepared = prepare_batch_subscribe_data(chunk)
+            for list_id, data in prepared:
+                pending.append((list_id, executor.submit(_subscribe_request,
+                                                         client, list_id, data)))
+                sent += 1
+            # keep the prepared requests in memory bounded
+            while len(pending) > 2 * workers:
+                _collect_subscribe_response(errors_writer, *pending.popleft())
+        while pending:
+            _collect_subscribe_response(errors_writer, *pending.popleft())
+    logging.info("Sent %s batch subscribe requests, %s members refused",
+                 sent, errors_writer.written)
+    return sent
+
+
+def _subscribe_request(client, list_id, data):
+    try:
+        return client.lists.update_members(list_id=list_id, data=data)
+    except HTTPError as exc:
+        logging.error("Error while batch subscribing %s members to list %s:\n%s",
+                      len(data['members']), list_id, exc.response.text)
+        raise
+
+
+def _subscribe_chunk(client, members, errors_writer):
+    """Send the members of a chunk through the list batch subscribe endpoint"""
+    with metrics.timer('stage.prepare_batch'):
+        prepared = prepare_batch_subscribe_data(members)
+    for list_id, data in prepared:
+        _record_subscribe_response(errors_writer, list_id,
+                                   _subscribe_request(client, list_id, data))
+
+
+def _collect_subscribe_response(errors_writer, list_id, future):
+    _record_subscribe_response(errors_writer, list_id, future.result())
+
+
+def _record_subscribe_response(errors_writer, list_id, response):
+    # None for a disabled client
+    response = response or {}
+    metrics.incr('members.created', response.get('total_created') or 0)
+    metrics.incr('members.updated', response.get('total_updated') or 0)
+    errors = response.get('errors') or []
+    metrics.incr('members.errored', len(errors))
+    for error in errors:
+        logging.warning("Member %s not added to list %s: %s",
+                        error.get('email_address'), list_id, error.get('error'))
+        errors_writer.write(dict(error, list_id=list_id))
+
+
 def create_tags(client, csv_tags, created_lists=None):
+    """Create or update the merge fields described in add_tags.csv
+
+    The existing merge fields of every list are fetched once and compared
+    with the csv; only the missing or changed merge fields are sent, in one
+    batch operation across all the lists (or serially for up to
+    BATCH_THRESHOLD operations). Running it again is a no-op.
+    """
     serialized_tags = serialize_tags_input(csv_tags, created_lists=created_lists)
     logging.info("Adding %s tags to lists", len(serialized_tags))
+    tags_by_list = OrderedDict()
     for tag in serialized_tags:
         # at this point we need th real list id
-        list_id = tag.pop('list_id')
-        client.lists.merge_fields.create(list_id, tag)
+        tags_by_list.setdefault(tag.pop('list_id'), []).append(tag)
+
+    changes = []
+    operations = []
+    for list_id, wanted in tags_by_list.items():
+        to_create, to_update = diff_merge_fields(get_merge_fields(client, list_id), wanted)
+        logging.info("List %s: %s tags to create, %s to update, %s up to date",
+                     list_id, len(to_create), len(to_update),
+                     len(wanted) - len(to_create) - len(to_update))
+        changes.append((list_id, to_create, to_update))
+        operations.extend(
+            prepare_batch_data_merge_fields(list_id, to_create, to_update)['operations'])
+    metrics.incr('rows.create_tags', len(operations))
+
+    if not operations:
+        logging.info("All tags are up to date.")
+        return
+    if len(operations) <= BATCH_THRESHOLD:
+        _create_tags_serial(client, changes)
+    else:
+        _run_batch_operations(client, {'operations': operations}, 'create tags')
     logging.info("Tags created.")
 
 
+def _create_tags_serial(client, changes):
+    for list_id, to_create, to_update in changes:
+        calls = [(client.lists.merge_fields.create, (list_id, data))
+                 for data in to_create]
+        calls.extend((client.lists.merge_fields.update, (list_id, merge_id, data))
+                        for merge_id, data in to_update)
+        for method, args in calls:
+            try:
+                method(*args)
+                metrics.sleep('sleep.sequential_delay', SEQUENTIAL_REQUEST_DELAY)
+            except HTTPError as exc:
+                logging.error("Error while creating tag in list %s:\n%s\n%s",
+                              list_id, args[-1], exc.response.text)
+                raise
+
+
 def run_update_lists(client, csv_lists):
     """Run the writer only updating tables
 
-    The reason for the wrapper function is that sometimes in the future we
-    might want to implement batch updating of lists
     Args:
         client: a mailchimp3.MailChimp instance
         csv_lists: path/to/update_lists.csv
@@ -424,7 +953,15 @@ def run():
     try:
         datadir = os.getenv("KBC_DATADIR")
         client, params, tables = set_up(path_config=datadir)
-        run_writer(client, params, tables, datadir=datadir)
+        try:
+            with metrics.timer('run_writer'), profiled(params.get('profile'),
+                                                       PATH_OUT_FILES), \
+                    csv_backend(params.get('csv_backend')), \
+                    _batch_notifications(client, None if params.get('plan')
+                                         else params.get('batch_webhook')):
+                run_writer(client, params, tables, datadir=datadir)
+        finally:
+            _write_metrics(PATH_OUT_METRICS)
     except (UserError, RequestException) as err:
         print(err, file=sys.stderr)
         sys.exit(1)
@@ -434,6 +971,69 @@ def run():
         sys.exit(2)
 
 
+@contextmanager
+def _batch_notifications(client, config):
+    """Receive the batch notifications if the `batch_webhook` parameter is set"""
+    if not config:
+        yield None
+        return
+    try:
+        url, port = config['url'], int(config['port'])
+    except (KeyError, TypeError, ValueError):
+        raise ConfigError("The batch_webhook parameter needs the public 'url' "
+                          "of the writer and the 'port' to listen on")
+    with batch_webhook(client, url, port) as receiver:
+        yield receiver
+
+
+def _write_metrics(outpath):
+    """Write the run metrics table, even for failed runs
+
+    Never raise from here, it would shadow the actual error of the run.
+    """
+    try:
+        metrics.log()
+        metrics.write_csv(outpath)
+    except Exception:
+        logging.exception("Couldn't write the writer metrics to %s", outpath)
+
+
+def _refresh_snapshots(client, members_tables, created_lists, datadir, lists=None):
+    """Snapshot the lists referenced in the members tables
+
+    The lists created in this run are empty and are not exported.
+
+    Args:
+        lists (ListResolver): resolves custom_list_id, by default only to the
+            lists created in this run
+    """
+    if lists is None:
+        lists = created_lists
+    list_ids = set()
+    for path in members_tables:
+        with open_table(path) as rows:
+            # only the list columns are decoded
+            columns = [name for name in ('list_id', 'custom_list_id')
+                       if name in rows.index]
+            list_id = columns.index('list_id') if 'list_id' in columns else None
+            custom_list_id = (columns.index('custom_list_id')
+                              if 'custom_list_id' in columns else None)
+            for batch in rows.batches(CHUNK_SIZE, columns=columns):
+                for row in batch:
+                    if list_id is not None and row[list_id]:
+                        list_ids.add(row[list_id])
+                    elif custom_list_id is not None and row[custom_list_id] in lists:
+                        list_ids.add(lists[row[custom_list_id]])
+    new_lists = set(created_lists.values())
+    with metrics.timer('stage.snapshot'):
+        snapshots = refresh_snapshots(client, list_ids - new_lists,
+                                      indir=os.path.join(datadir, 'in/files'),
+                                      outdir=os.path.join(datadir, 'out/files'))
+    for list_id in new_lists:
+        snapshots[list_id] = ListSnapshot(list_id)
+    return snapshots
+
+
 def run_writer(client, params, tables, datadir):
     """Analyze which tables are defined and act accordingly
 
@@ -469,6 +1069,7 @@ def run_writer(client, params, tables, datadir):
     path_add_tags = os.path.join(datadir, 'in/tables', FILE_ADD_TAGS)
     path_delete_members = os.path.join(datadir, 'in/tables', FILE_DELETE_MEMBERS)
     path_add_member_tags = os.path.join(datadir, 'in/tables', FILE_ADD_MEMBER_TAGS)
+    path_mirror_members = os.path.join(datadir, 'in/tables', FILE_MIRROR_MEMBERS)
 
     created_lists = {}
     #1. update_lists.csv
@@ -478,27 +1079,138 @@ def run_writer(client, params, tables, datadir):
 
     if len(tablenames) == 0:
         raise ConfigError("No input tables specified!")
-
-    if path_add_member_tags in tablenames:
-        add_member_tags(client, path_add_member_tags)
+    engine = params.get('engine', 'batches')
+    if engine not in ENGINES:
+        raise ConfigError("Unknown engine '{}', use one of {}".format(engine, ENGINES))
+    tags_engine = params.get('tags_engine', 'batches')
+    if tags_engine not in TAGS_ENGINES:
+        raise ConfigError("Unknown tags engine '{}', use one of {}".format(
+            tags_engine, TAGS_ENGINES))
+    journal = params.get('journal')
+    if journal is not None and journal not in JOURNAL_MODES:
+        raise ConfigError("Unknown journal mode '{}', use one of {}".format(
+            journal, JOURNAL_MODES))
+    journal_path = params.get('journal_path') or os.path.join(datadir, 'out/files/journal')
+    if journal is not None:
+        ignored = ['{}={}'.format(name, json.dumps(params[name]))
+                   for name, default in (('engine', 'batches'), ('tags_engine', 'batches'),
+                                         ('snapshot', False))
+                   if params.get(name, default) != default]
+        if ignored:
+            logging.warning("The journal sends only batch operations, ignoring %s",
+                            ', '.join(ignored))
+    if journal in ('compile', 'replay'):
+        skipped = [os.path.basename(path) for path in (
+            path_update_lists, path_new_lists, path_add_tags, path_mirror_members)
+                   if path in tablenames]
+        if skipped:
+            raise ConfigError("The journal mode '{}' handles only the tables {}, "
+                              "process {} without the journal or in the 'run' "
+                              "mode".format(journal, JOURNAL_TABLES, skipped))
+    # the tables sent through the journal, in the order of a run
+    journal_tables = [(table, path) for table, path in (
+        ('add_member_tags', path_add_member_tags),
+        ('add_members', path_add_members),
+        ('update_members', path_update_members),
+        ('delete_members', path_delete_members)) if path in tablenames]
+    lists = ListResolver(client, datadir=datadir,
+                         ttl=params.get('lists_index_ttl', LISTS_INDEX_TTL))
+    schemas = MergeFieldSchemas(client) if params.get('validate_merge_fields') else None
+    journal_outpaths = {'add_members': PATH_OUT_BATCHES_ADD,
+                        'update_members': PATH_OUT_BATCHES_UPDATE,
+                        'delete_members': PATH_OUT_BATCHES_DELETE}
+    quarantine_outpaths = {'add_members': PATH_OUT_QUARANTINE_ADD,
+                           'update_members': PATH_OUT_QUARANTINE_UPDATE,
+                           'delete_members': PATH_OUT_QUARANTINE_DELETE}
+
+    if params.get('plan'):
+        tables_in_order = [('add_member_tags', path_add_member_tags),
+                           ('update_lists', path_update_lists),
+                           ('new_lists', path_new_lists),
+                           ('add_tags', path_add_tags),
+                           ('add_members', path_add_members),
+                           ('update_members', path_update_members),
+                           ('delete_members', path_delete_members),
+                           ('mirror_members', path_mirror_members)]
+        plan_run([(action, path) for action, path in tables_in_order
+                  if path in tablenames],
+                 throttle=Throttle(batch_delay=BATCH_DELAY,
+                                   sequential_delay=SEQUENTIAL_REQUEST_DELAY,
+                                   polling_delay=SEQUENTIAL_REQUEST_DELAY,
+                                   subscribe_workers=SUBSCRIBE_WORKERS,
+                                   batch_threshold=BATCH_THRESHOLD),
+                 engine=engine, tags_engine=tags_engine,
+                 notified=bool(params.get('batch_webhook')),
+                 outpath=PATH_OUT_PLAN,
+                 lists=lists)
+        lists.save()
+        logging.info("Planned the run, nothing was sent")
+        return
+    if journal == 'compile':
+        compile_journal(journal_path, journal_tables, created_lists=lists,
+                        schemas=schemas, quarantine_outpaths=quarantine_outpaths)
+        lists.save()
+        logging.info("Compiled the journal, nothing was sent")
+        return
+    if journal == 'replay':
+        replay_journal(client, journal_path, outpaths=journal_outpaths,
+                       polling_delay=BATCH_WAIT_DELAY, api_delay=SEQUENTIAL_REQUEST_DELAY)
+        lists.save()
+        return
+    if path_add_member_tags in tablenames and journal is None:
+        add_member_tags(client, path_add_member_tags, engine=tags_engine,
+                        errors_outpath=PATH_OUT_TAG_ERRORS)
     if path_update_lists in tablenames:
         update_lists(client, csv_lists=path_update_lists)
     if path_new_lists in tablenames:
         created_lists = create_lists(client, csv_lists=path_new_lists)
+        lists.add_created(created_lists)
     if path_add_tags in tablenames:
-        create_tags(client, csv_tags=path_add_tags, created_lists=created_lists)
-    if path_add_members in tablenames:
-        batches = add_members_to_lists(client=client, csv_members=path_add_members,
-                                       created_lists=created_lists)
-        if batches:
-            write_batches_to_csv(batches, PATH_OUT_BATCHES_ADD)
-    if path_update_members in tablenames:
-        batches = update_members(client, csv_members=path_update_members)
-        if batches:
-            write_batches_to_csv(batches, PATH_OUT_BATCHES_UPDATE)
-
-    if path_delete_members in tablenames:
-        batches = delete_members(client, csv_members=path_delete_members)
-        if batches:
-            write_batches_to_csv(batches, PATH_OUT_BATCHES_DELETE)
+        create_tags(client, csv_tags=path_add_tags, created_lists=lists)
+    snapshots = None
+    if params.get('snapshot') and not journal:
+        # the journal is compiled offline, without the snapshots
+        members_tables = [path for path in (path_add_members, path_update_members,
+                                            path_delete_members)
+                          if path in tablenames]
+        snapshots = _refresh_snapshots(client, members_tables, created_lists, datadir,
+                                       lists=lists)
+    if journal == 'run':
+        # a journal compiled by a crashed run is replayed, not compiled again
+        if needs_compiling(journal_path, journal_tables):
+            compile_journal(journal_path, journal_tables, created_lists=lists,
+                            schemas=schemas, quarantine_outpaths=quarantine_outpaths)
+        replay_journal(client, journal_path, outpaths=journal_outpaths,
+                       polling_delay=BATCH_WAIT_DELAY, api_delay=SEQUENTIAL_REQUEST_DELAY)
+    if path_add_members in tablenames and not journal:
+        add_members_to_lists(client=client, csv_members=path_add_members,
+                             created_lists=lists,
+                             outpath=PATH_OUT_BATCHES_ADD,
+                             snapshots=snapshots,
+                             engine=engine,
+                             errors_outpath=PATH_OUT_SUBSCRIBE_ERRORS,
+                             schemas=schemas,
+                             quarantine_outpath=PATH_OUT_QUARANTINE_ADD)
+    if path_update_members in tablenames and not journal:
+        update_members(client, csv_members=path_update_members,
+                       created_lists=lists,
+                       outpath=PATH_OUT_BATCHES_UPDATE,
+                       snapshots=snapshots,
+                       schemas=schemas,
+                       quarantine_outpath=PATH_OUT_QUARANTINE_UPDATE)
+
+    if path_delete_members in tablenames and not journal:
+        delete_members(client, csv_members=path_delete_members,
+                       created_lists=lists,
+                       outpath=PATH_OUT_BATCHES_DELETE,
+                       snapshots=snapshots,
+                       quarantine_outpath=PATH_OUT_QUARANTINE_DELETE)
+    if path_mirror_members in tablenames:
+        mirror_members(client, csv_members=path_mirror_members,
+                       created_lists=lists,
+                       outpath=PATH_OUT_BATCHES_MIRROR,
+                       schemas=schemas,
+                       quarantine_outpath=PATH_OUT_QUARANTINE_MIRROR)
+    # without an output state, the next run would forget the custom ids
+    lists.save()
     logging.info("Writer finished")
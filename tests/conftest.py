@@ -1,5 +1,9 @@
 import pytest
 from tempfile import NamedTemporaryFile
+from unittest.mock import Mock
+import io
+import json
+import tarfile
 import mailchimp3
 
 
@@ -31,6 +35,21 @@ def client(monkeypatch):
     return client
 
 
+@pytest.fixture
+def batch_results_response():
+    """Make a fake requests response streaming a mailchimp batch results tarball"""
+    def make(results):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+            payload = json.dumps(results).encode('utf-8')
+            info = tarfile.TarInfo('a3bb03520b.json')
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+        buffer.seek(0)
+        return Mock(raw=buffer, raise_for_status=Mock())
+    return make
+
+
 @pytest.fixture
 def new_members_csv():
     inputs = NamedTemporaryFile(delete=False)
@@ -0,0 +1,53 @@
+from benchmarks.fake_mailchimp import FakeMailchimp
+from benchmarks.micro import compare
+from benchmarks.run_writer import parse_args, run_one
+
+NO_DELAYS = ['--set', 'BATCH_DELAY=0', '--set', 'BATCH_WAIT_DELAY=0',
+             '--set', 'SEQUENTIAL_REQUEST_DELAY=0']
+
+
+def test_running_the_writer_against_the_fake_api():
+    # enough members not to go serially
+    args = parse_args(['--rows', '300', '--lists', '2'] + NO_DELAYS)
+    result = run_one(300, args)
+    assert result['error'] is None
+    assert result['rows'] == 300
+    assert result['api_calls']['POST /batches'] >= 1
+    assert result['throttled'] == 0
+
+
+def test_throttled_requests_are_counted():
+    args = parse_args(['--rows', '20', '--throttle-rate', '1'] + NO_DELAYS)
+    result = run_one(20, args)
+    # the writer doesn't retry the 429s, the run fails
+    assert result['error']
+    assert result['throttled'] >= 1
+
+
+def test_fake_api_serves_batch_subscribe_and_segments():
+    with FakeMailchimp() as server:
+        client = server.client()
+        list_id = client._post(url=client.base_url + 'lists', data={'name': 'x'})['id']
+        response = client.lists.update_members(list_id=list_id, data={
+            'members': [{'email_address': 'a@b.cz', 'status_if_new': 'subscribed'}],
+            'update_existing': True})
+        assert response['total_created'] == 1
+
+        segment = client.lists.segments.create(list_id, {'name': 'VIP',
+                                                         'static_segment': []})
+        response = client.lists.segments.update_members(
+            list_id, segment['id'], {'members_to_add': ['a@b.cz', 'no@b.cz']})
+        assert response['total_added'] == 1
+        assert response['errors'][0]['email_addresses'] == ['no@b.cz']
+        segments = client.lists.segments.all(list_id, type='static')['segments']
+        assert [(s['name'], s['member_count']) for s in segments] == [('VIP', 1)]
+
+
+def test_micro_comparison_flags_slower_stages_and_more_allocations():
+    baseline = {'narrow/a': {'ns_per_row': 100, 'bytes_per_row': 100, 'calibration_ns': 1},
+                'narrow/b': {'ns_per_row': 100, 'bytes_per_row': 100, 'calibration_ns': 1}}
+    results = {'narrow/a': {'ns_per_row': 200, 'bytes_per_row': 100, 'calibration_ns': 1},
+               'narrow/b': {'ns_per_row': 100, 'bytes_per_row': 200, 'calibration_ns': 1}}
+    assert compare(results, baseline, tolerance=1.5) == ['narrow/a', 'narrow/b']
+    assert compare(results, baseline, tolerance=3, alloc_tolerance=1.5) == ['narrow/b']
+    assert compare(results, {}, tolerance=1.5) == []
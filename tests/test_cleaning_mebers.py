@@ -5,7 +5,11 @@ from mcwriter.cleaning import (_clean_mandatory_custom_fields,
                                clean_and_validate_members_data,
                                _clean_members_interests,
                                _clean_exclusive_fields,
-                               _clean_members_merge_fields)
+                               _clean_members_merge_fields,
+                               clean_and_validate_members_columns,
+                               normalize_email,
+                               _hash_email,
+                               rows_to_columns)
 
 def test_cleaning_mandatory_custom_fields_raises_if_not_present():
     data = {
@@ -175,3 +179,58 @@ def test_providing_custom_list_id_and_list_id_raises():
     exclusive_fields = {'custom_list_id', 'list_id'}
     with pytest.raises(CleaningError):
         _clean_exclusive_fields(data, exclusive_fields)
+
+
+def test_cleaning_members_columns_matches_rows():
+    header = ('email_address', 'list_id', 'status', 'status_if_new', 'vip',
+              'language', 'interests__abc1234')
+    rows = [('Robin@example.com', '12345', 'subscribed', 'subscribed', 'TRUE',
+             None, 'false'),
+            ('foo@bar.com', '12345', 'pending', 'subscribed', None, 'en', 'true')]
+    keys, cleaned = clean_and_validate_members_columns(
+        rows_to_columns(header, rows), 'add_or_update')
+    assert [dict(zip(keys, row)) for row in cleaned] == [
+        clean_and_validate_members_data(dict(zip(header, row))) for row in rows]
+
+
+def test_cleaning_members_columns_reports_the_row():
+    header = ('email_address', 'list_id', 'status_if_new', 'vip')
+    rows = [('a@example.com', '1', 'subscribed', 'true'),
+            ('b@example.com', '1', 'subscribed', 'maybe')]
+    with pytest.raises(CleaningError) as excinfo:
+        clean_and_validate_members_columns(rows_to_columns(header, rows),
+                                           'add_or_update', offset=500)
+    assert 'maybe' in str(excinfo.value)
+    assert 'row 501' in str(excinfo.value)
+
+
+def test_cleaning_members_columns_requires_status_if_new_when_adding():
+    header = ('email_address', 'list_id')
+    columns = rows_to_columns(header, [('a@example.com', '1')])
+    with pytest.raises(MissingFieldError):
+        clean_and_validate_members_columns(dict(columns), 'add_or_update')
+    keys, cleaned = clean_and_validate_members_columns(columns, 'delete')
+    assert keys == header + ('subscriber_hash', )
+
+
+def test_normalizing_emails():
+    assert normalize_email(' Robin@Example.COM\t') == 'Robin@example.com'
+    assert normalize_email('robin@bücher.de') == 'robin@xn--bcher-kva.de'
+    assert _hash_email(' Robin@Example.com') == _hash_email('robin@example.com')
+
+
+def test_cleaning_members_columns_quarantines_invalid_emails():
+    header = ('email_address', 'list_id', 'status_if_new')
+    rows = [(' Robin@Example.com ', '1', 'subscribed'),
+            ('robin.example.com', '1', 'subscribed'),
+            ('robin@bücher.de', '2', 'subscribed'),
+            ('robin@@example.com', '2', 'subscribed')]
+    quarantined = []
+    keys, cleaned = clean_and_validate_members_columns(
+        rows_to_columns(header, rows), 'add_or_update', offset=500,
+        quarantined=quarantined)
+    members = [dict(zip(keys, row)) for row in cleaned]
+    assert [m['email_address'] for m in members] == ['Robin@example.com',
+                                                     'robin@xn--bcher-kva.de']
+    assert members[0]['subscriber_hash'] == _hash_email('robin@example.com')
+    assert [(q['row'], q['list_id']) for q in quarantined] == [(501, '1'), (503, '2')]
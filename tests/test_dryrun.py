@@ -0,0 +1,59 @@
+import csv
+from unittest.mock import Mock
+from mcwriter.dryrun import Throttle, estimate_polls, plan_run
+from mcwriter.resolver import ListResolver
+
+THROTTLE = Throttle(batch_delay=0.5, sequential_delay=0.8, polling_delay=0.8,
+                    subscribe_workers=4, batch_threshold=5)
+HEADER = 'email_address,list_id,status,status_if_new\n'
+
+
+def test_estimate_polls():
+    assert estimate_polls(0, 0.8) == 1
+    # 0.8, 1.6, 2.4, ... until a minute passed
+    assert estimate_polls(60, 0.8) == 13
+    assert estimate_polls(600, 0.8, notified=True) == 3
+
+
+def test_plan_counts_operations_without_sending(new_members_csv, tmpdir):
+    add_members = tmpdir.join('add_members.csv')
+    add_members.write(HEADER + ''.join(
+        'member{}@example.com,{},subscribed,subscribed\n'.format(i, list_id)
+        for list_id, count in (('abc', 1000), ('def', 2)) for i in range(count)))
+    outpath = tmpdir.join('writer_plan.csv')
+
+    rows = plan_run([('add_members', add_members.strpath),
+                     ('update_members', new_members_csv.name)],
+                    THROTTLE, outpath=outpath.strpath)
+
+    by_list = {(row['table'], row['list_id']): row for row in rows}
+    assert by_list[('add_members', 'abc')]['operations'] == 1000
+    assert by_list[('add_members', 'def')]['operations'] == 2
+    add_members_total = by_list[('add_members', '')]
+    # the big list goes in batches of 500 rows, the small one serially
+    assert add_members_total['batches'] == 2
+    assert add_members_total['serial_requests'] == 2
+    assert add_members_total['polls'] >= 2
+    assert by_list[('update_members', '')]['serial_requests'] == 2
+    total = rows[-1]
+    assert total['table'] == 'total'
+    assert total['operations'] == 1004
+    assert total['seconds'] > 60
+    with open(outpath.strpath) as f:
+        assert len(list(csv.DictReader(f))) == len(rows)
+
+
+def test_plan_resolves_custom_list_ids_without_fetching(tmpdir):
+    update_members = tmpdir.join('update_members.csv')
+    update_members.write('email_address,custom_list_id,status\n'
+                         'robin@keboola.com,wizards,subscribed\n'
+                         'foo@bar.com,Muggles,subscribed\n')
+    client = Mock()
+    lists = ListResolver(client)
+    lists.add_created({'wizards': 'a1'})
+
+    rows = plan_run([('update_members', update_members.strpath)], THROTTLE,
+                    lists=lists)
+
+    assert [row['list_id'] for row in rows[:-2]] == ['a1', 'unknown:Muggles']
+    assert not client.lists.all.called
@@ -0,0 +1,116 @@
+import json
+import logging
+from unittest.mock import Mock
+import pytest
+from mcwriter.exceptions import ConfigError
+from mcwriter.journal import (JournalWriter, compile_journal, needs_compiling,
+                              read_index, replay_journal)
+from mcwriter.writer import run_writer
+
+
+def batch_status(batch_id):
+    return {'id': batch_id, 'status': 'finished', 'total_operations': 1,
+            'finished_operations': 1, 'errored_operations': 0}
+
+
+def test_compiling_members_into_journal(new_members_csv, tmpdir):
+    journal = tmpdir.join('journal').strpath
+    assert compile_journal(journal, [('add_members', new_members_csv.name),
+                                     ('delete_members', new_members_csv.name)]) == 2
+    entries, complete = read_index(journal)
+    assert complete
+    assert [(e['table'], e['operations']) for e in entries] == [('add_members', 2),
+                                                                ('delete_members', 2)]
+    with open(tmpdir.join('journal', entries[1]['segment']).strpath, 'rb') as f:
+        f.seek(entries[1]['offset'])
+        payload = json.loads(f.read(entries[1]['length']).decode('utf-8'))
+    assert payload['operations'][0]['method'] == 'DELETE'
+
+
+def test_replay_resumes_from_progress(tmpdir):
+    journal = tmpdir.join('journal').strpath
+    with JournalWriter(journal, segment_batches=2) as writer:
+        for i in range(3):
+            writer.append('add_members', {'operations': [{'operation_id': str(i)}]})
+    # a previous replay submitted the first batch and crashed
+    tmpdir.join('journal', 'progress.ndjson').write(
+        json.dumps({'seq': 0, 'batch_id': 'b0'}) + '\n')
+    client = Mock()
+    client.batches.create.side_effect = [{'id': 'b1'}, {'id': 'b2'}]
+    client.batches.get.side_effect = batch_status
+    outpath = tmpdir.join('add_members_batches.csv')
+
+    assert replay_journal(client, journal, {'add_members': outpath.strpath},
+                          api_delay=0) == 3
+    sent = [call[1]['data']['operations'][0]['operation_id']
+            for call in client.batches.create.call_args_list]
+    assert sent == ['1', '2']
+    assert len(outpath.read().splitlines()) == 4
+
+    # replaying a finished journal sends nothing
+    client.reset_mock()
+    assert replay_journal(client, journal, api_delay=0) == 3
+    assert not client.batches.create.called
+    assert not client.batches.get.called
+
+
+def test_incomplete_journal_isnt_replayed(tmpdir):
+    journal = tmpdir.join('journal').strpath
+    with pytest.raises(RuntimeError):
+        with JournalWriter(journal) as writer:
+            writer.append('add_members', {'operations': [{}]})
+            raise RuntimeError()
+    with pytest.raises(ConfigError):
+        replay_journal(Mock(), journal)
+
+
+def test_run_mode_compiles_changed_or_replayed_journal_again(new_members_csv, tmpdir):
+    journal = tmpdir.join('journal').strpath
+    tables = [('delete_members', new_members_csv.name)]
+    assert needs_compiling(journal, tables)
+    compile_journal(journal, tables)
+    # compiled and not replayed yet, e.g. a crashed run
+    assert not needs_compiling(journal, tables)
+    client = Mock()
+    client.batches.create.return_value = {'id': 'b0'}
+    client.batches.get.side_effect = batch_status
+    replay_journal(client, journal, api_delay=0)
+    # the replay finished, the next run sends its own tables
+    assert needs_compiling(journal, tables)
+
+    compile_journal(journal, tables)
+    with open(new_members_csv.name, 'a') as f:
+        f.write('\nnew@keboola.com,,,,,,,abc,subscribed')
+    assert needs_compiling(journal, tables)
+
+
+@pytest.mark.parametrize('mode', ['compile', 'replay'])
+def test_journal_modes_refuse_tables_they_dont_handle(tmpdir, mode):
+    tmpdir.join('in', 'tables').ensure(dir=True)
+    tables = [tmpdir.join('in', 'tables', name).strpath
+              for name in ('new_lists.csv', 'add_members.csv')]
+    with pytest.raises(ConfigError) as excinfo:
+        run_writer(Mock(), {'journal': mode}, tables, datadir=tmpdir.strpath)
+    assert 'new_lists.csv' in str(excinfo.value)
+
+
+def test_journal_modes_warn_about_ignored_engines(tmpdir, caplog):
+    tmpdir.join('in', 'tables').ensure(dir=True)
+    tables = [tmpdir.join('in', 'tables', 'new_lists.csv').strpath]
+    params = {'journal': 'compile', 'engine': 'auto', 'tags_engine': 'batches'}
+    with pytest.raises(ConfigError), caplog.at_level(logging.WARNING):
+        run_writer(Mock(), params, tables, datadir=tmpdir.strpath)
+    warnings = [r.getMessage() for r in caplog.records if r.levelname == 'WARNING']
+    assert warnings == ['The journal sends only batch operations, ignoring engine="auto"']
+
+
+def test_replay_with_disabled_client_sends_nothing(tmpdir):
+    journal = tmpdir.join('journal').strpath
+    with JournalWriter(journal) as writer:
+        writer.append('add_members', {'operations': [{'operation_id': '0'}]})
+    client = Mock()
+    # a disabled client returns None for every call
+    client.batches.create.return_value = None
+    replay_journal(client, journal, api_delay=0)
+    assert not client.batches.get.called
+    assert not tmpdir.join('journal', 'progress.ndjson').read().strip()
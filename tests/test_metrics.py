@@ -0,0 +1,88 @@
+import csv
+from unittest.mock import Mock
+import pytest
+import requests
+from mailchimp3 import MailChimp
+from mcwriter.metrics import Metrics, endpoint_name, instrument_client, percentile
+from mcwriter.utils import wait_for_batch_to_finish
+
+
+@pytest.fixture
+def registry():
+    return Metrics()
+
+
+def test_endpoint_name_replaces_ids():
+    base_url = 'https://us1.api.mailchimp.com/3.0/'
+    assert endpoint_name('put', base_url + 'lists/abc/members/123hash',
+                         base_url) == 'PUT lists/{id}/members/{id}'
+    assert endpoint_name('post', 'lists/abc/members/123hash/tags') == \
+        'POST lists/{id}/members/{id}/tags'
+    assert endpoint_name('get', 'batches') == 'GET batches'
+    assert endpoint_name('get', base_url, base_url) == 'GET /'
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 51
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
+
+
+def test_summary_contains_counters_timers_and_percentiles(registry):
+    registry.incr('rows.add_or_update', 1000)
+    registry.add_time('run_writer', 2.0)
+    registry.add_time('stage.cleaning', 0.5)
+    registry.add_time('stage.cleaning', 0.25)
+    for latency in (1, 2, 3, 4):
+        registry.observe('batch.latency_seconds', latency)
+
+    summary = registry.summary()
+    assert summary['rows.add_or_update'] == 1000
+    assert summary['stage.cleaning.seconds'] == 0.75
+    assert summary['stage.cleaning.count'] == 2
+    assert summary['batch.latency_seconds.count'] == 4
+    assert summary['batch.latency_seconds.max'] == 4
+    assert summary['rows_per_second'] == 500
+
+
+def test_writing_metrics_csv(registry, tmpdir):
+    registry.incr('api_calls.GET batches/{id}', 3)
+    outpath = registry.write_csv(tmpdir.join('writer_metrics.csv').strpath)
+    with open(outpath) as f:
+        rows = list(csv.DictReader(f))
+    assert rows == [{'metric': 'api_calls.GET batches/{id}', 'value': '3'}]
+
+
+def test_instrumented_client_counts_calls_by_endpoint(registry):
+    client = instrument_client(MailChimp('foo', 'bar', enabled=False), registry)
+    client.lists.members.create_or_update(
+        list_id='abc', subscriber_hash='a2a362ca5ce6dc7e069b6f7323342079',
+        data={'email_address': 'robin@keboola.com', 'status_if_new': 'subscribed'})
+    client.batches.get('batch1')
+    client.batches.get('batch2')
+
+    assert registry.counters['api_calls.PUT lists/{id}/members/{id}'] == 1
+    assert registry.counters['api_calls.GET batches/{id}'] == 2
+    assert registry.timer_counts['http.get'] == 2
+    # the disabled client doesn't send anything, prepare a request as it would
+    prepared = requests.Request('POST', client.base_url + 'batches', auth=client.auth,
+                                json={'operations': []}).prepare()
+    assert registry.counters['http.bytes_sent'] == len(prepared.body) == 18
+    assert prepared.headers['Authorization'].startswith('Basic ')
+
+
+def test_waiting_for_batch_records_latency(monkeypatch, registry):
+    monkeypatch.setattr('mcwriter.utils.metrics', registry)
+    finished = {'id': 'a3bb03520b', 'status': 'finished',
+                'submitted_at': '2017-04-21T11:08:15+00:00',
+                'completed_at': '2017-04-21T11:08:22+00:00',
+                'total_operations': 3, 'finished_operations': 3,
+                'errored_operations': 1}
+    client = Mock()
+    client.batches.get.return_value = finished
+    wait_for_batch_to_finish(client, 'a3bb03520b', api_delay=0)
+
+    assert registry.samples['batch.latency_seconds'] == [7.0]
+    assert registry.counters['batches.errored_operations'] == 1
+    assert registry.timer_counts['wait_for_batch'] == 1
@@ -0,0 +1,53 @@
+import random
+from unittest.mock import Mock
+from mcwriter.mirror import chunked, external_sort, diff_members, mirror_changes
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_external_sort_merges_runs(tmpdir):
+    records = [{'n': n} for n in range(100)]
+    random.Random(42).shuffle(records)
+    result = list(external_sort(iter(records), lambda r: r['n'], tmpdir.strpath,
+                                run_size=7))
+    assert [r['n'] for r in result] == list(range(100))
+    # the runs are removed once merged
+    assert tmpdir.listdir() == []
+
+
+def desired(sub_hash, **kwargs):
+    return dict({'list_id': 'abc', 'subscriber_hash': sub_hash,
+                 'email_address': '{}@example.com'.format(sub_hash),
+                 'status_if_new': 'subscribed', 'status': 'subscribed'}, **kwargs)
+
+
+def current(sub_hash, **kwargs):
+    return dict({'list_id': 'abc', 'id': sub_hash,
+                 'email_address': '{}@example.com'.format(sub_hash),
+                 'status': 'subscribed'}, **kwargs)
+
+
+def test_diffing_members():
+    changes = list(diff_members(
+        iter([desired('a'), desired('b', status='unsubscribed'), desired('c'),
+              desired('e')]),
+        iter([current('b'), current('c'), current('d'),
+              current('e', status='archived'), current('f', status='archived')])))
+    assert [(action, member['subscriber_hash']) for action, member in changes] == [
+        ('add_or_update', 'a'), ('update', 'b'), ('delete', 'd'),
+        ('add_or_update', 'e')]
+    assert 'status_if_new' not in changes[1][1]
+
+
+def test_mirror_changes_only_touches_lists_in_the_table(tmpdir):
+    client = Mock()
+    client.lists.members.all.return_value = {
+        'members': [current('z'), current('a')], 'total_items': 2}
+    chunks = [[desired('b'), desired('a')], [desired('c')]]
+    changes = list(mirror_changes(client, iter(chunks), tmpdir.strpath, run_size=2))
+
+    assert [(action, member['subscriber_hash']) for action, member in changes] == [
+        ('add_or_update', 'b'), ('add_or_update', 'c'), ('delete', 'z')]
+    assert client.lists.members.all.call_args[0] == ('abc', )
@@ -0,0 +1,75 @@
+import pytest
+from mcwriter.metrics import Metrics
+from mcwriter.planner import (EnginePlanner, SERIAL, BATCH, BULK,
+                              MAX_RUNNING_BATCHES)
+
+
+@pytest.fixture
+def registry():
+    return Metrics()
+
+
+def members(list_id, count):
+    return [{'list_id': list_id, 'email_address': '{}@example.com'.format(i)}
+            for i in range(count)]
+
+
+def test_small_chunks_are_sent_serially_large_ones_in_a_batch(registry):
+    planner = EnginePlanner(registry=registry)
+    assert planner.plan(members('small', 3)) == [(SERIAL, members('small', 3))]
+    assert registry.counters['planner.serial'] == 3
+    # the small list joins the batch of the large one
+    plan = planner.plan(members('small', 3) + members('large', 400))
+    assert [(strategy, len(sent)) for strategy, sent in plan] == [(BATCH, 403)]
+
+
+def test_serial_cost_is_for_the_whole_chunk(registry):
+    planner = EnginePlanner(registry=registry)
+    chunk = [member for list_id in 'abcde' for member in members(list_id, 100)]
+    assert [(strategy, len(sent)) for strategy, sent in planner.plan(chunk)] == \
+        [(BATCH, 500)]
+    # cheap requests don't send more than serial_limit members serially
+    planner.observe(SERIAL, 10, 0.01)
+    assert planner.plan(members('a', 60) + members('b', 41))[0][0] == BATCH
+    assert planner.plan(members('a', 60) + members('b', 40))[0][0] == SERIAL
+    planner = EnginePlanner(registry=registry, serial_limit=5)
+    assert planner.plan(members('a', 3) + members('b', 3))[0][0] == BATCH
+
+
+def test_small_runs_dont_wait_for_the_batch_queue(registry):
+    planner = EnginePlanner(registry=registry)
+    # 80 requests take less than the default batch latency
+    assert planner.plan(members('a', 40) + members('b', 40)) == [
+        (SERIAL, members('a', 40) + members('b', 40))]
+
+
+def test_running_batches_make_another_batch_cheap(registry):
+    planner = EnginePlanner(registry=registry)
+    assert planner.plan(members('abc', 5))[0][0] == SERIAL
+    assert planner.plan(members('abc', 5), running=10)[0][0] == BATCH
+    # no free slot, the batch would have to wait for one
+    costs = planner.costs(5, running=MAX_RUNNING_BATCHES)
+    assert costs[BATCH] > costs[SERIAL]
+
+
+def test_estimates_follow_observations(registry):
+    planner = EnginePlanner(registry=registry)
+    assert planner.plan(members('abc', 5))[0][0] == SERIAL
+    # the batches turned out quick, the requests slow
+    for _ in range(3):
+        registry.observe('batch.latency_seconds', 5)
+    planner.observe(SERIAL, 10, 20.0)
+    assert planner.request_latency() == 2.0
+    assert planner.plan(members('abc', 5))[0][0] == BATCH
+
+
+def test_bulk_wins_for_large_lists(registry):
+    planner = EnginePlanner((SERIAL, BATCH, BULK), registry=registry)
+    assert planner.plan(members('abc', 500))[0][0] == BULK
+    assert planner.plan(members('abc', 1))[0][0] == SERIAL
+
+
+def test_single_strategy_isnt_planned(registry):
+    planner = EnginePlanner((BATCH, ), registry=registry)
+    chunk = [('delete', {'list_id': 'abc'})]
+    assert planner.plan(chunk) == [(BATCH, chunk)]
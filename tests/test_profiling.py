@@ -0,0 +1,59 @@
+import os
+import pytest
+from mcwriter.exceptions import ConfigError
+from mcwriter.profiling import (profiled, PSTATS_FILENAME, COLLAPSED_FILENAME)
+
+
+def _busy(n=20000):
+    return sum(_square(i) for i in range(n))
+
+
+def _square(i):
+    return i * i
+
+
+def _collapsed_lines(outdir):
+    with open(os.path.join(outdir, COLLAPSED_FILENAME)) as f:
+        return f.read().splitlines()
+
+
+def test_profiling_is_noop_when_disabled(tmpdir):
+    with profiled(None, tmpdir.strpath):
+        _busy(10)
+    assert tmpdir.listdir() == []
+
+
+def test_deterministic_profile_writes_pstats_and_collapsed_stacks(tmpdir):
+    with profiled('deterministic', tmpdir.strpath):
+        _busy()
+    assert tmpdir.join(PSTATS_FILENAME).check()
+    lines = _collapsed_lines(tmpdir.strpath)
+    stacks = [l.rsplit(' ', 1) for l in lines]
+    stack, weight = [(s, w) for s, w in stacks
+                     if s.split(';')[-1].startswith('_square ')][0]
+    frames = stack.split(';')
+    # the caller is kept in the stack
+    assert any(f.startswith('_busy ') for f in frames)
+    assert int(weight) > 0
+
+
+def test_profile_true_means_deterministic(tmpdir):
+    with profiled(True, tmpdir.strpath):
+        _busy(10)
+    assert tmpdir.join(PSTATS_FILENAME).check()
+
+
+def test_sampling_profile_writes_collapsed_stacks(tmpdir, monkeypatch):
+    monkeypatch.setattr('mcwriter.profiling.SAMPLING_INTERVAL', 0.001)
+    with profiled('sampling', tmpdir.strpath):
+        for _ in range(20):
+            _busy()
+    assert not tmpdir.join(PSTATS_FILENAME).check()
+    lines = _collapsed_lines(tmpdir.strpath)
+    assert any('test_sampling_profile_writes_collapsed_stacks' in l for l in lines)
+
+
+def test_unknown_profile_mode_is_config_error(tmpdir):
+    with pytest.raises(ConfigError):
+        with profiled('magic', tmpdir.strpath):
+            pass
@@ -0,0 +1,57 @@
+import json
+import pytest
+from mcwriter.records import MemberRecord, encode_member
+from mcwriter.utils import serialize_dotted_path_dict
+
+
+@pytest.fixture
+def flat():
+    return {'email_address': 'robin@keboola.com',
+            'list_id': '12345',
+            'vip': True,
+            'merge_fields__FNAME': 'Robin',
+            'interests__1234abc': True,
+            'interests__abc1234': False,
+            'custom_list_id': 'foo',
+            'subscriber_hash': 'a2a362ca5ce6dc7e069b6f7323342079'}
+
+
+def test_record_equals_serialized_dict(flat):
+    record = MemberRecord(flat)
+    expected = serialize_dotted_path_dict(flat)
+    assert record == expected
+    assert dict(record) == expected
+    assert record.as_dict() == expected
+    assert len(record) == len(expected)
+    assert 'interests' in record
+    assert 'status' not in record
+    assert record.get('status') is None
+
+
+def test_record_pops_fixed_fields(flat):
+    record = MemberRecord(flat)
+    assert record.pop('list_id') == '12345'
+    assert record.pop('list_id', None) is None
+    with pytest.raises(KeyError):
+        record.pop('list_id')
+    assert 'list_id' not in json.loads(encode_member(record))
+
+
+def test_record_unpacks_nested_fields_when_modified(flat):
+    record = MemberRecord(flat)
+    record['merge_fields']['LNAME'] = 'Hood'
+    record['language'] = 'en'
+    del record['custom_list_id']
+    assert json.loads(encode_member(record)) == {
+        'email_address': 'robin@keboola.com',
+        'list_id': '12345',
+        'vip': True,
+        'language': 'en',
+        'merge_fields': {'FNAME': 'Robin', 'LNAME': 'Hood'},
+        'interests': {'1234abc': True, 'abc1234': False},
+        'subscriber_hash': 'a2a362ca5ce6dc7e069b6f7323342079'}
+
+
+def test_record_refuses_deep_nesting():
+    with pytest.raises(ValueError):
+        MemberRecord({'a__b__c__d': 1})
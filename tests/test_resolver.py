@@ -0,0 +1,82 @@
+import json
+import time
+from unittest.mock import Mock
+import pytest
+from mcwriter.exceptions import CleaningError
+from mcwriter.resolver import ListResolver
+from mcwriter.utils import serialize_members_input
+from mcwriter.writer import run_writer
+
+
+@pytest.fixture
+def client():
+    client = Mock()
+    client.lists.all.return_value = {
+        'total_items': 3,
+        'lists': [{'id': 'a1', 'name': 'Wizards'},
+                  {'id': 'b2', 'name': 'Witches'},
+                  {'id': 'c3', 'name': 'Witches'}]}
+    return client
+
+
+def test_resolving_custom_ids_and_names(client):
+    lists = ListResolver(client)
+    lists.add_created({'wizards': 'a1', 'deleted': 'x9'})
+    assert lists['wizards'] == 'a1'
+    assert lists['Wizards'] == 'a1'
+    # the lists are fetched once per run, with the names only
+    assert lists['wizards'] == 'a1'
+    client.lists.all.assert_called_once_with(
+        count=1000, offset=0, fields='total_items,lists.id,lists.name')
+    assert 'deleted' not in lists
+    with pytest.raises(CleaningError):
+        lists['Witches']
+    with pytest.raises(CleaningError):
+        lists['muggles']
+
+
+def test_index_is_persisted_in_state_file(client, tmpdir):
+    datadir = tmpdir.strpath
+    now = [1000.0]
+    lists = ListResolver(client, datadir=datadir, clock=lambda: now[0])
+    lists.add_created({'wizards': 'a1'})
+    assert lists['Wizards'] == 'a1'
+    client.lists.all.reset_mock()
+    tmpdir.join('in').ensure(dir=True)
+    tmpdir.join('out', 'state.json').copy(tmpdir.join('in', 'state.json'))
+
+    # fresh index, nothing fetched
+    lists = ListResolver(client, datadir=datadir, ttl=3600, clock=lambda: now[0] + 60)
+    assert lists['wizards'] == 'a1'
+    assert not client.lists.all.called
+    state = json.loads(tmpdir.join('out', 'state.json').read())
+    assert state['lists_index']['custom_ids'] == {'wizards': 'a1'}
+
+    # stale index, fetched again
+    lists = ListResolver(client, datadir=datadir, ttl=3600, clock=lambda: now[0] + 7200)
+    assert lists['wizards'] == 'a1'
+    assert client.lists.all.called
+
+
+def test_members_reference_lists_by_name(client, tmpdir):
+    members = tmpdir.join('add_members.csv')
+    members.write('email_address,custom_list_id,status_if_new\n'
+                  'robin@keboola.com,Wizards,subscribed\n')
+    chunk = next(serialize_members_input(members.strpath, 'add_or_update',
+                                         created_lists=ListResolver(client)))
+    assert chunk[0]['list_id'] == 'a1'
+
+
+def test_state_is_written_when_nothing_is_fetched(client, tmpdir):
+    index = {'custom_ids': {'wizards': 'a1'}, 'names': {}, 'fetched_at': time.time()}
+    tmpdir.join('in', 'state.json').write(json.dumps({'lists_index': index}),
+                                          ensure=True)
+    members = tmpdir.join('in', 'tables', 'add_members.csv')
+    members.write('email_address,custom_list_id,status_if_new\n'
+                  'robin@keboola.com,wizards,subscribed\n', ensure=True)
+
+    run_writer(client, {'journal': 'compile'}, [members.strpath],
+               datadir=tmpdir.strpath)
+    assert not client.lists.all.called
+    state = json.loads(tmpdir.join('out', 'state.json').read())
+    assert state['lists_index']['custom_ids'] == {'wizards': 'a1'}
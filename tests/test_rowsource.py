@@ -0,0 +1,199 @@
+import gzip
+import json
+import os
+import pytest
+from mcwriter.exceptions import ConfigError
+from mcwriter.rowsource import (RowSource, SlicedRowSource, csv_backend, open_table,
+                                read_dicts)
+import mcwriter.rowsource
+
+
+@pytest.fixture(params=['mmap', 'csv'])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def table(tmpdir):
+    path = tmpdir.join('add_members.csv')
+    path.write('list_id,email_address,merge_fields__FNAME\n'
+               'abc,robin@keboola.com,"Robin, the\nsecond"\n'
+               '\n'
+               'abc,foo@bar.com\n'
+               'def,baz@bar.com,Baz\n'
+               'ghi,"quoted@bar.com",He said "hi"\n')
+    return path.strpath
+
+
+def test_row_source_header_and_index(table, backend):
+    with RowSource(table, backend=backend) as rows:
+        assert rows.header == ('list_id', 'email_address', 'merge_fields__FNAME')
+        assert rows.index['email_address'] == 1
+
+
+def test_row_source_batches_skip_empty_lines_and_pad_short_rows(table, backend):
+    with RowSource(table, backend=backend) as rows:
+        batches = list(rows.batches(2))
+    assert [len(batch) for batch in batches] == [2, 2]
+    assert list(batches[0][0]) == ['abc', 'robin@keboola.com', 'Robin, the\nsecond']
+    assert batches[0][1] == ('abc', 'foo@bar.com', None)
+    assert list(batches[1][1]) == ['ghi', 'quoted@bar.com', 'He said "hi"']
+
+
+def test_row_source_batches_with_selected_columns(table, backend):
+    with RowSource(table, backend=backend) as rows:
+        batches = list(rows.batches(10, columns=['email_address', 'list_id']))
+    assert [list(row) for row in batches[0]] == [
+        ['robin@keboola.com', 'abc'], ['foo@bar.com', 'abc'],
+        ['baz@bar.com', 'def'], ['quoted@bar.com', 'ghi']]
+
+
+def test_reading_dicts(table, backend):
+    rows = list(read_dicts(table, backend=backend))
+    assert rows[2] == {'list_id': 'def', 'email_address': 'baz@bar.com',
+                       'merge_fields__FNAME': 'Baz'}
+
+
+def test_empty_table(tmpdir, backend):
+    path = tmpdir.join('empty.csv')
+    path.write('')
+    assert list(read_dicts(path.strpath, backend=backend)) == []
+
+
+def test_unknown_or_missing_backend(table, monkeypatch):
+    with pytest.raises(ConfigError):
+        RowSource(table, backend='pandas')
+    monkeypatch.setattr(mcwriter.rowsource, 'pyarrow', None)
+    with pytest.raises(ConfigError):
+        RowSource(table, backend='pyarrow')
+    assert mcwriter.rowsource.default_backend() == 'csv'
+
+
+def test_csv_backend_sets_the_backend_of_the_run(tmpdir, monkeypatch):
+    monkeypatch.setattr(mcwriter.rowsource, 'pyarrow', None)
+    table = tmpdir.join('add_members.csv')
+    table.write('list_id,email_address\nabc,robin@keboola.com\n')
+    table = table.strpath
+    with csv_backend('mmap'):
+        assert open_table(table).backend == 'mmap'
+    assert open_table(table).backend == 'csv'
+    with csv_backend(None):
+        assert open_table(table).backend == 'csv'
+    with pytest.raises(ConfigError):
+        with csv_backend('pandas'):
+            pass
+
+
+def test_pyarrow_backend_reads_the_same_rows(tmpdir):
+    pytest.importorskip('pyarrow')
+    path = tmpdir.join('add_members.csv')
+    path.write('list_id,email_address,vip\nabc,robin@keboola.com,\n007,foo@bar.com,true\n')
+    assert (list(read_dicts(path.strpath, backend='pyarrow')) ==
+            list(read_dicts(path.strpath, backend='csv')))
+
+
+@pytest.mark.parametrize('backend', ['mmap', 'csv', 'pyarrow'])
+def test_column_batches(tmpdir, backend, monkeypatch):
+    if backend == 'pyarrow':
+        pytest.importorskip('pyarrow')
+        # several record batches, each of a couple of rows
+        monkeypatch.setattr(mcwriter.rowsource, 'PYARROW_BLOCK_SIZE', 64)
+    path = tmpdir.join('add_members.csv')
+    path.write('list_id,email_address\n' + ''.join(
+        'abc,member{}@example.com\n'.format(i) for i in range(7)))
+    with RowSource(path.strpath, backend=backend) as rows:
+        batches = list(rows.column_batches(3))
+    assert [len(columns['email_address']) for columns in batches] == [3, 3, 1]
+    assert batches[2] == {'list_id': ['abc'], 'email_address': ['member6@example.com']}
+
+
+def write_gzip(path, text):
+    with gzip.open(path, 'wt') as f:
+        f.write(text)
+
+
+def test_reading_gzipped_table(tmpdir, backend):
+    write_gzip(tmpdir.join('add_members.csv.gz').strpath,
+               'list_id,email_address\nabc,robin@keboola.com\n')
+    # the table is referred to by its uncompressed name
+    rows = list(read_dicts(tmpdir.join('add_members.csv').strpath, backend=backend))
+    assert rows == [{'list_id': 'abc', 'email_address': 'robin@keboola.com'}]
+
+
+@pytest.fixture
+def sliced_table(tmpdir):
+    table = tmpdir.mkdir('add_members.csv')
+    tmpdir.join('add_members.csv.manifest').write(
+        json.dumps({'columns': ['list_id', 'email_address']}))
+    for part in range(5):
+        text = ''.join('abc,member{}@example.com\n'.format(part * 100 + i)
+                       for i in range(100))
+        if part % 2:
+            write_gzip(table.join('part{}.csv.gz'.format(part)).strpath, text)
+        else:
+            table.join('part{}.csv'.format(part)).write(text)
+    return table.strpath
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_reading_sliced_table(sliced_table, backend, workers):
+    with SlicedRowSource(sliced_table, backend=backend, workers=workers) as rows:
+        assert rows.header == ('list_id', 'email_address')
+        batches = list(rows.batches(30, columns=['email_address']))
+    # in the order of the slices and their rows
+    emails = [row[0] for batch in batches for row in batch]
+    assert emails == ['member{}@example.com'.format(i) for i in range(500)]
+    assert max(len(batch) for batch in batches) == 30
+
+
+def test_open_table_recognizes_sliced_tables(sliced_table):
+    with open_table(sliced_table) as rows:
+        assert isinstance(rows, SlicedRowSource)
+        assert sum(len(batch) for batch in rows.dicts(100)) == 500
+
+
+def test_sliced_table_without_manifest(tmpdir):
+    with pytest.raises(ConfigError):
+        open_table(tmpdir.mkdir('add_members.csv').strpath)
+
+
+def test_sliced_table_readers_stop_when_not_consumed(sliced_table):
+    with open_table(sliced_table) as rows:
+        batches = rows.batches(10)
+        assert next(batches)[0][1] == 'member0@example.com'
+        batches.close()
+
+
+def test_sliced_table_reader_errors_are_raised(sliced_table, backend):
+    with open(os.path.join(sliced_table, 'part9.csv'), 'wb') as f:
+        f.write(b'abc,\xff\xfe@example.com\n')
+    with pytest.raises(UnicodeDecodeError):
+        with open_table(sliced_table, backend=backend) as rows:
+            list(rows.batches(10))
+
+
+def test_mmap_falls_back_to_csv_for_quoted_and_cr_only_tables(tmpdir):
+    quoted = tmpdir.join('quoted.csv')
+    quoted.write('"list_id","email_address"\r\n"abc","robin@keboola.com"\r\n')
+    cr_only = tmpdir.join('cr_only.csv')
+    cr_only.write_binary(b'list_id,email_address\rabc,robin@keboola.com\r'
+                         b'def,foo@bar.com\r')
+    unquoted = tmpdir.join('unquoted.csv')
+    unquoted.write_binary(b'list_id,email_address\r\nabc,robin@keboola.com\r\n')
+    for path, backend, rows in ((quoted, 'csv', 1), (cr_only, 'csv', 2),
+                                (unquoted, 'mmap', 1)):
+        with RowSource(path.strpath, backend='mmap') as source:
+            assert source.backend == backend
+            assert source.header == ('list_id', 'email_address')
+            batch = [list(row) for batch in source.batches(10) for row in batch]
+        assert len(batch) == rows
+        assert batch[0] == ['abc', 'robin@keboola.com']
+
+
+def test_mmap_parses_quoted_lines_after_the_sniffed_start(table, monkeypatch):
+    monkeypatch.setattr(mcwriter.rowsource, 'SNIFF_SIZE', 16)
+    with RowSource(table, backend='mmap') as rows:
+        assert rows.backend == 'mmap'
+        batch = next(rows.batches(10))
+    assert list(batch[0]) == ['abc', 'robin@keboola.com', 'Robin, the\nsecond']
+    assert list(batch[3]) == ['ghi', 'quoted@bar.com', 'He said "hi"']
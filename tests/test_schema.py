@@ -0,0 +1,71 @@
+from unittest.mock import Mock
+import pytest
+from mcwriter.schema import MergeFieldSchemas, compile_coercer
+from mcwriter.utils import serialize_members_input
+
+
+def test_coercing_numbers_and_dates():
+    number = compile_coercer({'tag': 'AGE', 'type': 'number'})
+    assert number('42') == 42
+    assert number('4.5') == 4.5
+    assert number('') == ''
+    with pytest.raises(ValueError):
+        number('forty')
+    with pytest.raises(ValueError):
+        number('1_000')
+
+    date = compile_coercer({'tag': 'JOINED', 'type': 'date',
+                            'options': {'date_format': 'DD/MM/YYYY'}})
+    assert date('31/12/2017') == '31/12/2017'
+    assert date('2017-12-31') == '2017-12-31'
+    with pytest.raises(ValueError):
+        date('12/31/2017')
+
+    birthday = compile_coercer({'tag': 'BDAY', 'type': 'birthday'})
+    assert birthday('02/29') == '02/29'
+    with pytest.raises(ValueError):
+        birthday('02/30')
+
+
+def test_coercing_choices_and_required_fields():
+    choice = compile_coercer({'tag': 'HOUSE', 'type': 'dropdown', 'required': True,
+                              'options': {'choices': ['Gryffindor', 'Slytherin']}})
+    assert choice('Slytherin') == 'Slytherin'
+    with pytest.raises(ValueError):
+        choice('Hufflepuff')
+    with pytest.raises(ValueError):
+        choice('')
+    assert compile_coercer({'tag': 'FNAME', 'type': 'text'}) is None
+
+
+def test_members_are_validated_against_list_schemas(tmpdir):
+    client = Mock()
+    client.lists.merge_fields.all.return_value = {
+        'total_items': 2,
+        'merge_fields': [{'tag': 'FNAME', 'type': 'text'},
+                         {'tag': 'AGE', 'type': 'number'}]}
+    schemas = MergeFieldSchemas(client)
+    members = tmpdir.join('add_members.csv')
+    members.write('email_address,list_id,status_if_new,merge_fields__*|FNAME|*,'
+                  'merge_fields__AGE\n'
+                  'robin@keboola.com,a1,subscribed,Robin,27\n'
+                  'harry@keboola.com,a1,subscribed,Harry,17\n')
+    chunk = next(serialize_members_input(members.strpath, 'add_or_update',
+                                         schemas=schemas))
+    assert [member['merge_fields']['AGE'] for member in chunk] == [27, 17]
+    # the schema of the list is fetched once
+    assert client.lists.merge_fields.all.call_count == 1
+
+    # the invalid rows are quarantined, the others sent
+    members.write('email_address,list_id,status_if_new,merge_fields__AGE\n'
+                  'robin@keboola.com,a1,subscribed,27\n'
+                  'harry@keboola.com,a1,subscribed,old\n')
+    quarantine = tmpdir.join('add_members_quarantine.csv')
+    for columnar in (True, False):
+        chunk = next(serialize_members_input(members.strpath, 'add_or_update',
+                                             columnar=columnar, schemas=schemas,
+                                             quarantine_outpath=quarantine.strpath))
+        assert [member['email_address'] for member in chunk] == ['robin@keboola.com']
+        rows = quarantine.read().splitlines()
+        assert rows[1].startswith('1,harry@keboola.com,a1,')
+        assert 'AGE' in rows[1]
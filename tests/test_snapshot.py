@@ -0,0 +1,92 @@
+import datetime
+from unittest.mock import Mock
+import pytest
+from mcwriter.snapshot import (ListSnapshot, find_snapshot, refresh_snapshot,
+                               refresh_snapshots, member_in_sync)
+
+
+def member(sub_hash, status='subscribed', **kwargs):
+    return dict({'id': sub_hash, 'email_address': '{}@example.com'.format(sub_hash),
+                 'status': status, 'merge_fields': {'FNAME': 'Robin'},
+                 'interests': {}, 'vip': False}, **kwargs)
+
+
+@pytest.fixture
+def snapshot():
+    snapshot = ListSnapshot('abc0123', synced_at='2018-05-01T10:00:00+00:00')
+    snapshot.upsert(member('hash1'))
+    snapshot.upsert(member('hash2', status='archived'))
+    return snapshot
+
+
+def test_snapshot_upsert_replaces_members(snapshot):
+    snapshot.upsert(member('hash1', status='unsubscribed'))
+    assert len(snapshot) == 2
+    assert snapshot.get('hash1')['status'] == 'unsubscribed'
+    assert snapshot.get('hash3') is None
+
+
+def test_snapshot_save_and_load(snapshot, tmpdir):
+    snapshot.save(tmpdir.strpath)
+    assert tmpdir.join('members_snapshot_abc0123.json.gz.manifest').check()
+    # the input mapping prefixes the file id
+    tmpdir.join('members_snapshot_abc0123.json.gz').move(
+        tmpdir.join('123456_members_snapshot_abc0123.json.gz'))
+
+    loaded = find_snapshot(tmpdir.strpath, 'abc0123')
+    assert loaded.synced_at == snapshot.synced_at
+    assert loaded.get('hash1') == snapshot.get('hash1')
+    assert find_snapshot(tmpdir.strpath, 'other') is None
+
+
+def test_refreshing_snapshot_fetches_only_changed_members(snapshot):
+    client = Mock()
+    client.lists.members.all.side_effect = [
+        {'members': [member('hash3')], 'total_items': 1},
+        {'total_items': 3}]
+    now = datetime.datetime(2018, 5, 2, 10, 0, 0)
+    refreshed = refresh_snapshot(client, 'abc0123', snapshot, now=now)
+
+    assert len(refreshed) == 3
+    assert refreshed.synced_at == '2018-05-02T09:55:00+00:00'
+    first_call = client.lists.members.all.call_args_list[0]
+    assert first_call[1]['since_last_changed'] == '2018-05-01T10:00:00+00:00'
+
+
+def test_refreshing_snapshot_exports_all_after_deletions(snapshot):
+    client = Mock()
+    client.lists.members.all.side_effect = [
+        {'members': [], 'total_items': 0},
+        {'total_items': 1},
+        {'members': [member('hash1')], 'total_items': 1}]
+    now = datetime.datetime(2018, 5, 2, 10, 0, 0)
+    refreshed = refresh_snapshot(client, 'abc0123', snapshot, now=now)
+    assert len(refreshed) == 1
+    assert 'since_last_changed' not in client.lists.members.all.call_args[1]
+
+
+def test_refreshing_snapshots_saves_them(tmpdir):
+    client = Mock()
+    client.lists.members.all.return_value = {'members': [member('hash1')],
+                                             'total_items': 1}
+    snapshots = refresh_snapshots(client, ['abc0123', 'def4567'],
+                                  indir=tmpdir.join('in').strpath,
+                                  outdir=tmpdir.join('out').strpath)
+    assert sorted(snapshots) == ['abc0123', 'def4567']
+    assert tmpdir.join('out', 'members_snapshot_def4567.json.gz').check()
+
+
+def test_member_in_sync(snapshot):
+    snapshots = {'abc0123': snapshot}
+    same = {'list_id': 'abc0123', 'subscriber_hash': 'hash1',
+            'email_address': 'hash1@example.com', 'status_if_new': 'subscribed',
+            'merge_fields': {'FNAME': 'Robin'}}
+    changed = dict(same, merge_fields={'FNAME': 'Batman'})
+    new = dict(same, subscriber_hash='hash3')
+    assert member_in_sync(snapshots, same, 'add_or_update')
+    assert not member_in_sync(snapshots, changed, 'update')
+    assert not member_in_sync(snapshots, new, 'add_or_update')
+    assert not member_in_sync({}, same, 'add_or_update')
+    assert member_in_sync(snapshots, new, 'delete')
+    assert member_in_sync(snapshots, dict(same, subscriber_hash='hash2'), 'delete')
+    assert not member_in_sync(snapshots, same, 'delete')
@@ -12,6 +12,7 @@ from mcwriter.utils import (serialize_dotted_path_dict,
                             serialize_lists_input,
                             serialize_members_input,
                             serialize_tags_input,
+                            serialize_member_tags_by_tag,
                             prepare_batch_data_lists,
                             prepare_batch_data_add_members,
                             prepare_batch_data_delete_members,
@@ -19,7 +20,18 @@ from mcwriter.utils import (serialize_dotted_path_dict,
                             _verify_credentials,
                             batch_still_pending,
                             wait_for_batch_to_finish,
-                            write_batches_to_csv)
+                            wait_for_batches,
+                            prepare_batch_subscribe_data,
+                            BatchProgress,
+                            write_batches_to_csv,
+                            get_batch_results,
+                            get_merge_fields,
+                            get_lists,
+                            differs,
+                            prepare_batch_data_update_lists,
+                            diff_merge_fields,
+                            prepare_batch_data_merge_fields,
+                            BatchesCsvWriter)
 from mcwriter.exceptions import ConfigError, MissingFieldError
 
 @pytest.fixture
@@ -159,11 +171,11 @@ def test_preparing_batch_data():
     expected = {'operations': [
         {'method': 'POST',
          'path': '/lists',
-         'operation_id': 'bar',
+         'operation_id': '0',
          'body': json.dumps({'name':'bar', 'baz':'qux'})},
         {'method': 'POST',
          'path': '/lists',
-         'operation_id': 'bar2',
+         'operation_id': '1',
          'body': json.dumps({'name':'bar2', 'baz': 'quxx'})}
     ]}
     assert batch_data == expected
@@ -223,6 +235,32 @@ def test_serializing_members_input(new_members_csv):
     with pytest.raises(StopIteration):
         next(serialized)
 
+@pytest.mark.parametrize('action', ['add_or_update', 'update', 'delete'])
+def test_serializing_members_input_by_columns_matches_rows(new_members_csv, action):
+    by_columns = serialize_members_input(new_members_csv.name, action=action)
+    by_rows = serialize_members_input(new_members_csv.name, action=action,
+                                      columnar=False)
+    assert [dict(m) for chunk in by_columns for m in chunk] == \
+        [dict(m) for chunk in by_rows for m in chunk]
+
+
+@pytest.mark.parametrize('columnar', [True, False])
+def test_serializing_members_input_quarantines_invalid_emails(tmpdir, columnar):
+    members = tmpdir.join('delete_members.csv')
+    members.write('email_address,list_id\n'
+                  'robin@keboola.com,a1\n'
+                  'robin at keboola,a1\n')
+    quarantine = tmpdir.join('delete_members_quarantine.csv')
+    chunks = list(serialize_members_input(members.strpath, action='delete',
+                                          columnar=columnar,
+                                          quarantine_outpath=quarantine.strpath))
+    assert [m['email_address'] for chunk in chunks for m in chunk] == ['robin@keboola.com']
+    with open(quarantine.strpath) as f:
+        assert list(csv.DictReader(f)) == [{'row': '1', 'email_address': 'robin at keboola',
+                                           'list_id': 'a1',
+                                           'reason': 'invalid email address'}]
+
+
 def test_serializing_members_input_linked_to_lists(new_members_csv_linked_to_lists,
                                                    created_lists):
     serialized = serialize_members_input(
@@ -339,6 +377,83 @@ def test_waiting_for_batch_op_to_finish(pending_batch_response,
     assert results == finished_batch_response
 
 
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, name, seconds):
+        self.now += seconds
+
+
+def test_batch_progress_estimates_eta():
+    clock = FakeClock()
+    progress = BatchProgress('b1', clock)
+    progress.update({'status': 'pending', 'total_operations': 500,
+                     'finished_operations': 0})
+    assert progress.eta() is None
+    # no estimate yet, the delay grows with the polls
+    assert progress.next_delay(5) == 5
+    clock.now = 10
+    progress.update({'status': 'started', 'total_operations': 500,
+                     'finished_operations': 100})
+    assert progress.next_delay(5) == 10
+    clock.now = 20
+    progress.update({'status': 'started', 'total_operations': 500,
+                     'finished_operations': 200})
+    assert progress.rate() == 10
+    assert progress.eta() == 30
+    assert progress.next_delay(5, max_delay=20) == 20
+    progress.update({'status': 'finalizing', 'total_operations': 500,
+                     'finished_operations': 500})
+    assert progress.next_delay(5) == 5
+
+
+def test_waiting_for_batches_polls_the_next_to_finish(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr('mcwriter.utils.metrics.sleep', clock.sleep)
+
+    def status(batch_id, total, rate):
+        finished = min(total, int(clock.now * rate))
+        return {'id': batch_id, 'total_operations': total,
+                'finished_operations': finished, 'errored_operations': 0,
+                'status': 'finished' if finished == total else 'started'}
+
+    client = Mock()
+    polls = []
+
+    def get(batch_id):
+        polls.append((batch_id, clock.now))
+        if batch_id == 'slow':
+            return status(batch_id, 1000, 10)
+        return status(batch_id, 100, 10)
+    client.batches.get.side_effect = get
+
+    finished = [(s['id'], clock.now) for s in wait_for_batches(
+        client, ['slow', 'fast'], api_delay=1, clock=clock)]
+    assert [batch_id for batch_id, _ in finished] == ['fast', 'slow']
+    # the slow batch is polled rarely and no sleep follows the last poll
+    assert len([p for p in polls if p[0] == 'slow']) < 10
+    assert clock.now == finished[-1][1]
+
+
+def test_preparing_batch_subscribe_data():
+    members = [{'list_id': list_id, 'subscriber_hash': str(i),
+                'email_address': '{}@example.com'.format(i), 'status_if_new': 'subscribed'}
+               for i, list_id in enumerate(['a', 'b', 'a', 'a'])]
+    prepared = prepare_batch_subscribe_data(members, size=2)
+    assert [(list_id, [m['email_address'] for m in data['members']])
+            for list_id, data in prepared] == [
+        ('a', ['0@example.com', '2@example.com']), ('a', ['3@example.com']),
+        ('b', ['1@example.com'])]
+    assert prepared[0][1]['members'][0] == {'email_address': '0@example.com',
+                                            'status_if_new': 'subscribed'}
+    # the serialized members are left intact
+    assert members[0]['list_id'] == 'a'
+
+
 def test_parsing_tags_table(add_tags_csv):
     serialized = serialize_tags_input(add_tags_csv.strpath)
     expected = [{
@@ -396,3 +511,156 @@ def test_writing_batches_csv(tmpdir):
         reader = csv.DictReader(f)
         assert '_links' not in reader.fieldnames
         assert 'id' in reader.fieldnames
+
+
+def test_streaming_batches_csv_flushes_each_row(tmpdir, finished_batch_response):
+    outpath = tmpdir.join("out.csv")
+    with BatchesCsvWriter(outpath.strpath) as writer:
+        writer.write(finished_batch_response)
+        # the row must be on disk before the writer is closed
+        with open(outpath.strpath, 'r') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 1
+        assert rows[0]['id'] == 'a3bb03520b'
+        assert '_links' not in rows[0]
+    assert writer.written == 1
+    # the input dict is left intact
+    assert '_links' in finished_batch_response
+
+
+def test_streaming_batches_csv_has_fixed_schema(tmpdir, finished_batch_response,
+                                                pending_batch_response):
+    outpath = tmpdir.join("out.csv")
+    with BatchesCsvWriter(outpath.strpath) as writer:
+        # the pending response lacks some fields, the header must not change
+        writer.write(pending_batch_response)
+        writer.write(finished_batch_response)
+    with open(outpath.strpath, 'r') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+    assert tuple(reader.fieldnames) == BatchesCsvWriter(None).fieldnames
+    assert rows[0]['completed_at'] == ''
+    assert rows[1]['completed_at'] == '2017-04-21T11:08:22+00:00'
+
+
+def test_streaming_batches_csv_creates_no_file_without_batches(tmpdir):
+    outpath = tmpdir.join("out.csv")
+    with BatchesCsvWriter(outpath.strpath) as writer:
+        pass
+    assert writer.written == 0
+    assert not outpath.check()
+
+
+def test_getting_batch_results(monkeypatch, finished_batch_response,
+                               batch_results_response):
+    response = batch_results_response([
+        {'status_code': 200, 'operation_id': 'custom_list1',
+         'response': json.dumps({'id': 'mc_list_1'})},
+        {'status_code': 400, 'operation_id': 'custom_list2',
+         'response': json.dumps({'title': 'Invalid Resource'})}])
+    monkeypatch.setattr('mcwriter.utils.requests.get', Mock(return_value=response))
+
+    results = list(get_batch_results(finished_batch_response))
+    assert results == [
+        {'status_code': 200, 'operation_id': 'custom_list1',
+         'response': {'id': 'mc_list_1'}},
+        {'status_code': 400, 'operation_id': 'custom_list2',
+         'response': {'title': 'Invalid Resource'}}]
+
+
+def test_getting_batch_results_without_url(pending_batch_response):
+    del pending_batch_response['response_body_url']
+    assert list(get_batch_results(pending_batch_response)) == []
+
+
+def test_preparing_batch_data_lists_uses_unique_operation_ids():
+    data = [{'name': 'bar', 'custom_id': 'custom_bar'},
+            {'name': 'custom_bar'},
+            {'name': 'bar', 'custom_id': 'custom_bar'}]
+    batch_data = prepare_batch_data_lists(data)
+    assert [op['operation_id'] for op in batch_data['operations']] == ['0', '1', '2']
+
+
+@pytest.fixture
+def existing_merge_fields():
+    return [
+        {'merge_id': 1, 'tag': 'FNAME', 'name': 'First Name', 'type': 'text',
+         'required': False, 'options': {'size': 25}},
+        {'merge_id': 2, 'tag': 'MYFIRST', 'name': 'My first tag', 'type': 'text',
+         'required': False, 'options': {'size': 255}}]
+
+
+def test_getting_merge_fields_pages_through_all(existing_merge_fields):
+    client = Mock()
+    client.lists.merge_fields.all.side_effect = [
+        {'merge_fields': existing_merge_fields[:1], 'total_items': 2},
+        {'merge_fields': existing_merge_fields[1:], 'total_items': 2}]
+    assert get_merge_fields(client, 'abc0123', page_size=1) == existing_merge_fields
+    client.lists.merge_fields.all.assert_called_with('abc0123', count=1, offset=1)
+
+
+def test_diffing_merge_fields(existing_merge_fields):
+    wanted = [
+        {'name': 'My first tag', 'type': 'text', 'tag': 'myfirst',
+         'required': False, 'options': {'size': 255}},
+        {'name': 'First Name', 'type': 'text', 'required': True},
+        {'name': 'Shoe size', 'type': 'number', 'tag': 'SHOE'}]
+    to_create, to_update = diff_merge_fields(existing_merge_fields, wanted)
+    assert to_create == [{'name': 'Shoe size', 'type': 'number', 'tag': 'SHOE'}]
+    assert to_update == [(1, {'required': True, 'name': 'First Name'})]
+
+
+def test_preparing_batch_data_merge_fields():
+    batch_data = prepare_batch_data_merge_fields(
+        'abc0123', [{'name': 'Shoe size', 'type': 'number', 'tag': 'SHOE'}],
+        [(1, {'name': 'First Name', 'required': True})])
+    operations = batch_data['operations']
+    assert [(op['method'], op['path']) for op in operations] == [
+        ('POST', '/lists/abc0123/merge-fields'),
+        ('PATCH', '/lists/abc0123/merge-fields/1')]
+    assert json.loads(operations[1]['body']) == {'name': 'First Name', 'required': True}
+
+
+def test_getting_lists_pages_through_all():
+    client = Mock()
+    client.lists.all.side_effect = [
+        {'lists': [{'id': 'abc', 'name': 'A'}], 'total_items': 2},
+        {'lists': [{'id': 'def', 'name': 'B'}], 'total_items': 2}]
+    lists = get_lists(client, fields=['name'], page_size=1)
+    assert lists == {'abc': {'id': 'abc', 'name': 'A'},
+                     'def': {'id': 'def', 'name': 'B'}}
+    client.lists.all.assert_called_with(count=1, offset=1,
+                                        fields='total_items,lists.id,lists.name')
+
+
+def test_differs_compares_nested_values():
+    existing = {'name': 'Wizards', 'stats': {'member_count': 3},
+                'contact': {'city': 'Wizardshire', 'zip': '66678'}}
+    assert not differs(existing, {'name': 'Wizards', 'contact': {'city': 'Wizardshire'}})
+    assert differs(existing, {'name': 'Wizards', 'contact': {'city': 'Hogsmeade'}})
+    assert differs(existing, {'visibility': 'prv'})
+
+
+def test_preparing_batch_data_update_lists():
+    batch_data = prepare_batch_data_update_lists([{'list_id': 'abc', 'name': 'A'}])
+    assert batch_data == {'operations': [{
+        'method': 'PATCH', 'path': '/lists/abc', 'operation_id': 'abc',
+        'body': json.dumps({'name': 'A'})}]}
+
+
+def test_grouping_member_tags_keeps_the_last_status(tmpdir):
+    tags = tmpdir.join('add_member_tags.csv')
+    tags.write('list_id,email_address,tags\n'
+               'abc,robin@keboola.com,"[{""name"": ""vip""}]"\n'
+               'abc,foo@bar.com,"[{""name"": ""vip"", ""status"": ""inactive""}]"\n'
+               'abc,robin@keboola.com,"[{""name"": ""vip"", ""status"": ""inactive""}]"\n'
+               'abc,foo@bar.com,"[{""name"": ""vip""}]"\n')
+    assert list(serialize_member_tags_by_tag(tags.strpath)) == [
+        ('abc', 'vip', 'active', ['foo@bar.com']),
+        ('abc', 'vip', 'inactive', ['robin@keboola.com'])]
+    # a full group goes before the later group of the other status
+    assert list(serialize_member_tags_by_tag(tags.strpath, size=1)) == [
+        ('abc', 'vip', 'active', ['robin@keboola.com']),
+        ('abc', 'vip', 'inactive', ['foo@bar.com']),
+        ('abc', 'vip', 'inactive', ['robin@keboola.com']),
+        ('abc', 'vip', 'active', ['foo@bar.com'])]
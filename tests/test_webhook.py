@@ -0,0 +1,100 @@
+import threading
+from unittest.mock import Mock
+import pytest
+import requests
+from mcwriter.utils import wait_for_batches
+from mcwriter.webhook import (BatchWebhookReceiver, batch_webhook,
+                              current_receiver, parse_notification)
+
+NOTIFICATION = ('type=batch_operation_completed&fired_at=2017-04-21+11%3A08%3A22'
+                '&data%5Bid%5D=a3bb03520b&data%5Bstatus%5D=finished'
+                '&data%5Btotal_operations%5D=3&data%5Bfinished_operations%5D=3'
+                '&data%5Berrored_operations%5D=1')
+
+
+@pytest.fixture
+def receiver():
+    receiver = BatchWebhookReceiver('127.0.0.1')
+    receiver.start()
+    yield receiver
+    receiver.stop()
+
+
+def url(receiver, path=None):
+    return 'http://127.0.0.1:{}{}'.format(receiver.port, path or receiver.path)
+
+
+def test_parsing_notification():
+    assert parse_notification(NOTIFICATION) == {
+        'id': 'a3bb03520b', 'status': 'finished', 'total_operations': 3,
+        'finished_operations': 3, 'errored_operations': 1}
+    assert parse_notification('type=subscribe&data%5Bid%5D=abc') is None
+    with pytest.raises(ValueError):
+        parse_notification('type=batch_operation_completed&data%5Bid%5D=abc')
+    with pytest.raises(ValueError):
+        parse_notification('[]', 'application/json')
+
+
+def test_receiver_collects_notifications(receiver):
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    receiver.expect(['a3bb03520b'])
+    assert requests.get(url(receiver)).status_code == 200
+    assert requests.post(url(receiver, '/elsewhere'), data=NOTIFICATION,
+                         headers=headers).status_code == 404
+    assert requests.post(url(receiver), data=NOTIFICATION,
+                         headers=headers).status_code == 200
+    assert receiver.finished('a3bb03520b')['errored_operations'] == 1
+    assert receiver.finished('a3bb03520b') is None
+
+
+def test_receiver_refuses_incomplete_notifications(receiver):
+    receiver.expect(['a3bb03520b'])
+    incomplete = NOTIFICATION.replace('&data%5Btotal_operations%5D=3', '')
+    assert requests.post(url(receiver), data=incomplete).status_code == 400
+    assert receiver.received == 0
+    assert receiver.finished('a3bb03520b') is None
+
+
+def test_receiver_drops_notifications_nobody_waits_for(receiver):
+    assert requests.post(url(receiver), data=NOTIFICATION).status_code == 200
+    assert receiver.received == 0
+    receiver.expect(['a3bb03520b'])
+    assert receiver.finished('a3bb03520b') is None
+    # a stopped wait drops what was kept for it
+    requests.post(url(receiver), data=NOTIFICATION)
+    receiver.forget(['a3bb03520b'])
+    assert receiver.finished('a3bb03520b') is None
+    assert not receiver._finished
+
+
+def test_waiting_for_notified_batch(receiver):
+    client = Mock()
+    client.batches.get.return_value = {'id': 'a3bb03520b', 'status': 'started',
+                                       'total_operations': 3,
+                                       'finished_operations': 0}
+    timer = threading.Timer(0.2, requests.post, args=(url(receiver), ),
+                            kwargs={'data': NOTIFICATION})
+    timer.start()
+    try:
+        statuses = list(wait_for_batches(client, ['a3bb03520b'], api_delay=0.01,
+                                         receiver=receiver))
+    finally:
+        timer.cancel()
+    assert [status['status'] for status in statuses] == ['finished']
+    # polled once at the start, then only the slow fallback is left
+    assert client.batches.get.call_count == 1
+    # the batch isn't waited for anymore
+    requests.post(url(receiver), data=NOTIFICATION)
+    assert not receiver._finished
+
+
+def test_registering_batch_webhook():
+    client = Mock()
+    client._post.return_value = {'id': 'webhook1'}
+    with batch_webhook(client, 'https://writer.example.com/', port=0) as receiver:
+        assert current_receiver() is receiver
+        client._post.assert_called_once_with(
+            url='batch-webhooks',
+            data={'url': 'https://writer.example.com' + receiver.path})
+    assert current_receiver() is None
+    client._delete.assert_called_once_with(url='batch-webhooks/webhook1')
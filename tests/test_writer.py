@@ -1,8 +1,13 @@
 import pytest
 import requests
+import csv
+import time
 from mcwriter.writer import (create_lists, update_lists,
                              create_tags, add_members_to_lists,
-                             _create_lists_serial)
+                             delete_members, add_member_tags,
+                             _create_lists_serial,
+                             _create_lists_in_batch)
+from mcwriter.exceptions import BatchOperationError
 from tempfile import NamedTemporaryFile
 from mcwriter.exceptions import CleaningError, MissingFieldError, UserError
 import mcwriter
@@ -128,3 +133,291 @@ def test_creating_tags_with_created_lists_has_ok_syntax(client, add_tags_csv_cus
     created_lists = {'wizards': 'abc0123'}
     create_tags(client, csv_tags=add_tags_csv_custom_id.strpath, created_lists=created_lists)
     assert 1
+
+
+def test_deleting_members_streams_batch_results(client, new_members_csv,
+                                                monkeypatch, tmpdir):
+    monkeypatch.setattr('mcwriter.writer.BATCH_DELAY', 0)
+    monkeypatch.setattr('mcwriter.writer.SEQUENTIAL_REQUEST_DELAY', 0)
+    monkeypatch.setattr(client.batches, 'create',
+                        lambda data: {'id': 'batch1', 'status': 'pending'})
+    monkeypatch.setattr(client.batches, 'get',
+                        lambda batch_id: {'id': batch_id,
+                                          'status': 'finished',
+                                          'total_operations': 2,
+                                          'finished_operations': 2,
+                                          'errored_operations': 0,
+                                          '_links': []})
+    outpath = tmpdir.join('delete_members_batches.csv')
+    finished = delete_members(client, new_members_csv.name, outpath=outpath.strpath)
+    assert finished == 1
+    with open(outpath.strpath) as f:
+        rows = list(csv.DictReader(f))
+    assert rows[0]['id'] == 'batch1'
+    assert rows[0]['total_operations'] == '2'
+
+
+@pytest.fixture
+def finished_lists_batch(client, monkeypatch, batch_results_response):
+    """Fake the batch endpoints, set `.results` to the per operation results"""
+    class Batch:
+        results = []
+    monkeypatch.setattr(client.batches, 'create',
+                        lambda data: {'id': 'batch1', 'status': 'pending'})
+    monkeypatch.setattr(client.batches, 'get',
+                        lambda batch_id: {'id': batch_id, 'status': 'finished',
+                                          'total_operations': 1,
+                                          'finished_operations': 1,
+                                          'errored_operations': 0,
+                                          'response_body_url': 'https://s3/x.tar.gz'})
+    monkeypatch.setattr('mcwriter.utils.requests.get',
+                        lambda *args, **kwargs: batch_results_response(Batch.results))
+    return Batch
+
+
+def test_creating_lists_in_batch_returns_custom_ids(client, finished_lists_batch):
+    finished_lists_batch.results = [
+        {'status_code': 200, 'operation_id': str(i),
+         'response': '{{"id": "mc_list_{}"}}'.format(i)}
+        for i in range(4)]
+    serialized_data = [{'name': 'list {}'.format(i),
+                        'custom_id': 'custom_list_{}'.format(i)}
+                       for i in range(3)]
+    # named as the custom_id of another list
+    serialized_data.insert(1, {'name': 'custom_list_0'})
+    lists = _create_lists_in_batch(client, serialized_data)
+    assert lists == {'custom_list_0': 'mc_list_0',
+                     'custom_list_1': 'mc_list_2',
+                     'custom_list_2': 'mc_list_3'}
+
+
+def test_creating_lists_in_batch_with_disabled_client():
+    import mailchimp3
+    client = mailchimp3.MailChimp('foo', 'bar', enabled=False)
+    assert _create_lists_in_batch(client, [{'name': 'list 0', 'custom_id': 'a'}]) == {}
+
+
+def test_creating_lists_in_batch_raises_on_errored_operations(client, finished_lists_batch):
+    finished_lists_batch.results = [
+        {'status_code': 400, 'operation_id': '0',
+         'response': '{"title": "Invalid Resource"}'}]
+    with pytest.raises(BatchOperationError):
+        _create_lists_in_batch(client, [{'name': 'list 0', 'custom_id': 'custom_list_0'}])
+
+
+def test_creating_tags_only_sends_missing_ones(client, add_tags_csv, monkeypatch):
+    monkeypatch.setattr('mcwriter.writer.SEQUENTIAL_REQUEST_DELAY', 0)
+    existing = {'merge_id': 3, 'tag': 'MYFIRST', 'name': 'My first tag',
+                'type': 'text', 'required': False, 'options': {'size': 255}}
+    monkeypatch.setattr(client.lists.merge_fields, 'all', lambda list_id, **kwargs: {
+        'merge_fields': [existing], 'total_items': 1})
+    created = []
+    monkeypatch.setattr(client.lists.merge_fields, 'create',
+                        lambda list_id, data: created.append(data))
+
+    create_tags(client, csv_tags=add_tags_csv.strpath)
+    assert created == []
+
+    existing['tag'] = 'OTHER'
+    create_tags(client, csv_tags=add_tags_csv.strpath)
+    assert [tag['tag'] for tag in created] == ['MYFIRST']
+
+
+def test_updating_lists_skips_unchanged_lists(client, update_lists_csv, monkeypatch):
+    unchanged = mcwriter.utils.serialize_lists_input(update_lists_csv.name)[0]
+    existing = dict(unchanged, id=unchanged.pop('list_id'))
+    monkeypatch.setattr(client.lists, 'all', lambda **kwargs: {
+        'lists': [existing], 'total_items': 1})
+    updated = []
+    monkeypatch.setattr(client.lists, 'update',
+                        lambda list_id, data: updated.append(list_id))
+
+    update_lists(client, csv_lists=update_lists_csv.name)
+    assert updated == ['1234xxbc']
+
+
+def test_adding_members_skips_members_in_sync(client, new_members_csv, monkeypatch):
+    from mcwriter.snapshot import ListSnapshot
+    from mcwriter.utils import serialize_members_input
+    snapshot = ListSnapshot('12345')
+    for chunk in serialize_members_input(new_members_csv.name, action='add_or_update'):
+        for member in chunk:
+            snapshot.upsert(dict(member, id=member['subscriber_hash']))
+    snapshot.upsert({'id': snapshot.columns['subscriber_hash'][1], 'status': 'cleaned'})
+    sent = []
+    monkeypatch.setattr('mcwriter.writer._add_members_serial',
+                        lambda client, data: sent.extend(data))
+
+    add_members_to_lists(client, new_members_csv.name, batch=False,
+                         snapshots={'12345': snapshot})
+    assert [member['email_address'] for member in sent] == ['foo@bar.com']
+
+
+def test_snapshots_decode_only_the_list_columns(tmpdir, monkeypatch):
+    from mcwriter.writer import _refresh_snapshots
+    from mcwriter.rowsource import RowSource
+    table = tmpdir.join('add_members.csv')
+    table.write('email_address,custom_list_id,list_id\n'
+                'a@b.cz,,abc\n'
+                'c@d.cz,wizards,\n')
+    selected = []
+    batches = RowSource.batches
+
+    def recording_batches(self, size, columns=None):
+        selected.append(columns)
+        return batches(self, size, columns)
+    monkeypatch.setattr(RowSource, 'batches', recording_batches)
+    refreshed = []
+    monkeypatch.setattr('mcwriter.writer.refresh_snapshots',
+                        lambda client, list_ids, **kwargs: refreshed.append(list_ids) or {})
+
+    _refresh_snapshots(None, [table.strpath], {}, tmpdir.strpath,
+                       lists={'wizards': 'def'})
+    assert selected == [['list_id', 'custom_list_id']]
+    assert refreshed == [{'abc', 'def'}]
+
+
+def test_mirroring_members_sends_one_batch(client, new_members_csv, monkeypatch):
+    from mcwriter.writer import mirror_members
+    monkeypatch.setattr('mcwriter.writer.BATCH_DELAY', 0)
+    monkeypatch.setattr(client.lists.members, 'all', lambda list_id, **kwargs: {
+        'members': [{'id': 'b8dab1a6741b4fb07ae73544b508bbbe', 'status': 'subscribed',
+                     'email_address': 'gone@example.com'}],
+        'total_items': 1})
+    sent = []
+
+    def create_batch(data):
+        sent.append(data)
+        return {'id': 'batch1'}
+    monkeypatch.setattr(client.batches, 'create', create_batch)
+    monkeypatch.setattr('mcwriter.writer.wait_for_batches',
+                        lambda client, batch_ids, api_delay: [{'id': batch_id}
+                                                              for batch_id in batch_ids])
+
+    assert mirror_members(client, new_members_csv.name) == 1
+    assert len(sent) == 1
+    methods = [op['method'] for op in sent[0]['operations']]
+    assert sorted(methods) == ['DELETE', 'PUT', 'PUT']
+
+
+def test_planner_observes_only_the_batch_request(client, monkeypatch):
+    from mcwriter.writer import _send_chunks_and_wait_for_batches
+    from mcwriter.metrics import Metrics
+    from mcwriter.planner import EnginePlanner
+    registry = Metrics()
+    monkeypatch.setattr('mcwriter.writer.metrics', registry)
+    monkeypatch.setattr('mcwriter.writer.BATCH_DELAY', 0)
+    monkeypatch.setattr('mcwriter.writer.wait_for_batches',
+                        lambda client, batch_ids, api_delay: [])
+    observed = []
+    monkeypatch.setattr(EnginePlanner, 'observe',
+                        lambda self, strategy, size, seconds: observed.append(seconds))
+
+    def batch_action(client, members):
+        # preparing the operations takes long, the request doesn't
+        registry.add_time('stage.prepare_batch', 100)
+        return {'id': 'batch1'}
+
+    _send_chunks_and_wait_for_batches(client, [[{'list_id': 'abc'}]],
+                                      batch_action=batch_action, batch=True)
+    assert len(observed) == 1
+    assert observed[0] < 1
+
+
+def test_adding_members_through_batch_subscribe(client, new_members_csv,
+                                               monkeypatch, tmpdir):
+    requests = []
+
+    def update_members(list_id, data):
+        requests.append((list_id, data))
+        return {'total_created': 1, 'total_updated': 0, 'error_count': 1,
+                'errors': [{'email_address': 'foo@bar.com',
+                            'error': 'looks fake', 'error_code': 'ERROR_GENERIC'}]}
+    monkeypatch.setattr(client.lists, 'update_members', update_members)
+    errors = tmpdir.join('add_members_errors.csv')
+
+    assert add_members_to_lists(client, new_members_csv.name, engine='subscribe',
+                                errors_outpath=errors.strpath) == 1
+    list_id, data = requests[0]
+    assert list_id == '12345'
+    assert data['update_existing'] is True
+    assert [m['email_address'] for m in data['members']] == ['robin@keboola.com',
+                                                             'foo@bar.com']
+    assert 'subscriber_hash' not in data['members'][0]
+    assert errors.read().splitlines() == ['list_id,email_address,error_code,error',
+                                          '12345,foo@bar.com,ERROR_GENERIC,looks fake']
+
+
+def test_tagging_members_through_static_segments(client, monkeypatch, tmpdir):
+    tags = tmpdir.join('add_member_tags.csv')
+    tags.write('list_id,email_address,tags\n'
+               '12345,robin@keboola.com,"[{""name"": ""vip""}, {""name"": ""old"", ""status"": ""inactive""}]"\n'
+               '12345,foo@bar.com,"[{""name"": ""vip""}, {""name"": ""gone"", ""status"": ""inactive""}]"\n')
+    created = []
+    requests = []
+
+    def all_segments(list_id, **queryparams):
+        assert queryparams['type'] == 'static'
+        return {'total_items': 1, 'segments': [{'id': 7, 'name': 'old'}]}
+
+    def create(list_id, data):
+        created.append((list_id, data['name']))
+        return {'id': 8, 'name': data['name']}
+
+    def update_members(list_id, segment_id, data):
+        requests.append((list_id, segment_id, data))
+        return {'total_added': 1, 'total_removed': 0, 'error_count': 1,
+                'errors': [{'email_addresses': ['foo@bar.com'], 'error': 'unsubscribed'}]}
+    monkeypatch.setattr(client.lists.segments, 'all', all_segments)
+    monkeypatch.setattr(client.lists.segments, 'create', create)
+    monkeypatch.setattr(client.lists.segments, 'update_members', update_members)
+    errors = tmpdir.join('add_member_tags_errors.csv')
+
+    assert add_member_tags(client, tags.strpath, engine='segments',
+                           errors_outpath=errors.strpath) == 2
+    # the missing tag is created once, removing a missing tag is a no-op
+    assert created == [('12345', 'vip')]
+    assert sorted(requests, key=lambda r: r[1]) == [
+        ('12345', 7, {'members_to_remove': ['robin@keboola.com']}),
+        ('12345', 8, {'members_to_add': ['robin@keboola.com', 'foo@bar.com']})]
+    assert errors.read().splitlines()[0] == 'list_id,tag,email_address,error'
+    assert len(errors.read().splitlines()) == 3
+
+
+def test_adding_and_removing_a_tag_dont_overlap(client, monkeypatch):
+    groups = [('12345', 'vip', 'active', ['robin@keboola.com']),
+              ('12345', 'vip', 'inactive', ['robin@keboola.com']),
+              ('12345', 'vip', 'active', ['robin@keboola.com'])]
+    monkeypatch.setattr(mcwriter.writer, 'serialize_member_tags_by_tag',
+                        lambda path: iter(groups))
+    monkeypatch.setattr(client.lists.segments, 'all', lambda list_id, **params: {
+        'total_items': 1, 'segments': [{'id': 7, 'name': 'vip'}]})
+    running = []
+    overlapping = []
+    finished = []
+
+    def update_members(list_id, segment_id, data):
+        overlapping.extend(running)
+        running.append(data)
+        time.sleep(0.05)
+        running.remove(data)
+        finished.append(list(data))
+        return {}
+    monkeypatch.setattr(client.lists.segments, 'update_members', update_members)
+
+    assert add_member_tags(client, 'add_member_tags.csv', engine='segments') == 3
+    assert not overlapping
+    assert finished == [['members_to_add'], ['members_to_remove'], ['members_to_add']]
+
+
+def test_finding_input_tables(tmpdir):
+    from pathlib import Path
+    from mcwriter.writer import _find_tables
+    tables = tmpdir.mkdir('in').mkdir('tables')
+    tables.join('add_members.csv').write('')
+    tables.join('delete_members.csv.gz').write('')
+    tables.mkdir('update_members.csv')
+    tables.join('update_members.csv.manifest').write('{}')
+    assert _find_tables(Path(tables.strpath)) == [
+        tables.join(name).strpath for name in
+        ('add_members.csv', 'delete_members.csv', 'update_members.csv')]